@@ -1,22 +1,21 @@
-import os
+from udp_sweep import sweep
 
-client = "python3 udp_rtt.py -c -f {frequency} -n {packetsize} -t {time} --ip {ip} --lp {local_port} --rp {remote_port} --save {save} --verbose False"
-
-server = "python3 udp_rtt.py -s -b 1024 -n {packetsize} --ip {ip} --lp {local_port} --rp {remote_port} --verbose False"
+# Start the long-lived server side once (on the remote host):
+#     python3 udp_sweep.py -s
+# Every packet size then reuses the same sockets, processes and clock sync;
+# results are written to the "runs" table of sweep.db. The sweep measures
+# one-way latency on synchronized clocks, where the old os.system loop took
+# the RTT with udp_rtt.py.
 
 FREQUENCY = 1
 
-for packet_size in range(50, 1500, 10):
-    os.system(
-        server.format(packetsize=packet_size,
-                      ip="localhost",
-                      local_port=10003,
-                      remote_port=10002) + '|' +
-        client.format(frequency=FREQUENCY,
-                      packetsize=packet_size,
-                      time=10,
-                      ip="localhost",
-                      local_port=10002,
-                      remote_port=10003,
-                      save="test_%04d.csv" % packet_size))
-    break
+# The sweep starts processes; under the spawn start method (macOS, Windows)
+# they import this file again, which must not start another sweep
+if __name__ == "__main__":
+    sweep(
+        "localhost",
+        sizes=range(50, 1500, 10),
+        rates=[FREQUENCY],
+        durations=[10],
+        store="sweep.db",
+    )
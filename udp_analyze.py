@@ -0,0 +1,239 @@
+import csv
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from udp_hist import LatencyHistogram
+from udp_numpy import numpy
+from udp_record import RecordFile, is_csv
+from udp_stats import StreamingStats, histogram_percentiles, summarize
+
+
+CACHE_PATH = ".udp_analyze_cache.json"
+# 2: summaries count loss against the recorded packet count, entries keep
+# the announced run
+CACHE_VERSION = 2
+_BLOCK = 1 << 20
+# Command-line options of the sender that name a field of the recorded run
+RUN_FIELDS = {"-f": "rate", "-n": "size", "-t": "duration"}
+
+# Summary key and table title; latencies are in seconds
+COLUMNS = (
+    ("count", "count"),
+    ("latency_avg", "avg"),
+    ("p50", "p50"),
+    ("p99", "p99"),
+    ("p999", "p99.9"),
+    ("latency_max", "max"),
+    ("jitter_rfc3550", "jitter"),
+    ("packet_loss", "loss"),
+)
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _summarize_rows(rows: Iterable[Tuple[int, int, int, int]], expected: int = 0) -> dict:
+    # Streaming path: constant memory, percentiles from the histogram
+    stats = StreamingStats(expected)
+    histogram = LatencyHistogram()
+    update = stats.update
+    record = histogram.record
+    for index, latency, recv_time, size in rows:
+        update(index, latency, recv_time, size)
+        record(latency)
+    return stats.summary(histogram_percentiles(histogram))
+
+
+def _csv_rows(path: str):
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        index, latency, recv_time, size = (
+            header.index(name) for name in ("index", "latency", "recv-time", "recv-size")
+        )
+        for row in reader:
+            yield (
+                int(row[index]),
+                round(float(row[latency]) * 1e9),
+                int(row[recv_time]),
+                int(row[size]),
+            )
+
+
+def load(path: str) -> Tuple[dict, dict, dict]:
+    # Returns (summary, command-line parameters, announced run) of one saved
+    # run. Loss is counted against the run's packet count, so packets lost at
+    # the end of a record still count; CSV files carry none.
+    if is_csv(path):
+        return _summarize_rows(_csv_rows(path)), {}, {}
+    with RecordFile(path) as record:
+        expected = int(record.run.get("expected") or 0)
+        if numpy() is not None:
+            result = summarize(record, expected)
+        else:
+            result = _summarize_rows(
+                zip(
+                    record.column("index"),
+                    record.column("latency"),
+                    record.column("recv-time"),
+                    record.column("recv-size"),
+                ),
+                expected,
+            )
+        return result, record.params, record.run
+
+
+class ResultCache:
+    # Summaries keyed by content hash; (path, size, mtime) remembers the hash
+    # of files seen before so unchanged files are not even read again
+    def __init__(self, path: Optional[str] = CACHE_PATH) -> None:
+        self.path = path
+        self.results: Dict[str, dict] = {}
+        self.files: Dict[str, str] = {}
+        self.dirty = False
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_VERSION:
+                self.results = data["results"]
+                self.files = data["files"]
+
+    def get(self, path: str) -> dict:
+        st = os.stat(path)
+        stamp = "%s:%d:%d" % (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        digest = self.files.get(stamp)
+        if digest is None or digest not in self.results:
+            digest = file_hash(path)
+            self.files[stamp] = digest
+            self.dirty = True
+        if digest not in self.results:
+            result, params, run = load(path)
+            self.results[digest] = {"summary": result, "params": params, "run": run}
+        return self.results[digest]
+
+    def save(self) -> None:
+        if not self.path or not self.dirty:
+            return
+        with open(self.path, "w") as f:
+            json.dump(
+                {"version": CACHE_VERSION, "results": self.results, "files": self.files},
+                f,
+            )
+        self.dirty = False
+
+
+def expand(paths: Iterable[str]) -> List[str]:
+    files: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith((".udpl", ".csv"))
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def _key(path: str, params: dict, run: dict, by: Optional[str]):
+    # Sweep variable of a run: a field of the run the sender announced (rate,
+    # size, duration, expected; -f, -n and -t name the first three), else a
+    # saved command-line parameter, else the last number in the file name
+    # (test_0050.csv from example.py)
+    field = RUN_FIELDS.get(by, by) if by else None
+    if field and run.get(field) is not None:
+        return float(run[field])
+    if by and by in params:
+        try:
+            return float(params[by])
+        except ValueError:
+            return params[by]
+    numbers = re.findall(r"\d+", os.path.basename(path))
+    return int(numbers[-1]) if numbers else os.path.basename(path)
+
+
+def analyze(
+    paths: Iterable[str], by: Optional[str] = None, cache: Optional[str] = CACHE_PATH
+) -> List[Tuple[object, str, dict]]:
+    store = ResultCache(cache)
+    runs = []
+    for path in expand(paths):
+        entry = store.get(path)
+        runs.append((_key(path, entry["params"], entry["run"], by), path, entry["summary"]))
+    store.save()
+    runs.sort(key=lambda run: (isinstance(run[0], str), run[0], run[1]))
+    return runs
+
+
+def _format_key(key) -> str:
+    if isinstance(key, float) and key.is_integer():
+        return "%d" % key
+    return str(key)
+
+
+def _cell(value) -> str:
+    if isinstance(value, int):
+        return "%10d" % value
+    if value is None or math.isnan(value):
+        return "%10s" % "-"
+    return "%10.6f" % value
+
+
+def print_table(runs: List[Tuple[object, str, dict]], by: Optional[str]) -> None:
+    print("| -------------  Comparison  --------------- |")
+    print("%-24s" % (by or "run") + "".join("%10s" % title for _, title in COLUMNS))
+    for key, path, result in runs:
+        label = _format_key(key) if by else os.path.basename(path)
+        print(
+            "%-24s" % label[:24]
+            + "".join(_cell(result.get(name)) for name, _ in COLUMNS)
+        )
+
+
+def write_table(runs: List[Tuple[object, str, dict]], path: str) -> None:
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["key", "path"] + [name for name, _ in COLUMNS])
+        for key, run_path, result in runs:
+            writer.writerow(
+                [_format_key(key), run_path] + [result.get(name) for name, _ in COLUMNS]
+            )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import getopt
+
+    try:
+        _opts, _paths = getopt.gnu_getopt(
+            sys.argv[1:] if argv is None else argv, "", ["by=", "cache=", "save="]
+        )
+        opts = dict(_opts)
+        if not _paths:
+            raise getopt.GetoptError("no input")
+    except getopt.GetoptError:
+        print(
+            "Usage --> udp_analyze.py <record / csv / directory> [...] --by <run field or parameter, e.g. size or -n> --cache <cache path> --save <table saving path>"
+        )
+        sys.exit(2)
+
+    _by = opts.get("--by")
+    _runs = analyze(_paths, by=_by, cache=opts.get("--cache", CACHE_PATH) or None)
+    print_table(_runs, _by)
+    if "--save" in opts:
+        write_table(_runs, opts["--save"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,511 @@
+import contextlib
+import io
+import json
+import math
+import multiprocessing as mp
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Optional
+
+import udp_latency
+import udp_rtt
+from udp_hist import LatencyHistogram
+from udp_io import BatchReceiver, BatchSender
+from udp_log import RECEIVE_SCHEMA, MeasurementLog, write_csv
+from udp_numpy import numpy
+from udp_proto import DATA, HEADER, MAGIC, VERSION
+from udp_record import RecordFile, write_record
+from udp_ring import ORDERED
+from udp_stats import StreamingStats, summarize
+
+
+# Loopback ports used by the engine runs, clear of the tools' defaults
+BENCH_PORT = 20401
+REPEAT = 5
+STAGE_OPS = 100_000
+ANALYSIS_SIZES = (100_000, 1_000_000)
+STARTUP_MODULES = ("udp_latency", "udp_rtt")
+RTT_ENGINES = ("selector", "asyncio", "process", "process_queue")
+TOLERANCE = 0.2
+MSG_SIZE = 1500 - 28
+_TIMESPEC = struct.Struct("@qq")
+
+# Metric names end in their unit: "_ns" per packet / sample and "_us" latency
+# are lower-is-better, "_pps" higher-is-better, anything else is informational
+Results = Dict[str, float]
+
+
+def _per_op(run: Callable[[int], None], n: int) -> float:
+    # Best of REPEAT runs, in ns per operation
+    best = math.inf
+    for _ in range(REPEAT):
+        start = time.perf_counter_ns()
+        run(n)
+        best = min(best, time.perf_counter_ns() - start)
+    return best / n
+
+
+def _loopback_pair():
+    rx = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    rx.bind(("127.0.0.1", 0))
+    tx = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    tx.bind(("127.0.0.1", 0))
+    return tx, rx
+
+
+def _queue_sink(q, n: int, done) -> None:
+    get = q.get
+    for _ in range(n):
+        get()
+    done.put(time.perf_counter_ns())
+
+
+def _queue_handoff(n: int) -> float:
+    # udp_rtt process engine: one tuple per packet from listener to sender
+    q: mp.Queue = mp.Queue()
+    done: mp.Queue = mp.Queue()
+    sink = mp.Process(target=_queue_sink, args=(q, n, done))
+    sink.start()
+    put = q.put
+    start = time.perf_counter_ns()
+    for i in range(n):
+        put((DATA, 0, i, -1000, None))
+    end = done.get()
+    sink.join()
+    return (end - start) / n
+
+
+def _ring_sink(ring, n: int, done) -> None:
+    get_batch = ring.get_batch
+    got = 0
+    while got < n:
+        got += len(get_batch())
+    done.put(time.perf_counter_ns())
+    ring.close()
+
+
+def _ring_handoff(n: int) -> float:
+    # The same hand-off over the shared-memory ring, one 16-byte slot per packet
+    from udp_ring import Ring
+
+    ring = Ring()
+    done: mp.Queue = mp.Queue()
+    sink = mp.Process(target=_ring_sink, args=(ring, n, done))
+    sink.start()
+    put = ring.put
+    start = time.perf_counter_ns()
+    for i in range(n):
+        put(-1000, i)
+    end = done.get()
+    sink.join()
+    ring.close()
+    return (end - start) / n
+
+
+def bench_stages(n: int = STAGE_OPS) -> Results:
+    # Per-packet cost of every step of the send and receive hot loops
+    results: Results = {}
+    buf = bytearray(MSG_SIZE)
+    pack_into = HEADER.pack_into
+    unpack_from = HEADER.unpack_from
+    time_ns = time.time_ns
+    HEADER.pack_into(buf, 0, MAGIC, VERSION, DATA, 0, 1, time_ns())
+    stamp = _TIMESPEC.pack(1, 2)
+
+    def clock(n):
+        for _ in range(n):
+            time_ns()
+
+    def pack(n):
+        for i in range(n):
+            pack_into(buf, 0, MAGIC, VERSION, DATA, 0, i, i)
+
+    def unpack(n):
+        for _ in range(n):
+            unpack_from(buf)
+
+    def timespec(n):
+        for _ in range(n):
+            sec, nsec = _TIMESPEC.unpack_from(stamp)
+            sec * 1_000_000_000 + nsec
+
+    def log_append(n):
+        append = MeasurementLog(RECEIVE_SCHEMA).append
+        for i in range(n):
+            append(i, i, i, i, MSG_SIZE)
+
+    def stats_update(n):
+        update = StreamingStats(window=1 << 16).update
+        for i in range(1, n + 1):
+            update(i, 20_000 + (i & 1023), i * 1000, MSG_SIZE)
+
+    def hist_record(n):
+        record = LatencyHistogram().record
+        for i in range(n):
+            record(20_000 + (i & 1023))
+
+    for name, run in (
+        ("clock", clock),
+        ("header_pack", pack),
+        ("header_unpack", unpack),
+        ("kernel_stamp", timespec),
+        ("log_append", log_append),
+        ("stats_update", stats_update),
+        ("hist_record", hist_record),
+    ):
+        results["stage/%s_ns" % name] = _per_op(run, n)
+    results["stage/queue_handoff_ns"] = _queue_handoff(n)
+    if ORDERED:
+        results["stage/ring_handoff_ns"] = _ring_handoff(n)
+
+    for batch in (1, 32):
+        results["stage/send_batch%d_ns" % batch] = _send_cost(n, batch)
+        results["stage/recv_batch%d_ns" % batch] = _recv_cost(n, batch)
+    return results
+
+
+def _send_cost(n: int, batch: int) -> float:
+    # Nobody reads rx, loopback drops what overflows its buffer
+    tx, rx = _loopback_pair()
+    sender = BatchSender(tx, rx.getsockname(), MSG_SIZE, batch)
+    bursts = max(n // sender.batch, 1)
+
+    def run(bursts):
+        send = sender.send
+        for i in range(bursts):
+            send(i * batch + 1, batch, 0)
+
+    cost = _per_op(run, bursts) / sender.batch
+    sender.close()
+    tx.close()
+    rx.close()
+    return cost
+
+
+def _recv_cost(n: int, batch: int) -> float:
+    # Fill the socket with a block of packets, then time draining it
+    tx, rx = _loopback_pair()
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    sender = BatchSender(tx, rx.getsockname(), MSG_SIZE, 64)
+    receiver = BatchReceiver(rx, MSG_SIZE, batch)
+    elapsed = 0
+    received = 0
+    while received < n:
+        sender.send(received + 1, 64, 0)
+        start = time.perf_counter_ns()
+        pending = 64
+        while pending > 0:
+            pending -= receiver.recv()
+        elapsed += time.perf_counter_ns() - start
+        received += 64
+    receiver.close()
+    sender.close()
+    tx.close()
+    rx.close()
+    return elapsed / received
+
+
+def _synthetic_log(size: int) -> MeasurementLog:
+    log = MeasurementLog(RECEIVE_SCHEMA)
+    log.reserve(size)
+    append = log.append
+    for i in range(1, size + 1):
+        latency = 20_000 + (i * 7919) % 5000
+        append(i, i * 1000, i * 1000 + latency, latency, MSG_SIZE)
+    return log
+
+
+def bench_analysis(sizes=ANALYSIS_SIZES, directory: Optional[str] = None) -> Results:
+    # evaluate() and save() cost per sample of a finished run
+    results: Results = {}
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for size in sizes:
+            log = _synthetic_log(size)
+            tag = "%.0e" % size
+            record = os.path.join(tmp, "bench.udpl")
+            steps = (
+                ("summarize", lambda: summarize(log)),
+                ("write_record", lambda: write_record(log, record)),
+                ("read_record", lambda: _read_record(record)),
+                ("write_csv", lambda: write_csv(log, os.path.join(tmp, "bench.csv"))),
+            )
+            for name, step in steps:
+                start = time.perf_counter_ns()
+                step()
+                elapsed = time.perf_counter_ns() - start
+                results["analysis/%s_%s_ns" % (name, tag.replace("+0", ""))] = (
+                    elapsed / size
+                )
+    return results
+
+
+def _read_record(path: str) -> None:
+    with RecordFile(path) as record:
+        summarize(record)
+
+
+def _latency_server(port: int, batch: int, ready, results) -> None:
+    server = udp_latency.Server(local_ip="127.0.0.1", local_port=port, to_port=port + 1)
+    ready.set()
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.listen(MSG_SIZE, False, False, batch=batch, raw_log=False, timeout=2)
+        results.put(server.evaluate())
+
+
+def _handoff(engine: str):
+    # "process" runs the udp_rtt default shared-memory ring, "process_queue"
+    # the multiprocessing.Queue it replaced; off x86 both use the queue
+    from udp_ring import open_ring
+
+    return None if engine == "process_queue" else open_ring()
+
+
+def _rtt_server(engine: str, port: int, size: int, batch: int, ready) -> None:
+    server = udp_rtt.Server(local_ip="127.0.0.1", local_port=port, to_port=port + 1)
+    ready.set()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if engine.startswith("process"):
+            q: mp.Queue = mp.Queue()
+            ring = _handoff(engine)
+            listener = mp.Process(
+                target=server.listen, args=(MSG_SIZE, False, q, batch, True, 2, 1, ring)
+            )
+            listener.start()
+            server.send(size, False, q, ring)
+            listener.join()
+            if ring is not None:
+                ring.close()
+        elif engine == "asyncio":
+            server.reflect_async(size, False, 2)
+        else:
+            server.reflect(size, MSG_SIZE, False, batch, True, 2)
+
+
+def _run_latency(rate: float, size: int, duration: int, batch: int, port: int) -> dict:
+    ready = mp.Event()
+    results: mp.Queue = mp.Queue()
+    server = mp.Process(target=_latency_server, args=(port, batch, ready, results))
+    server.start()
+    ready.wait()
+    client = udp_latency.Client(local_ip="127.0.0.1", local_port=port + 1, to_port=port)
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.send(
+            rate, size, duration, False, sync=False, dyna=False, batch=batch, report=False
+        )
+    result = results.get()
+    server.join()
+    return result
+
+
+def _run_rtt(
+    engine: str, rate: float, size: int, duration: int, batch: int, port: int
+) -> dict:
+    ready = mp.Event()
+    server = mp.Process(target=_rtt_server, args=(engine, port, size, batch, ready))
+    server.start()
+    ready.wait()
+    client = udp_rtt.Client(local_ip="127.0.0.1", local_port=port + 1, to_port=port)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Echoes are streamed to a record, the process engine's listener
+        # cannot hand its log back otherwise
+        record = os.path.join(tmp, "rtt.udpl")
+        with contextlib.redirect_stdout(io.StringIO()):
+            if engine.startswith("process"):
+                q: mp.Queue = mp.Queue()
+                ring = _handoff(engine)
+                listener = mp.Process(
+                    target=client.listen,
+                    args=(MSG_SIZE, False, record, q, batch),
+                    kwargs={"ring": ring},
+                )
+                listener.start()
+                client.send(rate, size, duration, False, q, batch=batch, ring=ring)
+                listener.join()
+                if ring is not None:
+                    ring.close()
+            else:
+                client.run(rate, size, duration, MSG_SIZE, False, record, batch=batch)
+        with RecordFile(record) as log:
+            result = summarize(log, len(client.send_log))
+    server.join()
+    return result
+
+
+def _delivered(result: dict) -> float:
+    return result["count"] / result["duration"] if result["duration"] else 0.0
+
+
+def bench_engines(duration: int = 1, port: int = BENCH_PORT) -> Results:
+    # Unpaced end-to-end throughput over loopback, then the latency floor:
+    # what the tool itself adds when the network adds nothing
+    results: Results = {}
+    for batch in (1, 32):
+        result = _run_latency(math.inf, MSG_SIZE + 28, duration, batch, port)
+        results["engine/latency_batch%d_pps" % batch] = _delivered(result)
+        results["engine/latency_batch%d_loss" % batch] = result["packet_loss"]
+    for engine in RTT_ENGINES:
+        result = _run_rtt(engine, math.inf, MSG_SIZE + 28, duration, 1, port)
+        results["engine/rtt_%s_pps" % engine] = _delivered(result)
+        results["engine/rtt_%s_loss" % engine] = result["packet_loss"]
+
+    result = _run_latency(1000, 64, duration, 1, port)
+    results["floor/one_way_p50_us"] = result["p50"] * 1e6
+    results["floor/one_way_p99_us"] = result["p99"] * 1e6
+    for engine in RTT_ENGINES:
+        result = _run_rtt(engine, 1000, 64, duration, 1, port)
+        results["floor/rtt_%s_p50_us" % engine] = result["p50"] * 1e6
+        results["floor/rtt_%s_p99_us" % engine] = result["p99"] * 1e6
+    return results
+
+
+def _import_time(module: str) -> float:
+    # Cumulative `python -X importtime` figure of `module` in a fresh
+    # interpreter, in µs
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    for line in output.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return float(fields[1])
+    return math.nan
+
+
+def _spawn_time(module: str) -> float:
+    # Wall time of a fresh interpreter that only imports `module`, in µs
+    start = time.perf_counter_ns()
+    subprocess.run(
+        [sys.executable, "-c", "import " + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True,
+    )
+    return (time.perf_counter_ns() - start) / 1e3
+
+
+def bench_startup(modules=STARTUP_MODULES) -> Results:
+    # What every invocation pays before its first packet, best of REPEAT
+    # fresh processes: the imports alone and the whole interpreter start
+    results: Results = {}
+    for module in modules:
+        results["startup/%s_import_us" % module] = min(
+            _import_time(module) for _ in range(REPEAT)
+        )
+        results["startup/%s_process_us" % module] = min(
+            _spawn_time(module) for _ in range(REPEAT)
+        )
+    return results
+
+
+def environment() -> dict:
+    return {
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "numpy": numpy() is not None,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def compare(results: Results, baseline: Results, tolerance: float = TOLERANCE) -> List[str]:
+    # Names of the metrics that got worse than the baseline by more than
+    # `tolerance` (relative)
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not base or not math.isfinite(value):
+            continue
+        if name.endswith(("_ns", "_us")):
+            change = value / base - 1
+        elif name.endswith("_pps"):
+            change = base / value - 1 if value else math.inf
+        else:
+            continue
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def print_results(results: Results, baseline: Optional[Results] = None) -> None:
+    print("| -------------  Benchmarks  --------------- |")
+    for name in results:
+        line = "%-36s %14.3f" % (name, results[name])
+        if baseline and baseline.get(name):
+            line += "   baseline %14.3f  (%+.1f%%)" % (
+                baseline[name],
+                (results[name] / baseline[name] - 1) * 100,
+            )
+        print(line)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import getopt
+
+    try:
+        _opts, _ = getopt.getopt(
+            sys.argv[1:] if argv is None else argv,
+            "",
+            [
+                "suite=",
+                "ops=",
+                "sizes=",
+                "time=",
+                "port=",
+                "save=",
+                "compare=",
+                "tolerance=",
+            ],
+        )
+        opts = dict(_opts)
+        opts.setdefault("--suite", "stages,analysis,engines,startup")
+        opts.setdefault("--ops", str(STAGE_OPS))
+        opts.setdefault("--sizes", ",".join(str(size) for size in ANALYSIS_SIZES))
+        opts.setdefault("--time", "1")
+        opts.setdefault("--port", str(BENCH_PORT))
+        opts.setdefault("--tolerance", str(TOLERANCE))
+    except getopt.GetoptError:
+        print(
+            "Usage --> udp_bench.py --suite <stages,analysis,engines,startup> --ops <operations per stage> --sizes <samples, comma separated> --time <seconds per engine run> --port <first loopback port> --save <results path> --compare <baseline path> --tolerance <relative change>"
+        )
+        sys.exit(2)
+
+    _suites = opts["--suite"].split(",")
+    _results: Results = {}
+    if "stages" in _suites:
+        _results.update(bench_stages(int(opts["--ops"])))
+    if "analysis" in _suites:
+        _results.update(bench_analysis([int(x) for x in opts["--sizes"].split(",") if x]))
+    if "engines" in _suites:
+        _results.update(bench_engines(int(opts["--time"]), int(opts["--port"])))
+    if "startup" in _suites:
+        _results.update(bench_startup())
+
+    _baseline = None
+    if "--compare" in opts:
+        with open(opts["--compare"]) as f:
+            _baseline = json.load(f)["results"]
+    print_results(_results, _baseline)
+    if "--save" in opts:
+        with open(opts["--save"], "w") as f:
+            json.dump({"environment": environment(), "results": _results}, f, indent=2)
+            f.write("\n")
+    if _baseline is not None:
+        _regressions = compare(_results, _baseline, float(opts["--tolerance"]))
+        for _name in _regressions:
+            print("Regression: %s" % _name)
+        sys.exit(1 if _regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import math
+import struct
+import sys
+import zlib
+
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+HOUR = 3600 * 1_000_000_000
+
+_HEADER = struct.Struct("<4sBBxxQQqqdQ")
+_MAGIC = b"HDRL"
+_VERSION = 1
+
+
+class LatencyHistogram:
+    # Fixed-memory log-linear histogram in the spirit of HdrHistogram. Values
+    # are nanoseconds; every power of two is split into enough linear
+    # sub-buckets to keep `significant_digits` decimal digits of precision.
+    def __init__(self, highest: int = HOUR, significant_digits: int = 3) -> None:
+        if not 1 <= significant_digits <= 5:
+            raise Exception("Warning: significant digits should be within [1, 5]")
+        self.highest = highest
+        self.significant_digits = significant_digits
+        self.sub_bits = math.ceil(math.log2(2 * 10**significant_digits))
+        self.sub_count = 1 << self.sub_bits
+        self.half_count = self.sub_count >> 1
+        self.max_shift = max(highest.bit_length() - self.sub_bits, 0)
+        self.size = self.sub_count + self.max_shift * self.half_count
+        self.counts = array("Q", bytes(8 * self.size))
+        self.count = 0
+        self.negative = 0
+        self.min = 0
+        self.max = 0
+        self.total = 0.0
+
+    def index(self, value: int) -> int:
+        if value < self.sub_count:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        if shift > self.max_shift:
+            return self.size - 1
+        return self.sub_count + (shift - 1) * self.half_count + (value >> shift) - self.half_count
+
+    def bucket_range(self, index: int) -> Tuple[int, int]:
+        if index < self.sub_count:
+            return index, index
+        shift = (index - self.sub_count) // self.half_count + 1
+        low = (self.half_count + (index - self.sub_count) % self.half_count) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, value: int) -> None:
+        if value < 0:
+            self.negative += 1
+            value = 0
+        self.counts[self.index(value)] += 1
+        if not self.count or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+
+    def reset(self) -> None:
+        self.counts = array("Q", bytes(8 * self.size))
+        self.count = 0
+        self.negative = 0
+        self.min = 0
+        self.max = 0
+        self.total = 0.0
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def stddev(self) -> float:
+        if not self.count:
+            return 0.0
+        mean = self.mean
+        var = 0.0
+        for i, n in enumerate(self.counts):
+            if n:
+                low, high = self.bucket_range(i)
+                var += n * ((low + high) / 2 - mean) ** 2
+        return math.sqrt(var / self.count)
+
+    def percentile(self, q: float) -> int:
+        if not self.count:
+            return 0
+        target = max(math.ceil(self.count * q / 100), 1)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(self.bucket_range(i)[1], self.max)
+        return self.max
+
+    def percentiles(self, qs: Iterable[float]) -> List[int]:
+        qs = list(qs)
+        targets = [max(math.ceil(self.count * q / 100), 1) for q in qs]
+        result = [self.max] * len(qs)
+        if not self.count:
+            return [0] * len(qs)
+        order = sorted(range(len(qs)), key=lambda k: targets[k])
+        pending = 0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if not n:
+                continue
+            seen += n
+            while pending < len(order) and seen >= targets[order[pending]]:
+                result[order[pending]] = min(self.bucket_range(i)[1], self.max)
+                pending += 1
+            if pending == len(order):
+                break
+        return result
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        if (other.significant_digits, other.highest) != (
+            self.significant_digits,
+            self.highest,
+        ):
+            raise Exception("Warning: only histograms with the same layout can be merged")
+        counts = self.counts
+        for i, n in enumerate(other.counts):
+            if n:
+                counts[i] += n
+        if other.count:
+            self.min = other.min if not self.count else min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.count += other.count
+        self.negative += other.negative
+        self.total += other.total
+
+    def to_bytes(self) -> bytes:
+        counts = array("Q", self.counts)
+        if sys.byteorder == "big":
+            counts.byteswap()
+        header = _HEADER.pack(
+            _MAGIC,
+            _VERSION,
+            self.significant_digits,
+            self.highest,
+            self.count,
+            self.min,
+            self.max,
+            self.total,
+            self.negative,
+        )
+        return header + zlib.compress(counts.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LatencyHistogram":
+        magic, version, digits, highest, count, low, high, total, negative = (
+            _HEADER.unpack_from(data)
+        )
+        if magic != _MAGIC or version != _VERSION:
+            raise Exception("Warning: not a latency histogram file")
+        hist = cls(highest, digits)
+        counts = array("Q", zlib.decompress(data[_HEADER.size :]))
+        if sys.byteorder == "big":
+            counts.byteswap()
+        hist.counts = counts
+        hist.count = count
+        hist.min = low
+        hist.max = high
+        hist.total = total
+        hist.negative = negative
+        return hist
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str) -> "LatencyHistogram":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    paths = sys.argv[1:] if argv is None else argv
+    if not paths:
+        print("Usage --> udp_hist.py <histogram file> [<histogram file> ...]")
+        sys.exit(2)
+
+    merged = LatencyHistogram.load(paths[0])
+    for path in paths[1:]:
+        merged.merge(LatencyHistogram.load(path))
+
+    print("| -------------  Merged %d histograms  --------------- |" % len(paths))
+    print("Total %d samples (%d negative)" % (merged.count, merged.negative))
+    print("Average latency: %f second" % (merged.mean * 1e-9))
+    print("Minimum latency: %f second" % (merged.min * 1e-9))
+    print("Maximum latency: %f second" % (merged.max * 1e-9))
+    print("Std latency: %f second" % (merged.stddev() * 1e-9))
+    for q, value in zip(
+        (50, 90, 99, 99.9, 99.99), merged.percentiles((50, 90, 99, 99.9, 99.99))
+    ):
+        print("p%g: %f second" % (q, value * 1e-9))
+
+
+if __name__ == "__main__":
+    main()
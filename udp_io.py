@@ -0,0 +1,489 @@
+import ctypes
+import errno
+import os
+import socket
+import struct
+import sys
+import time
+
+from typing import List, Optional, Tuple
+
+from udp_proto import DATA, HEADER, MAGIC, VERSION
+
+# IPv4 + UDP header bytes, -n packet sizes are frame sizes on the wire
+WIRE_OVERHEAD = 20 + 8
+
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+MSG_WAITFORONE = 0x10000
+
+SO_TIMESTAMPING = getattr(socket, "SO_TIMESTAMPING", 37)
+SCM_TIMESTAMPING = SO_TIMESTAMPING
+SOF_TIMESTAMPING_TX_HARDWARE = 1 << 0
+SOF_TIMESTAMPING_TX_SOFTWARE = 1 << 1
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_RAW_HARDWARE = 1 << 6
+MSG_ERRQUEUE = getattr(socket, "MSG_ERRQUEUE", 0x2000)
+# Looped-back packet (link + IP + UDP headers, then ours) and its control data
+_ERRQUEUE_DATA = 64 + HEADER.size
+_ERRQUEUE_CONTROL = 512
+
+_TIMESPEC = struct.Struct("@qq")
+_TIMEVAL = struct.Struct("@ll")
+# scm_timestamping: software, (deprecated), raw hardware timespec
+_SCM_TIMESTAMPING = struct.Struct("@qq16xqq")
+_CMSG_HDR = struct.Struct("@Nii")
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),
+        ("sin_addr", ctypes.c_uint8 * 4),
+        ("sin_zero", ctypes.c_uint8 * 8),
+    ]
+
+
+def open_libc() -> Optional[ctypes.CDLL]:
+    # The glibc soname first: find_library() runs ldconfig in a subprocess,
+    # which costs more than everything else at startup
+    try:
+        return ctypes.CDLL("libc.so.6", use_errno=True)
+    except OSError:
+        pass
+    from ctypes.util import find_library
+
+    name = find_library("c")
+    try:
+        return ctypes.CDLL(name, use_errno=True) if name else None
+    except OSError:
+        return None
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    libc = open_libc()
+    if libc is None or not hasattr(libc, "sendmmsg"):
+        return None
+    libc.sendmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.c_void_p,
+        ctypes.c_uint,
+        ctypes.c_int,
+    ]
+    libc.sendmmsg.restype = ctypes.c_int
+    if hasattr(libc, "recvmmsg"):
+        libc.recvmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.c_uint,
+            ctypes.c_int,
+            ctypes.c_void_p,
+        ]
+        libc.recvmmsg.restype = ctypes.c_int
+    return libc
+
+
+_libc = _load_libc()
+HAVE_SENDMMSG = _libc is not None
+HAVE_RECVMMSG = HAVE_SENDMMSG and hasattr(_libc, "recvmmsg")
+
+
+def _sockaddr(address: Tuple[str, int]) -> _SockAddrIn:
+    addr = _SockAddrIn()
+    addr.sin_family = socket.AF_INET
+    addr.sin_port = socket.htons(address[1])
+    addr.sin_addr[:] = socket.inet_aton(socket.gethostbyname(address[0]))
+    return addr
+
+
+class BatchSender:
+    def __init__(
+        self,
+        sock: socket.socket,
+        address: Tuple[str, int],
+        msg_size: int,
+        batch: int = 1,
+        use_mmsg: Optional[bool] = None,
+        flow: int = 0,
+        kind: int = DATA,
+    ) -> None:
+        if msg_size < HEADER.size:
+            raise Exception("Warning: message is smaller than the packet header")
+
+        self.sock = sock
+        self.address = (socket.gethostbyname(address[0]), address[1])
+        self.msg_size = msg_size
+        self.flow = flow
+        self.kind = kind
+        self.batch = max(1, batch)
+        self.use_mmsg = HAVE_SENDMMSG if use_mmsg is None else (use_mmsg and HAVE_SENDMMSG)
+
+        # One preallocated buffer per slot, only the header is rewritten per packet
+        self.buffers: List[bytearray] = [bytearray(msg_size) for _ in range(self.batch)]
+        self.views = [memoryview(b) for b in self.buffers]
+        # What flush() sends from each slot without sendmmsg, see set_size()
+        self._out = list(self.views)
+        # Destination per slot, `address` unless changed by reply_to()
+        self._addresses = [self.address] * self.batch
+
+        if self.use_mmsg:
+            self._names = (_SockAddrIn * self.batch)()
+            self._iov = (_IOVec * self.batch)()
+            self._msgs = (_MMsgHdr * self.batch)()
+            self._cbufs = []
+            for i, buf in enumerate(self.buffers):
+                cbuf = (ctypes.c_char * msg_size).from_buffer(buf)
+                self._cbufs.append(cbuf)
+                self._iov[i].iov_base = ctypes.addressof(cbuf)
+                self._iov[i].iov_len = msg_size
+                self._names[i] = _sockaddr(self.address)
+                hdr = self._msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(self._names[i])
+                hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+                hdr.msg_iov = ctypes.pointer(self._iov[i])
+                hdr.msg_iovlen = 1
+
+    def send(self, first_index: int, count: int, stamp: int) -> int:
+        pack_into = HEADER.pack_into
+        buffers = self.buffers
+        flow = self.flow
+        kind = self.kind
+        for i in range(count):
+            pack_into(buffers[i], 0, MAGIC, VERSION, kind, flow, first_index + i, stamp)
+        return self.flush(count)
+
+    def send_stamped(
+        self,
+        kinds: List[int],
+        flows: List[int],
+        indices: List[int],
+        stamps: List[int],
+        count: int,
+    ) -> int:
+        pack_into = HEADER.pack_into
+        buffers = self.buffers
+        for i in range(count):
+            pack_into(
+                buffers[i], 0, MAGIC, VERSION, kinds[i], flows[i], indices[i], stamps[i]
+            )
+        return self.flush(count)
+
+    def set_size(self, i: int, size: int) -> None:
+        # Send only the first `size` bytes of slot i from now on
+        if self.use_mmsg:
+            self._iov[i].iov_len = size
+        else:
+            self._out[i] = self.views[i][:size]
+
+    def reply_to(self, i: int, receiver: "BatchReceiver", j: int) -> None:
+        # Send slot i to the source of the receiver's slot j
+        if self.use_mmsg and receiver.use_mmsg:
+            ctypes.memmove(
+                ctypes.addressof(self._names[i]),
+                ctypes.addressof(receiver._names[j]),
+                ctypes.sizeof(_SockAddrIn),
+            )
+        elif self.use_mmsg:
+            self._names[i] = _sockaddr(receiver.address(j))
+        else:
+            self._addresses[i] = receiver.address(j)
+
+    def flush(self, count: int) -> int:
+        if not self.use_mmsg:
+            sendto = self.sock.sendto
+            out = self._out
+            addresses = self._addresses
+            return sum(sendto(out[i], addresses[i]) for i in range(count))
+
+        fd = self.sock.fileno()
+        base = ctypes.addressof(self._msgs)
+        sent = 0
+        while sent < count:
+            n = _libc.sendmmsg(fd, base + sent * ctypes.sizeof(_MMsgHdr), count - sent, 0)
+            if n < 0:
+                _raise_errno()
+            sent += n
+        # set_size() may have changed the lengths, so count what was really sent
+        msgs = self._msgs
+        return sum(msgs[i].msg_len for i in range(count))
+
+    def close(self) -> None:
+        if self.use_mmsg:
+            self._cbufs = []
+        self.views = []
+        self._out = []
+
+
+def _raise_errno() -> None:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+def _kernel_stamp(control, length: int) -> int:
+    offset = 0
+    data_offset = socket.CMSG_LEN(0)
+    while offset + data_offset <= length:
+        cmsg_len, level, kind = _CMSG_HDR.unpack_from(control, offset)
+        if cmsg_len < data_offset:
+            break
+        if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPNS:
+            sec, nsec = _TIMESPEC.unpack_from(control, offset + data_offset)
+            return sec * 1_000_000_000 + nsec
+        offset += socket.CMSG_SPACE(cmsg_len - data_offset)
+    return 0
+
+
+class BatchReceiver:
+    def __init__(
+        self,
+        sock: socket.socket,
+        buffer_size: int,
+        batch: int = 1,
+        kernel_ts: bool = True,
+        use_mmsg: Optional[bool] = None,
+        timeout: float = 0,
+    ) -> None:
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.batch = max(1, batch)
+        self.use_mmsg = HAVE_RECVMMSG if use_mmsg is None else (use_mmsg and HAVE_RECVMMSG)
+
+        self.kernel_ts = kernel_ts
+        if kernel_ts:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            except OSError:
+                self.kernel_ts = False
+        self._control_size = socket.CMSG_SPACE(_TIMESPEC.size) * 2 if self.kernel_ts else 0
+        # SO_RCVTIMEO keeps the socket blocking (recvmmsg needs that), recv()
+        # returns 0 once nothing arrived for `timeout` seconds
+        self.timeout = timeout
+        if timeout > 0:
+            sec = int(timeout)
+            sock.setsockopt(
+                socket.SOL_SOCKET,
+                socket.SO_RCVTIMEO,
+                _TIMEVAL.pack(sec, int((timeout - sec) * 1e6)),
+            )
+        self._address: Tuple[str, int] = ("", 0)
+
+        # Ring of reusable receive slots, overwritten by every call to recv()
+        self.buffers: List[bytearray] = [bytearray(buffer_size) for _ in range(self.batch)]
+        self.views = [memoryview(b) for b in self.buffers]
+        self.sizes = [0] * self.batch
+        self.stamps = [0] * self.batch
+
+        if self.use_mmsg:
+            self._iov = (_IOVec * self.batch)()
+            self._msgs = (_MMsgHdr * self.batch)()
+            self._names = (_SockAddrIn * self.batch)()
+            self._controls = [bytearray(max(self._control_size, 1)) for _ in range(self.batch)]
+            self._cbufs = []
+            for i in range(self.batch):
+                cbuf = (ctypes.c_char * buffer_size).from_buffer(self.buffers[i])
+                ctrl = (ctypes.c_char * len(self._controls[i])).from_buffer(self._controls[i])
+                self._cbufs.append((cbuf, ctrl))
+                self._iov[i].iov_base = ctypes.addressof(cbuf)
+                self._iov[i].iov_len = buffer_size
+                hdr = self._msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(self._names[i])
+                hdr.msg_iov = ctypes.pointer(self._iov[i])
+                hdr.msg_iovlen = 1
+                hdr.msg_control = ctypes.addressof(ctrl) if self.kernel_ts else None
+
+    def recv(self) -> int:
+        if not self.use_mmsg:
+            return self._recv_one()
+
+        msgs = self._msgs
+        control_size = self._control_size
+        name_size = ctypes.sizeof(_SockAddrIn)
+        for i in range(self.batch):
+            msgs[i].msg_hdr.msg_controllen = control_size
+            msgs[i].msg_hdr.msg_namelen = name_size
+        n = _libc.recvmmsg(
+            self.sock.fileno(), ctypes.addressof(msgs), self.batch, MSG_WAITFORONE, None
+        )
+        if n < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK) and self.timeout:
+                return 0
+            _raise_errno()
+
+        sizes = self.sizes
+        stamps = self.stamps
+        if self.kernel_ts:
+            controls = self._controls
+            now = 0
+            for i in range(n):
+                sizes[i] = msgs[i].msg_len
+                stamps[i] = _kernel_stamp(controls[i], msgs[i].msg_hdr.msg_controllen)
+                if not stamps[i]:
+                    stamps[i] = now = now or time.time_ns()
+        else:
+            now = time.time_ns()
+            for i in range(n):
+                sizes[i] = msgs[i].msg_len
+                stamps[i] = now
+        return n
+
+    def _recv_one(self) -> int:
+        try:
+            return self._recv_one_blocking()
+        except BlockingIOError:
+            if not self.timeout:
+                raise
+            return 0
+
+    def _recv_one_blocking(self) -> int:
+        if self.kernel_ts:
+            size, ancdata, _, self._address = self.sock.recvmsg_into(
+                [self.views[0]], self._control_size
+            )
+            stamp = 0
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPNS:
+                    sec, nsec = _TIMESPEC.unpack_from(data)
+                    stamp = sec * 1_000_000_000 + nsec
+            self.stamps[0] = stamp or time.time_ns()
+        else:
+            size, self._address = self.sock.recvfrom_into(self.views[0])
+            self.stamps[0] = time.time_ns()
+        self.sizes[0] = size
+        return 1
+
+    def address(self, i: int) -> Tuple[str, int]:
+        # Source address of slot i from the last recv()
+        if not self.use_mmsg:
+            return self._address
+        name = self._names[i]
+        return socket.inet_ntoa(bytes(name.sin_addr)), socket.ntohs(name.sin_port)
+
+    def close(self) -> None:
+        if self.use_mmsg:
+            self._cbufs = []
+        self.views = []
+
+
+class TxTimestamps:
+    # Kernel transmit timestamps of the DATA packets sent on a socket
+    # (SO_TIMESTAMPING). The kernel queues one per packet on the socket's
+    # error queue; drain() collects what is there without blocking. With
+    # `hardware` the NIC's stamp is taken when its driver provides one (TX
+    # stamping switched on for the interface, e.g. by hwstamp_ctl), otherwise
+    # the software stamp taken when the packet reached the device.
+    def __init__(self, sock: socket.socket, hardware: bool = False, batch: int = 64) -> None:
+        self.sock = sock
+        self.batch = batch
+        self.hardware = 0
+        self.software = 0
+        flags = SOF_TIMESTAMPING_TX_SOFTWARE | SOF_TIMESTAMPING_SOFTWARE
+        if hardware:
+            flags |= SOF_TIMESTAMPING_TX_HARDWARE | SOF_TIMESTAMPING_RAW_HARDWARE
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING, flags)
+            self.enabled = sys.platform.startswith("linux")
+        except OSError:
+            self.enabled = False
+
+    def drain(self) -> List[Tuple[int, int]]:
+        # (sequence number, kernel send time) of the stamps queued so far
+        stamps: List[Tuple[int, int]] = []
+        if not self.enabled:
+            return stamps
+        recvmsg = self.sock.recvmsg
+        flags = MSG_ERRQUEUE | socket.MSG_DONTWAIT
+        for _ in range(self.batch):
+            try:
+                data, ancdata, _, _ = recvmsg(_ERRQUEUE_DATA, _ERRQUEUE_CONTROL, flags)
+            except (BlockingIOError, InterruptedError):
+                break
+            index = _sent_sequence(data)
+            for level, kind, cdata in ancdata:
+                if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPING and index:
+                    sec, nsec, hw_sec, hw_nsec = _SCM_TIMESTAMPING.unpack_from(cdata)
+                    if hw_sec or hw_nsec:
+                        self.hardware += 1
+                        sec, nsec = hw_sec, hw_nsec
+                    else:
+                        self.software += 1
+                    stamps.append((index, sec * 1_000_000_000 + nsec))
+        return stamps
+
+    def close(self) -> None:
+        if self.enabled:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING, 0)
+            self.enabled = False
+
+
+def _sent_sequence(data: bytes) -> int:
+    # The error queue hands the packet back as it left: IPv4 header, with or
+    # without the link-layer header in front, then UDP and our header
+    for offset in (0, 14):
+        if len(data) > offset and data[offset] >> 4 == 4:
+            start = offset + (data[offset] & 0x0F) * 4 + 8
+            if len(data) >= start + HEADER.size:
+                magic, _, kind, _, index, _ = HEADER.unpack_from(data, start)
+                if magic == MAGIC and kind == DATA:
+                    return index
+    return 0
+
+
+class RateMeter:
+    def __init__(self, target_pps: float, packet_size: float) -> None:
+        self.target_pps = target_pps
+        self.packet_size = packet_size
+        self.packets = 0
+        self.start_time = time.time_ns()
+        self.stop_time = self.start_time
+
+    def add(self, packets: int) -> None:
+        self.packets += packets
+
+    def stop(self) -> None:
+        self.stop_time = time.time_ns()
+
+    def summary(self):
+        elapsed = max(self.stop_time - self.start_time, 1) * 1e-9
+        pps = self.packets / elapsed
+        return {
+            "packets": self.packets,
+            "elapsed": elapsed,
+            "pps": pps,
+            "mbits": pps * self.packet_size * 8 / 1e6,
+            "target_pps": self.target_pps,
+            "target_mbits": self.target_pps * self.packet_size * 8 / 1e6,
+        }
+
+    def report(self) -> None:
+        s = self.summary()
+        print("| -------------  Sender  --------------- |")
+        print("Total %d packets are sent in %f seconds" % (s["packets"], s["elapsed"]))
+        if s["target_pps"] == float("inf"):
+            print("Achieved rate: %f pps, %f Mbits (target: maximum)" % (s["pps"], s["mbits"]))
+        else:
+            print(
+                "Achieved rate: %f pps, %f Mbits (target: %f pps, %f Mbits)"
+                % (s["pps"], s["mbits"], s["target_pps"], s["target_mbits"])
+            )
@@ -1,13 +1,65 @@
 import socket
 import time
 import math
-import csv
+import queue
 import sys
-import getopt
 
-from typing import List, Tuple, Union
-
-HEADER_SIZE = 32 + 4 + 8
+from collections import deque
+from contextlib import nullcontext
+
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+from udp_hist import LatencyHistogram
+from udp_io import WIRE_OVERHEAD, BatchReceiver, BatchSender, RateMeter, TxTimestamps
+from udp_log import RECEIVE_SCHEMA, SEND_SCHEMA, TX_SCHEMA, MeasurementLog, write_csv
+from udp_pacing import Pacer
+from udp_proto import (
+    DATA,
+    END,
+    END_ACK,
+    FOLLOW_UP,
+    HEADER,
+    MAGIC,
+    START,
+    START_ACK,
+    SYNC_HELLO,
+    TX_FOLLOW_UP,
+    end_follow_ups,
+    pack,
+    pack_end,
+    pack_start,
+    start_flags,
+    unpack,
+    unpack_end,
+    unpack_start,
+)
+from udp_record import RecordWriter, is_csv, write_record
+from udp_report import IntervalReporter
+from udp_stats import (
+    StreamingStats,
+    histogram_percentiles,
+    report,
+    report_schedule,
+    report_tx,
+    summarize,
+    summarize_schedule,
+    summarize_tx,
+)
+from udp_sync import ClockSync, SyncResponder
+
+if TYPE_CHECKING:
+    from udp_traffic import Schedule
+
+HEADER_SIZE = WIRE_OVERHEAD + HEADER.size
+SEQUENCE_WINDOW = 1 << 16
+# START / END are repeated every CONTROL_WAIT seconds until acknowledged
+CONTROL_RETRIES = 10
+CONTROL_WAIT = 0.1
+# Room for follow-ups in a DATA payload and in END
+FOLLOW_UP_SIZE = HEADER.size + FOLLOW_UP.size
+END_FOLLOW_UPS = 100
+# The last TX timestamps of a run arrive shortly after its last packets
+TX_SETTLE = 0.005
 
 
 class Client:
@@ -17,13 +69,21 @@ class Client:
         local_port: int = 20002,
         remote_ip: str = "127.0.0.1",
         to_port: int = 20001,
+        flow: int = 0,
     ) -> None:
         self.local_ip = local_ip
         self.local_port = local_port
         self.remote_ip = remote_ip
         self.to_port = to_port
-        self.log: List[List[Union[int, float]]] = []
+        self.flow = flow
+        self.log = MeasurementLog(SEND_SCHEMA)
+        self.tx_log = MeasurementLog(TX_SCHEMA)
         self.packet_index = 1
+        # Rows allocated in the send log before the first packet (--realtime)
+        self.prefault = 0
+        self._responder: Optional[SyncResponder] = None
+        self._tx: Optional[TxTimestamps] = None
+        self._tx_pending: deque = deque()
 
         self._udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         self._udp_socket.bind((self.local_ip, self.local_port))
@@ -31,57 +91,123 @@ class Client:
     def synchronize(self, verbose: bool) -> None:
         if verbose:
             print("|  ---------- Sychonizing Server & Client by PTP ------------  |")
-        for _ in range(10):
-            t1 = time.time_ns()
-            time_bytes = t1.to_bytes(8, "big")
-            index_bytes = (0).to_bytes(4, "big")
-            msg = b"".join([b"\x00"] * 128)
-            msg = index_bytes + time_bytes + msg
-            _send_nums = self._udp_socket.sendto(msg, (self.remote_ip, self.to_port))
-
-            msg, _ = self._udp_socket.recvfrom(128 + HEADER_SIZE)
-            t2 = int.from_bytes(msg[4:12], "big")
-            t2_p = time.time_ns()
-            time.sleep(0.05)
-
-            index_bytes = (0).to_bytes(4, "big")
-            time_bytes = t2_p.to_bytes(8, "big")
-            msg = b""
-            msg = index_bytes + time_bytes + msg
-            _send_nums = self._udp_socket.sendto(msg, (self.remote_ip, self.to_port))
-            time.sleep(1)
-
-    def send(
+        self._responder = SyncResponder(self._udp_socket)
+        self._responder.start()
+        # A multi-client server only synchronizes clients it has heard from
+        hello = pack(SYNC_HELLO, self.flow)
+
+        def announce() -> None:
+            self._udp_socket.sendto(hello, (self.remote_ip, self.to_port))
+
+        self._responder.wait_ready(announce=announce)
+
+    def _wait_for(self, kind: int, timeout: float) -> bool:
+        # After synchronize() the responder thread owns the socket and hands
+        # control replies over, otherwise read them here
+        deadline = time.monotonic() + timeout
+        if self._responder is not None:
+            while True:
+                try:
+                    got, flow, _ = self._responder.messages.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    return False
+                if got == kind and flow == self.flow:
+                    return True
+        try:
+            while True:
+                self._udp_socket.settimeout(max(deadline - time.monotonic(), 1e-3))
+                got, flow, _, _ = unpack(self._udp_socket.recv(64))
+                if got == kind and flow == self.flow:
+                    return True
+        except socket.timeout:
+            return False
+        finally:
+            self._udp_socket.settimeout(None)
+
+    def _control(self, packet: bytes, ack: int) -> bool:
+        for _ in range(CONTROL_RETRIES):
+            self._udp_socket.sendto(packet, (self.remote_ip, self.to_port))
+            if self._wait_for(ack, CONTROL_WAIT):
+                return True
+        return False
+
+    def start(
+        self, frequency: float, packet_size: int, running_time: float, flags: int = 0
+    ) -> bool:
+        # Announce the planned test so the server can size its log and
+        # count losses exactly
+        packet = pack_start(
+            self.flow, frequency, packet_size, running_time, time.time_ns(), flags
+        )
+        return self._control(packet, START_ACK)
+
+    def _open_tx(self, hardware: bool, smallest: int, batch: int) -> Optional[TxTimestamps]:
+        # Falls back to the user-space send time written into every packet
+        if smallest < FOLLOW_UP_SIZE + WIRE_OVERHEAD:
+            print(
+                "Packets smaller than %d bytes cannot carry TX timestamps, user-space send times are used"
+                % (FOLLOW_UP_SIZE + WIRE_OVERHEAD)
+            )
+            return None
+        tx = TxTimestamps(self._udp_socket, hardware, max(64, 2 * batch))
+        if not tx.enabled:
+            print("Kernel TX timestamps are not available, user-space send times are used")
+            return None
+        return tx
+
+    def _follow_up(self, tx: TxTimestamps, sender: BatchSender, count: int) -> None:
+        # TX timestamps of the packets sent so far ride in the payload of the
+        # next ones, one per packet
+        pending = self._tx_pending
+        append = self.tx_log.append
+        for index, stamp in tx.drain():
+            append(index, stamp)
+            pending.append((index, stamp))
+        pack_into = FOLLOW_UP.pack_into
+        buffers = sender.buffers
+        for j in range(count):
+            index, stamp = pending.popleft() if pending else (0, 0)
+            pack_into(buffers[j], HEADER.size, index, stamp)
+
+    def _send_periodic(
         self,
+        sender: BatchSender,
+        pacer: Optional[Pacer],
+        meter: RateMeter,
         frequency: float,
-        packet_size: int,
-        running_time: int,
+        running_time: float,
         verbose: bool,
-        sync: bool,
         dyna: bool,
-    ):
-        if sync:
-            self.synchronize(verbose)
-
-        if packet_size < HEADER_SIZE or packet_size > 1500:
-            raise Exception("warning: packet size should be no larger than 1500 bytes.")
-
-        _payload_size = packet_size - HEADER_SIZE
-        _fill = b"".join([b"\x00"] * (_payload_size))
-
+        pacing: str,
+    ) -> None:
+        append = self.log.append
         start_time = time.time_ns()
-        total_packets = math.ceil(frequency * running_time)
+        total_packets = (
+            math.ceil(frequency * running_time) if math.isfinite(frequency) else math.inf
+        )
         running_time = running_time * int(1e9)
-        period = 1 / frequency
+        period = sender.batch / frequency
+        burst = 0
+        error = 0
+        tx = self._tx
 
+        if pacer:
+            pacer.begin()
         while True:
-            index_bytes = self.packet_index.to_bytes(4, "big")
+            count = int(min(sender.batch, total_packets - self.packet_index + 1))
+            if tx:
+                self._follow_up(tx, sender, count)
+            if pacer:
+                error = pacer.wait(burst) if pacing == "deadline" else pacer.error(burst)
+                burst += 1
             current_time = time.time_ns()
-            time_bytes = current_time.to_bytes(8, "big")
-            send_nums = self._udp_socket.sendto(
-                index_bytes + time_bytes + _fill, (self.remote_ip, self.to_port)
-            )
-            self.log.append([self.packet_index, current_time, send_nums])
+            send_nums = sender.send(self.packet_index, count, current_time) // count
+            for i in range(self.packet_index, self.packet_index + count):
+                append(i, current_time, send_nums, error)
+            meter.add(count)
+            self.packet_index += count - 1
 
             if (
                 current_time - start_time
@@ -95,11 +221,15 @@ class Client:
                 )
             self.packet_index += 1
 
+            if pacing == "deadline":
+                continue
+
             if dyna:
                 prac_period = (
                     (running_time - (current_time - start_time))
                     / (total_packets - len(self.log))
                     * (len(self.log) / (frequency * (current_time - start_time + 1) * 1e-9))
+                    * sender.batch
                     * 1e-9
                 )
                 prac_period = period if prac_period > period else prac_period
@@ -109,8 +239,151 @@ class Client:
             time.sleep(prac_period)
             # time.sleep(period)
 
-        self._udp_socket.sendto((0).to_bytes(4, "big"), (self.remote_ip, self.to_port))
-        self._udp_socket.close()
+    def _send_schedule(
+        self,
+        sender: BatchSender,
+        schedule: "Schedule",
+        meter: RateMeter,
+        verbose: bool,
+    ) -> None:
+        # Packets already due when the batch goes out share the syscall, so
+        # bursts in the schedule become sendmmsg batches
+        append = self.log.append
+        offsets = schedule.offsets
+        sizes = schedule.sizes
+        set_size = None if schedule.fixed_size else sender.set_size
+        payload = schedule.max_size - WIRE_OVERHEAD
+        total = len(offsets)
+        batch = sender.batch
+        index = self.packet_index
+        tx = self._tx
+        k = 0
+
+        pacer = Pacer(0)
+        pacer.begin()
+        while k < total:
+            due = offsets[k] + pacer.wait_at(offsets[k])
+            count = 1
+            while count < batch and k + count < total and offsets[k + count] <= due:
+                count += 1
+            if set_size:
+                for j in range(count):
+                    set_size(j, sizes[k + j] - WIRE_OVERHEAD)
+            if tx:
+                self._follow_up(tx, sender, count)
+            current_time = time.time_ns()
+            sender.send(index, count, current_time)
+            for j in range(count):
+                if set_size:
+                    payload = sizes[k + j] - WIRE_OVERHEAD
+                append(index + j, current_time, payload, due - offsets[k + j])
+            meter.add(count)
+            if verbose:
+                print(
+                    "|  Client: %d  |  Packet: %d  |  Time: %d  |  Data size: %d  |"
+                    % (self.local_port, index, current_time, payload)
+                )
+            index += count
+            k += count
+        self.packet_index = index - 1
+
+    def send(
+        self,
+        frequency: float,
+        packet_size: int,
+        running_time: float,
+        verbose: bool,
+        sync: bool,
+        dyna: bool,
+        batch: int = 1,
+        pacing: str = "deadline",
+        report: bool = True,
+        keep_open: bool = False,
+        schedule: Optional["Schedule"] = None,
+        tx_timestamps: str = "off",
+    ):
+        # With a precomputed udp_traffic.Schedule the departure times and
+        # frame sizes come from it instead of frequency / packet_size.
+        # tx_timestamps "software" / "hardware" sends the kernel TX time of
+        # every packet to the server as a follow-up.
+        if sync:
+            self.synchronize(verbose)
+
+        if schedule is not None:
+            frequency = schedule.rate
+            packet_size = schedule.max_size
+            running_time = schedule.duration
+        if packet_size < HEADER_SIZE or packet_size > 1500:
+            raise Exception("warning: packet size should be no larger than 1500 bytes.")
+        self.log.reserve(self.prefault)
+
+        sender = BatchSender(
+            self._udp_socket,
+            (self.remote_ip, self.to_port),
+            packet_size - WIRE_OVERHEAD,
+            batch,
+            flow=self.flow,
+        )
+        if schedule is None and math.isfinite(frequency):
+            pacer: Optional[Pacer] = Pacer(sender.batch / frequency * 1e9)
+        else:
+            pacer = None
+        flags = 0
+        if tx_timestamps != "off":
+            smallest = packet_size if schedule is None else min(schedule.sizes, default=0)
+            self._tx = self._open_tx(tx_timestamps == "hardware", smallest, sender.batch)
+            flags = TX_FOLLOW_UP if self._tx else 0
+        if not self.start(frequency, packet_size, running_time, flags) and verbose:
+            print("|  ---------- No START acknowledgement from the server ----------  |")
+        meter = RateMeter(
+            frequency, packet_size if schedule is None else schedule.mean_size
+        )
+
+        if schedule is not None:
+            self._send_schedule(sender, schedule, meter, verbose)
+        else:
+            self._send_periodic(
+                sender, pacer, meter, frequency, running_time, verbose, dyna, pacing
+            )
+
+        meter.stop()
+        sender.close()
+        tx = self._tx
+        self.terminate()
+        if not keep_open:
+            self._udp_socket.close()
+        if report:
+            meter.report()
+            if pacer or schedule is not None:
+                report_schedule(summarize_schedule(self.log))
+            if tx:
+                print(
+                    "Kernel TX timestamps: %d software, %d hardware"
+                    % (tx.software, tx.hardware)
+                )
+        return meter.summary()
+
+    def terminate(self) -> bool:
+        # END carries the number of packets sent and the TX timestamps no
+        # DATA packet took along, repeated until acknowledged
+        follow_ups = []
+        if self._tx is not None:
+            time.sleep(TX_SETTLE)
+            for index, stamp in self._tx.drain():
+                self.tx_log.append(index, stamp)
+                self._tx_pending.append((index, stamp))
+            follow_ups = list(self._tx_pending)[-END_FOLLOW_UPS:]
+            self._tx_pending.clear()
+            self._tx.close()
+            self._tx = None
+        packet = pack_end(self.flow, len(self.log), time.time_ns(), follow_ups)
+        return self._control(packet, END_ACK)
+
+    def reset(self) -> None:
+        # Start a new measurement on the same (still bound) socket
+        self.log = MeasurementLog(SEND_SCHEMA)
+        self.tx_log = MeasurementLog(TX_SCHEMA)
+        self.packet_index = 1
 
     def __del__(self):
         self._udp_socket.close()
@@ -128,113 +401,275 @@ class Server:
         self.local_port = local_port
         self.remote_ip = remote_ip
         self.to_port = to_port
-        self.log: List[List[Union[int, float]]] = []
+        self.log = MeasurementLog(RECEIVE_SCHEMA)
+        self.tx_log = MeasurementLog(TX_SCHEMA)
+        self.histogram = LatencyHistogram()
+        self.stats = StreamingStats(window=SEQUENCE_WINDOW)
+        # tx_log.append once the client announced TX follow-ups
+        self._tx_append: Optional[Callable[..., None]] = None
 
         self.offset: List[float] = []
         self.OFFSET = 0.0
+        self.clock: Optional[ClockSync] = None
+        self.record_path: Optional[str] = None
+        self.expected = 0
+        self.planned: Optional[tuple] = None
 
         self._udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         self._udp_socket.bind((self.local_ip, self.local_port))
 
-    def synchronize(self, verbose: bool):
+    def synchronize(self, verbose: bool, fast: bool = True) -> ClockSync:
         if verbose:
             print("|  ---------- Sychonizing Server & Client by PTP ------------  |")
 
-        for i in range(10):
-            msg, _ = self._udp_socket.recvfrom(128 + HEADER_SIZE)
-            t1 = int.from_bytes(msg[4:12], "big")
-            t1_p = time.time_ns()
-            time.sleep(0.05)
-
-            t2 = time.time_ns()
-            index_bytes = (0).to_bytes(4, "big")
-            time_bytes = t2.to_bytes(8, "big")
-            msg = b"".join([b"\x00"] * 128)
-            msg = index_bytes + time_bytes + msg
-            send_nums = self._udp_socket.sendto(msg, (self.remote_ip, self.to_port))
-
-            msg, _ = self._udp_socket.recvfrom(1024)
-            t2_p = int.from_bytes(msg[4:12], "big")
-
-            offset = round(((t1_p - t1 + t2 - t2_p) / 2) * 1e-9, 6)
-            self.offset.append(offset)
-            print("----- Offset at time %d second:  %f -----" % (i, offset))
-        abs_min = 1e9
-        for v in self.offset:
-            if abs(v) < abs_min:
-                abs_min = abs(v)
-                self.OFFSET = v
-
-    def listen(self, buffer_size: int, verbose: bool, sync: bool):
+        clock = self.clock = ClockSync((self.remote_ip, self.to_port))
+        if fast:
+            clock.initial(count=32)
+        else:
+            clock.initial(count=10, gap=0.1)
+        self.offset = [s[1] * 1e-9 for s in clock.samples]
+        self.OFFSET = clock.model[0] * 1e-9
+        print("----- Offset after %d exchanges:  %f -----" % (len(self.offset), self.OFFSET))
+        return clock
+
+    def listen(
+        self,
+        buffer_size: int,
+        verbose: bool,
+        sync: bool,
+        batch: int = 1,
+        kernel_ts: bool = True,
+        interval: float = 0,
+        raw_log: bool = True,
+        significant_digits: int = 3,
+        fast_sync: bool = True,
+        sync_interval: float = 0.5,
+        record_path: Optional[str] = None,
+        params: Optional[dict] = None,
+        timeout: float = 5.0,
+    ):
         if sync:
-            self.synchronize(verbose)
+            synced = self.synchronize(verbose, fast_sync)
+            if sync_interval > 0:
+                synced.start(sync_interval)
 
         if verbose:
             print("|  ---------- Listen from Client %d ------------  |" % self.to_port)
-        latency = 0.0
-        while True:
-            msg, _ = self._udp_socket.recvfrom(buffer_size)
-            recv_time = time.time_ns()
-            packet_index = int.from_bytes(msg[:4], "big")
-            send_time = int.from_bytes(msg[4:12], "big")
-            old_latency = latency
-            latency = round(float(recv_time - send_time) * 1e-9 - float(self.OFFSET), 6)
-            jitter = abs(latency - old_latency)
-            recv_size = len(msg)
-            if packet_index == 0:
-                break
-            self.log.append([packet_index, latency, jitter, recv_time, recv_size])
+        receiver = BatchReceiver(
+            self._udp_socket, buffer_size, batch, kernel_ts, timeout=timeout
+        )
+        reporter = IntervalReporter(interval) if interval > 0 else None
+        record = reporter.record if reporter else None
+        verbose = verbose and reporter is None
+        unpack_from = HEADER.unpack_from
+        follow_up_from = FOLLOW_UP.unpack_from
+        buffers = receiver.buffers
+        sizes = receiver.sizes
+        stamps = receiver.stamps
+        tx_append = self._tx_append
+        self.histogram = LatencyHistogram(significant_digits=significant_digits)
+        hist_record = self.histogram.record
+        append = self.log.append if raw_log else None
+        update = self.stats.update
+        clock = self.clock
+        a, b, t0 = 0.0, 0.0, 0
+        latency = 0
+        running = True
+        started = False
+        recorder = None
+        if record_path and raw_log:
+            # Rows are streamed to disk during the run, not written at the end
+            recorder = RecordWriter(record_path, self.log, params)
+            recorder.start()
+            self.record_path = record_path
+        if reporter:
+            reporter.start()
+        while running:
+            n = receiver.recv()
+            if not n:
+                # Idle for `timeout` seconds: the END message was lost
+                if started:
+                    print("No packet for %g seconds, stop listening" % timeout)
+                    break
+                continue
+            started = True
+            if clock:
+                a, b, t0 = clock.model
+            for i in range(n):
+                recv_time = stamps[i]
+                recv_size = sizes[i]
+                magic, _, kind, _, packet_index, send_time = unpack_from(buffers[i])
+                if kind != DATA or magic != MAGIC:
+                    running = self._handle_control(receiver, i, raw_log)
+                    tx_append = self._tx_append
+                    if not running:
+                        break
+                    continue
+                old_latency = latency
+                latency = recv_time - send_time - int(a + b * (recv_time - t0))
+                if append:
+                    append(packet_index, send_time, recv_time, latency, recv_size)
+                else:
+                    update(packet_index, latency, recv_time, recv_size)
+                hist_record(latency)
+                if record:
+                    record(packet_index, latency, recv_size)
+                if tx_append and recv_size >= FOLLOW_UP_SIZE:
+                    tx_index, tx_time = follow_up_from(buffers[i], HEADER.size)
+                    if tx_index:
+                        tx_append(tx_index, tx_time)
+
+                if verbose:
+                    print(
+                        "[  Server: %d  |  Packet: %6d  |  Latency: %f ｜ Jitter: %f |  Data size: %4d  ]"
+                        % (
+                            self.local_port,
+                            packet_index,
+                            latency * 1e-9,
+                            abs(latency - old_latency) * 1e-9,
+                            recv_size,
+                        )
+                    )
+        if reporter:
+            reporter.stop()
+        receiver.close()
+        if clock:
+            # A clock started outside listen() keeps running for the next test
+            if sync:
+                clock.stop()
+            else:
+                clock.fit()
+            if raw_log:
+                clock.correct(self.log)
+            self.OFFSET = clock.offset_at(time.time_ns()) * 1e-9
+        if recorder:
+            recorder.close(
+                clock.model if clock else None,
+                ["latency"] if clock else [],
+                run=self.announced(),
+            )
 
-            if verbose:
-                print(
-                    "[  Server: %d  |  Packet: %6d  |  Latency: %f ｜ Jitter: %f |  Data size: %4d  ]"
-                    % (self.local_port, packet_index, latency, jitter, recv_size)
-                )
+    def announced(self) -> dict:
+        # What the client announced, for the record header: the planned rate,
+        # size and duration from START, the packet count from END (the planned
+        # count while END has not arrived)
+        run: dict = {}
+        if self.planned is not None:
+            rate, size, duration = self.planned
+            run["rate"] = rate if math.isfinite(rate) else None
+            run["size"] = size
+            run["duration"] = duration
+        if self.expected:
+            run["expected"] = self.expected
+        return run
+
+    def _handle_control(self, receiver: BatchReceiver, i: int, raw_log: bool) -> bool:
+        # Returns False once the client has ended the test
+        data = receiver.buffers[i]
+        kind, flow, _, _ = unpack(data)
+        if kind == START:
+            self.planned = unpack_start(data)
+            rate, _, duration = self.planned
+            if math.isfinite(rate) and not len(self.log):
+                self.expected = self.stats.expected = math.ceil(rate * duration)
+                if raw_log:
+                    self.log.reserve(self.expected)
+            # The split needs the per-packet rows to join the stamps with
+            if start_flags(data) & TX_FOLLOW_UP and raw_log:
+                self._tx_append = self.tx_log.append
+            self._udp_socket.sendto(pack(START_ACK, flow), receiver.address(i))
+        elif kind == END:
+            self.expected = self.stats.expected = unpack_end(data)
+            if self._tx_append:
+                for tx_index, tx_time in end_follow_ups(data, receiver.sizes[i]):
+                    self._tx_append(tx_index, tx_time)
+            self._udp_socket.sendto(pack(END_ACK, flow), receiver.address(i))
+            return False
+        return True
+
+    def reset(self) -> None:
+        # Start a new measurement on the same socket, dropping anything still
+        # queued from the previous one (e.g. repeated END messages)
+        self.log = MeasurementLog(RECEIVE_SCHEMA)
+        self.tx_log = MeasurementLog(TX_SCHEMA)
+        self._tx_append = None
+        self.histogram = LatencyHistogram()
+        self.stats = StreamingStats(window=SEQUENCE_WINDOW)
+        self.record_path = None
+        self.expected = 0
+        self.planned = None
+        self._udp_socket.setblocking(False)
+        try:
+            while True:
+                self._udp_socket.recv(65536)
+        except BlockingIOError:
+            pass
+        finally:
+            self._udp_socket.setblocking(True)
 
     def evaluate(self):
-        latency_list = [row[1] for row in self.log]
-        latency_max = max(latency_list)
-        latency_avg = sum(latency_list) / len(latency_list)
-        var = sum(pow(x - latency_avg, 2) for x in latency_list) / len(latency_list)
-        latency_std = math.sqrt(var)
-        jitter = max(latency_list) - min(latency_list)
-        cycle = (self.log[-1][3] - self.log[0][3]) * 1e-9
-        bandwidth = sum([x[4] + 32 for x in self.log]) / cycle
-        packet_loss = (max([x[0] for x in self.log]) - len(latency_list)) / max(
-            [x[0] for x in self.log]
-        )
-
-        print("| -------------  Summary  --------------- |")
-        print("Total %d packets are received in %f seconds" % (len(self.log), cycle))
-        print("Average latency: %f second" % latency_avg)
-        print("Maximum latency: %f second" % latency_max)
-        print("Std latency: %f second" % latency_std)
-        print("bandwidth: %f Mbits" % (bandwidth * 8 / 1024 / 1024))
-        print("Jitter (Latency Max - Min): %f second" % jitter)
-        print("Packet loss: %f" % packet_loss)
-        return {
-            "latency_max": latency_max,
-            "latency_avg": latency_avg,
-            "jitter": jitter,
-            "bandwidth": bandwidth,
-        }
+        if len(self.log):
+            result = summarize(self.log, self.expected)
+        else:
+            result = self.stats.summary(histogram_percentiles(self.histogram))
+        report(result)
+        if self._tx_append is not None:
+            result.update(summarize_tx(self.log, self.tx_log))
+            report_tx(result)
+        return result
 
     def save(self, path):
-        with open(path, "w") as f:
-            writer = csv.writer(f, delimiter=",")
-            content = [["index", "latency", "jitter", "recv-time", "recv-size"]]
-            writer.writerows(content + self.log)
+        if not len(self.log):
+            print("Raw log is disabled, %s is not written" % path)
+            return
+        if path == self.record_path:
+            return
+        if is_csv(path):
+            write_csv(self.log, path)
+        else:
+            clock = self.clock.model if self.clock else None
+            write_record(self.log, path, clock=clock, run=self.announced())
 
     def __del__(self):
         self._udp_socket.close()
 
 
-if __name__ == "__main__":
+def main(argv: Optional[List[str]] = None) -> None:
+    import getopt
+
     try:
         _opts, _ = getopt.getopt(
-            sys.argv[1:],
+            sys.argv[1:] if argv is None else argv,
             "csf:n:t:b:m:",
-            ["verbose=", "save=", "ip=", "port=", "sync=", "dyna="],
+            [
+                "verbose=",
+                "save=",
+                "ip=",
+                "port=",
+                "sync=",
+                "dyna=",
+                "batch=",
+                "timestamp=",
+                "interval=",
+                "no-raw-log",
+                "hist=",
+                "digits=",
+                "pacing=",
+                "fast-sync=",
+                "sync-interval=",
+                "flows=",
+                "lp=",
+                "timeout=",
+                "metrics=",
+                "window=",
+                "clients=",
+                "evict=",
+                "pattern=",
+                "mix=",
+                "seed=",
+                "tx-timestamp=",
+                "realtime=",
+            ],
         )
         opts = dict(_opts)
         opts.setdefault("-f", "1")
@@ -244,21 +679,52 @@ if __name__ == "__main__":
         opts.setdefault("--ip", "127.0.0.1")
         opts.setdefault("--port", "20001")
         opts.setdefault("--verbose", "True")
-        opts.setdefault("--save", "result.csv")
+        opts.setdefault("--save", "result.udpl")
         opts.setdefault("--dyna", "True")
         opts.setdefault("--sync", "True")
+        opts.setdefault("--batch", "1")
+        opts.setdefault("--timestamp", "kernel")
+        opts.setdefault("--interval", "0")
+        opts.setdefault("--digits", "3")
+        opts.setdefault("--pacing", "deadline")
+        opts.setdefault("--fast-sync", "True")
+        opts.setdefault("--sync-interval", "0.5")
+        opts.setdefault("--flows", "1")
+        opts.setdefault("--lp", "20002")
+        opts.setdefault("--timeout", "5")
+        opts.setdefault("--window", "60")
+        opts.setdefault("--evict", "30")
+        opts.setdefault("--tx-timestamp", "off")
 
     except getopt.GetoptError:
         print(
-            "For Client --> udp_latency.py -c -f/m <frequency / bandwidth> -m <bandwidth> -n <packet size> -t <running time> --ip <remote ip> --port <to port> --verbose <bool> --sync <bool>"
+            "For Client --> udp_latency.py -c -f/m <frequency / bandwidth> -m <bandwidth> -n <packet size> -t <running time> --ip <remote ip> --port <to port> --lp <local port> --verbose <bool> --sync <bool> --batch <packets per syscall> --pacing <deadline / sleep> --flows <number of flows> --pattern <constant / poisson / onoff:<on>:<off>[:exp] / trace:<path>[:<scale>]> --mix <imix / size:weight,...> --seed <random seed> --tx-timestamp <off / software / hardware> --realtime <cores>[:fifo[=<priority>]][:mlock]"
         )
         print(
-            "For Server --> udp_latency.py -s -b <buffer size> --ip <remote ip> --port <local port> --verbose <bool> --sync <bool> --save <records saving path>"
+            "For Server --> udp_latency.py -s -b <buffer size> --ip <remote ip> --port <local port> --verbose <bool> --sync <bool> --save <records saving path> --batch <packets per syscall> --timestamp <kernel / user> --interval <report seconds> --no-raw-log --hist <histogram saving path> --digits <significant digits> --fast-sync <bool> --sync-interval <seconds> --flows <number of flows> --timeout <idle seconds> --metrics <metrics http port> --window <rolling window seconds> --clients <clients to wait for, 0 = forever> --evict <idle seconds> --realtime <cores>[:fifo[=<priority>]][:mlock]"
         )
         sys.exit(2)
 
+    _flows = int(opts["--flows"])
+    if _flows > 1:
+        # The flow workers send plain constant-rate traffic
+        _unsupported: List[str] = [
+            name for name in ("--pattern", "--mix", "--realtime") if name in opts
+        ]
+        if opts["--tx-timestamp"] != "off":
+            _unsupported.append("--tx-timestamp")
+        if _unsupported:
+            print("--flows cannot be combined with %s" % ", ".join(_unsupported))
+            sys.exit(2)
+        # Imported here, udp_multiflow itself builds on this module
+        import udp_multiflow
+    _realtime = None
+    if "--realtime" in opts:
+        from udp_realtime import Realtime, describe, report_realtime
+
+        _realtime = Realtime.parse(opts["--realtime"])
+
     if "-c" in opts.keys():
-        client = Client(remote_ip=opts["--ip"], to_port=int(opts["--port"]))
         _f: float
         if "-m" in opts:
             _f = float(opts["-m"]) * 125000 / int(opts["-n"])
@@ -266,22 +732,154 @@ if __name__ == "__main__":
             _f = math.inf
         else:
             _f = float(opts["-f"])
-        client.send(
-            float(_f),
-            int(opts["-n"]),
-            int(opts["-t"]),
-            eval(opts["--verbose"]),
-            sync=eval(opts["--sync"]),
-            dyna=eval(opts["--dyna"]),
+        if _flows > 1:
+            udp_multiflow.run_clients(
+                _flows,
+                float(_f),
+                int(opts["-n"]),
+                int(opts["-t"]),
+                remote_ip=opts["--ip"],
+                to_port=int(opts["--port"]),
+                local_port=int(opts["--lp"]),
+                verbose=opts["--verbose"] == "True",
+                sync=opts["--sync"] == "True",
+                batch=int(opts["--batch"]),
+                pacing=opts["--pacing"],
+            )
+            sys.exit(0)
+        _schedule = None
+        if "--pattern" in opts or "--mix" in opts:
+            # Drawn in full before the client starts sending
+            from udp_traffic import make_schedule
+
+            _schedule = make_schedule(
+                opts.get("--pattern", "constant"),
+                float(_f),
+                int(opts["-t"]),
+                int(opts["-n"]),
+                mix=opts.get("--mix"),
+                seed=int(opts["--seed"]) if "--seed" in opts else None,
+            )
+        client = Client(
+            local_port=int(opts["--lp"]),
+            remote_ip=opts["--ip"],
+            to_port=int(opts["--port"]),
         )
-
-    if "-s" in opts.keys():
-        server = Server(remote_ip=opts["--ip"], local_port=int(opts["--port"]))
-        server.listen(
+        if _realtime is not None:
+            if _schedule is not None:
+                client.prefault = len(_schedule)
+            elif math.isfinite(_f):
+                client.prefault = math.ceil(_f * int(opts["-t"]))
+        with _realtime or nullcontext():
+            client.send(
+                float(_f),
+                int(opts["-n"]),
+                int(opts["-t"]),
+                opts["--verbose"] == "True",
+                sync=opts["--sync"] == "True",
+                dyna=opts["--dyna"] == "True",
+                batch=int(opts["--batch"]),
+                pacing=opts["--pacing"],
+                schedule=_schedule,
+                tx_timestamps=opts["--tx-timestamp"],
+            )
+        if _realtime is not None:
+            report_realtime(_realtime.applied)
+
+    if "-s" in opts.keys() and "--metrics" in opts:
+        # Daemon mode: listen forever, rolling metrics on http://<host>:<port>/metrics
+        import udp_metrics
+
+        udp_metrics.MetricsDaemon(
+            local_port=int(opts["--port"]),
+            metrics_port=int(opts["--metrics"]),
+            window=float(opts["--window"]),
+            significant_digits=int(opts["--digits"]),
+        ).serve(
             buffer_size=int(opts["-b"]),
-            verbose=eval(opts["--verbose"]),
-            sync=eval(opts["--sync"]),
+            verbose=opts["--verbose"] == "True",
+            batch=int(opts["--batch"]),
+            kernel_ts=opts["--timestamp"] == "kernel",
+            sync=opts["--sync"] == "True",
+            fast_sync=opts["--fast-sync"] == "True",
+            sync_interval=float(opts["--sync-interval"]),
+        )
+    elif "-s" in opts.keys() and "--clients" in opts:
+        # Any number of clients on one socket, one result per (address, flow)
+        import udp_peers
+
+        multi = udp_peers.MultiServer(
+            local_port=int(opts["--port"]),
+            evict=float(opts["--evict"]),
+            significant_digits=int(opts["--digits"]),
+        )
+        try:
+            _results = multi.listen(
+                buffer_size=int(opts["-b"]),
+                verbose=opts["--verbose"] == "True",
+                sync=opts["--sync"] == "True",
+                batch=int(opts["--batch"]),
+                kernel_ts=opts["--timestamp"] == "kernel",
+                fast_sync=opts["--fast-sync"] == "True",
+                sync_interval=float(opts["--sync-interval"]),
+                clients=int(opts["--clients"]),
+            )
+        except KeyboardInterrupt:
+            _results = multi.results
+        multi.close()
+        udp_peers.report_peers(_results)
+    elif "-s" in opts.keys() and _flows > 1:
+        _, _, _histogram = udp_multiflow.run_server(
+            _flows,
+            int(opts["-b"]),
+            local_port=int(opts["--port"]),
+            remote_ip=opts["--ip"],
+            verbose=opts["--verbose"] == "True",
+            sync=opts["--sync"] == "True",
+            batch=int(opts["--batch"]),
+            kernel_ts=opts["--timestamp"] == "kernel",
+            significant_digits=int(opts["--digits"]),
+            fast_sync=opts["--fast-sync"] == "True",
+            sync_interval=float(opts["--sync-interval"]),
+            timeout=float(opts["--timeout"]),
         )
+        if "--hist" in opts:
+            _histogram.save(opts["--hist"])
+    elif "-s" in opts.keys():
+        server = Server(remote_ip=opts["--ip"], local_port=int(opts["--port"]))
+        with _realtime or nullcontext():
+            if _realtime is not None:
+                # Kept in the record header next to the options
+                opts["realtime"] = describe(_realtime.applied)
+            server.listen(
+                buffer_size=int(opts["-b"]),
+                verbose=opts["--verbose"] == "True",
+                sync=opts["--sync"] == "True",
+                batch=int(opts["--batch"]),
+                kernel_ts=opts["--timestamp"] == "kernel",
+                interval=float(opts["--interval"]),
+                raw_log="--no-raw-log" not in opts,
+                significant_digits=int(opts["--digits"]),
+                fast_sync=opts["--fast-sync"] == "True",
+                sync_interval=float(opts["--sync-interval"]),
+                record_path=None if is_csv(opts["--save"]) else opts["--save"],
+                # Rate, size and duration are the client's and go in the header
+                # from START, not the server's unused defaults
+                params={
+                    name: value
+                    for name, value in opts.items()
+                    if name not in ("-f", "-m", "-n", "-t")
+                },
+                timeout=float(opts["--timeout"]),
+            )
         server.evaluate()
+        if _realtime is not None:
+            report_realtime(_realtime.applied)
         if "--save" in opts.keys():
             server.save(opts["--save"])
+        if "--hist" in opts:
+            server.histogram.save(opts["--hist"])
+
+
+if __name__ == "__main__":
+    main()
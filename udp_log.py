@@ -0,0 +1,151 @@
+from array import array
+from typing import Any, Iterator, List, Protocol, Sequence, Tuple
+
+from udp_numpy import numpy
+
+
+CHUNK_SIZE = 1 << 16
+
+SEND_SCHEMA = (
+    ("index", "q"),
+    ("send-time", "q"),
+    ("send-size", "q"),
+    ("sched-error", "q"),
+)
+RECEIVE_SCHEMA = (
+    ("index", "q"),
+    ("send-time", "q"),
+    ("recv-time", "q"),
+    ("latency", "q"),
+    ("recv-size", "q"),
+)
+# udp_rtt with four timestamps: the reflector's receive and send time of
+# each echo (0 from reflectors that do not stamp), latency is the net RTT
+REFLECT_SCHEMA = RECEIVE_SCHEMA + (
+    ("reflect-recv-time", "q"),
+    ("reflect-send-time", "q"),
+)
+# Kernel transmit time of a sent packet, joined to the others by index
+TX_SCHEMA = (
+    ("index", "q"),
+    ("tx-time", "q"),
+)
+
+
+class Columns(Protocol):
+    # What the summaries and exports read: a MeasurementLog in memory or a
+    # RecordFile on disk
+    def column(self, name: str) -> Any:
+        ...
+
+
+class MeasurementLog:
+    # Columnar per-packet log. Each column is a list of preallocated array
+    # chunks, so appending never copies earlier rows and no Python object is
+    # kept per packet.
+    def __init__(
+        self, schema: Sequence[Tuple[str, str]], chunk_size: int = CHUNK_SIZE
+    ) -> None:
+        self.schema = tuple(schema)
+        self.names = [name for name, _ in self.schema]
+        self.chunk_size = chunk_size
+        self._chunks: List[List[array]] = [[] for _ in self.schema]
+        self._chunk_index = 0
+        self._pos = 0
+        self._allocate()
+        self._current = [chunks[0] for chunks in self._chunks]
+
+    def _allocate(self) -> None:
+        for chunks, (_, code) in zip(self._chunks, self.schema):
+            chunks.append(array(code, bytes(array(code).itemsize * self.chunk_size)))
+
+    def _advance(self) -> None:
+        # The next chunk exists before its index is published: a thread
+        # reading sealed chunks never sees an index without its chunk
+        j = self._chunk_index + 1
+        if j == len(self._chunks[0]):
+            self._allocate()
+        self._current = [chunks[j] for chunks in self._chunks]
+        self._pos = 0
+        self._chunk_index = j
+
+    def reserve(self, rows: int) -> None:
+        capacity = len(self._chunks[0]) * self.chunk_size
+        while capacity < len(self) + rows:
+            self._allocate()
+            capacity += self.chunk_size
+
+    def append(self, *row) -> None:
+        if self._pos == self.chunk_size:
+            self._advance()
+        pos = self._pos
+        for column, value in zip(self._current, row):
+            column[pos] = value
+        self._pos = pos + 1
+
+    def __len__(self) -> int:
+        return self._chunk_index * self.chunk_size + self._pos
+
+    def sealed(self) -> int:
+        # Chunks before the one being filled are full and never change again
+        return self._chunk_index
+
+    def chunk(self, c: int, j: int) -> array:
+        # Chunk j of column c, safe from another thread for j < sealed()
+        return self._chunks[c][j]
+
+    def _parts(self, i: int) -> List[Tuple[array, int]]:
+        chunks = self._chunks[i]
+        full = [(chunk, self.chunk_size) for chunk in chunks[: self._chunk_index]]
+        return full + [(chunks[self._chunk_index], self._pos)]
+
+    def chunks(self, name: str) -> List[Tuple[array, int]]:
+        return self._parts(self.names.index(name))
+
+    def column(self, name: str):
+        i = self.names.index(name)
+        code = self.schema[i][1]
+        np = numpy()
+        if np is not None:
+            return np.concatenate(
+                [np.frombuffer(c, dtype=code, count=n) for c, n in self._parts(i)]
+            )
+        out = array(code)
+        for chunk, n in self._parts(i):
+            out.frombytes(memoryview(chunk).cast("B")[: n * chunk.itemsize])
+        return out
+
+    def first(self, name: str):
+        if not len(self):
+            raise IndexError("empty log")
+        return self._chunks[self.names.index(name)][0][0]
+
+    def last(self, name: str):
+        if not len(self):
+            raise IndexError("empty log")
+        return self._current[self.names.index(name)][self._pos - 1]
+
+    def rows(self) -> Iterator[tuple]:
+        return zip(*(self.column(name) for name in self.names))
+
+
+def _csv_rows(log: Columns) -> Iterator[list]:
+    old_latency = 0
+    for index, latency, recv_time, recv_size in zip(
+        log.column("index"),
+        log.column("latency"),
+        log.column("recv-time"),
+        log.column("recv-size"),
+    ):
+        jitter = abs(latency - old_latency)
+        old_latency = latency
+        yield [index, "%.9f" % (latency * 1e-9), "%.9f" % (jitter * 1e-9), recv_time, recv_size]
+
+
+def write_csv(log: Columns, path: str) -> None:
+    import csv
+
+    with open(path, "w") as f:
+        writer = csv.writer(f, delimiter=",")
+        writer.writerow(["index", "latency", "jitter", "recv-time", "recv-size"])
+        writer.writerows(_csv_rows(log))
@@ -0,0 +1,393 @@
+import http.server
+import socket
+import threading
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+from udp_hist import LatencyHistogram
+from udp_io import BatchReceiver
+from udp_latency import SEQUENCE_WINDOW
+from udp_peers import Key, PeerClocks, PeerTable
+from udp_proto import (
+    DATA,
+    END,
+    END_ACK,
+    HEADER,
+    MAGIC,
+    START,
+    START_ACK,
+    SYNC_HELLO,
+    pack,
+    unpack_end,
+)
+from udp_stats import StreamingStats
+from udp_sync import ClockSync
+
+METRICS_PORT = 9464
+WINDOW = 60.0
+# The rolling window is made of SLOTS sub-windows, metrics lag by one slot
+SLOTS = 6
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Slot:
+    # One closed sub-window of a peer, never written again once published
+    __slots__ = (
+        "start",
+        "end",
+        "latency",
+        "jitter",
+        "count",
+        "lost",
+        "reordered",
+        "duplicates",
+    )
+
+    def __init__(self, start, end, latency, jitter, count, lost, reordered, duplicates):
+        self.start = start
+        self.end = end
+        self.latency = latency
+        self.jitter = jitter
+        self.count = count
+        self.lost = lost
+        self.reordered = reordered
+        self.duplicates = duplicates
+
+
+class PeerMetrics:
+    # Rolling metrics of one client flow, written by the receive loop only.
+    # rotate() closes the live slot and replaces `closed` with a new tuple, so
+    # readers on other threads only ever see finished, immutable slots.
+    def __init__(self, window: int, significant_digits: int, now: int) -> None:
+        self.window = window
+        self.significant_digits = significant_digits
+        # Clock model of the client's address once it has synchronized
+        self.clock: Optional[ClockSync] = None
+        self.closed: Tuple[_Slot, ...] = ()
+        # packets, lost, reordered, duplicates, bytes since the daemon started
+        self.totals = (0, 0, 0, 0, 0)
+        self.jitter_rfc3550 = 0.0
+        self._last_latency: Optional[int] = None
+        self._restart(now)
+
+    def _restart(self, now: int) -> None:
+        self.stats = StreamingStats(window=SEQUENCE_WINDOW)
+        self._base = (0, 0, 0, 0, 0)
+        self._open(now)
+
+    def _open(self, now: int) -> None:
+        self.latency = LatencyHistogram(significant_digits=self.significant_digits)
+        self.jitter = LatencyHistogram(significant_digits=self.significant_digits)
+        self.start = now
+
+    def update(self, index: int, latency: int, recv_time: int, size: int) -> None:
+        if self.clock is not None:
+            a, b, t0 = self.clock.model
+            latency -= int(a + b * (recv_time - t0))
+        self.stats.update(index, latency, recv_time, size)
+        self.latency.record(latency)
+        if self._last_latency is not None:
+            self.jitter.record(abs(latency - self._last_latency))
+        self._last_latency = latency
+
+    def _counters(self) -> Tuple[int, int, int, int, int]:
+        s = self.stats
+        lost = max(s.highest - (s.count - s.duplicates), 0)
+        return s.count, lost, s.reordered, s.duplicates, s.bytes
+
+    def rotate(self, now: int) -> None:
+        counters = self._counters()
+        count, lost, reordered, duplicates, size = (
+            new - old for new, old in zip(counters, self._base)
+        )
+        self._base = counters
+        slot = _Slot(
+            self.start,
+            now,
+            self.latency,
+            self.jitter,
+            count,
+            max(lost, 0),
+            reordered,
+            duplicates,
+        )
+        packets, total_lost, total_reordered, total_duplicates, total_bytes = self.totals
+        self.totals = (
+            packets + count,
+            total_lost + max(lost, 0),
+            total_reordered + reordered,
+            total_duplicates + duplicates,
+            total_bytes + size,
+        )
+        self.jitter_rfc3550 = self.stats.jitter
+        oldest = now - self.window
+        self.closed = tuple(s for s in self.closed if s.end > oldest) + (slot,)
+        self._open(now)
+
+    def begin(self, now: int) -> None:
+        # START: a new test of this flow numbers its packets from 1 again
+        self.rotate(now)
+        self._restart(now)
+        self._last_latency = None
+
+    def end(self, sent: int) -> None:
+        # END: packets after the highest one received were lost in the tail
+        self.stats.highest = max(self.stats.highest, sent)
+
+
+def _merge(histograms: List[LatencyHistogram]) -> LatencyHistogram:
+    merged = LatencyHistogram(significant_digits=histograms[0].significant_digits)
+    for histogram in histograms:
+        merged.merge(histogram)
+    return merged
+
+
+def _summary(lines: List[str], name: str, labels: str, histogram) -> None:
+    for q, value in zip(QUANTILES, histogram.percentiles(q * 100 for q in QUANTILES)):
+        lines.append('%s{%s,quantile="%g"} %.9f' % (name, labels, q, value * 1e-9))
+    lines.append("%s_sum{%s} %.9f" % (name, labels, histogram.total * 1e-9))
+    lines.append("%s_count{%s} %d" % (name, labels, histogram.count))
+
+
+def render(peers) -> str:
+    # Prometheus text exposition of a published snapshot
+    lines = [
+        "# HELP udp_latency_peers Client flows seen within the rolling window.",
+        "# TYPE udp_latency_peers gauge",
+        "udp_latency_peers %d" % len(peers),
+    ]
+    families = (
+        ("udp_latency_seconds", "summary", "One-way latency over the rolling window."),
+        (
+            "udp_latency_jitter_seconds",
+            "summary",
+            "Latency difference of consecutive packets over the rolling window.",
+        ),
+        ("udp_latency_rfc3550_jitter_seconds", "gauge", "RFC 3550 interarrival jitter."),
+        ("udp_latency_window_seconds", "gauge", "Time span covered by the window."),
+        ("udp_latency_window_lost_packets", "gauge", "Packets lost in the window."),
+        ("udp_latency_window_loss_ratio", "gauge", "Lost / expected packets."),
+        ("udp_latency_window_reordered_packets", "gauge", "Reordered packets."),
+        ("udp_latency_packets_total", "counter", "Packets received."),
+        ("udp_latency_lost_packets_total", "counter", "Packets lost."),
+        ("udp_latency_reordered_packets_total", "counter", "Packets reordered."),
+        ("udp_latency_duplicate_packets_total", "counter", "Duplicated packets."),
+        ("udp_latency_received_bytes_total", "counter", "UDP payload bytes received."),
+    )
+    body: Dict[str, List[str]] = {name: [] for name, _, _ in families}
+    for labels, closed, totals, jitter_rfc3550 in peers:
+        if closed:
+            _summary(
+                body["udp_latency_seconds"],
+                "udp_latency_seconds",
+                labels,
+                _merge([s.latency for s in closed]),
+            )
+            _summary(
+                body["udp_latency_jitter_seconds"],
+                "udp_latency_jitter_seconds",
+                labels,
+                _merge([s.jitter for s in closed]),
+            )
+        count = sum(s.count for s in closed)
+        lost = sum(s.lost for s in closed)
+        span = (closed[-1].end - closed[0].start) * 1e-9 if closed else 0.0
+        expected = count - sum(s.duplicates for s in closed) + lost
+        gauges = (
+            ("udp_latency_rfc3550_jitter_seconds", "%.9f" % (jitter_rfc3550 * 1e-9)),
+            ("udp_latency_window_seconds", "%.3f" % span),
+            ("udp_latency_window_lost_packets", "%d" % lost),
+            ("udp_latency_window_loss_ratio", "%.6f" % (lost / expected if expected else 0)),
+            (
+                "udp_latency_window_reordered_packets",
+                "%d" % sum(s.reordered for s in closed),
+            ),
+        )
+        for name, value in gauges:
+            body[name].append("%s{%s} %s" % (name, labels, value))
+        counters = (
+            "udp_latency_packets_total",
+            "udp_latency_lost_packets_total",
+            "udp_latency_reordered_packets_total",
+            "udp_latency_duplicate_packets_total",
+            "udp_latency_received_bytes_total",
+        )
+        for name, value in zip(counters, totals):
+            body[name].append("%s{%s} %d" % (name, labels, value))
+    for name, kind, help_text in families:
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        lines.extend(body[name])
+    return "\n".join(lines) + "\n"
+
+
+def _labels(key: Key) -> str:
+    (ip, port), flow = key
+    return 'peer="%s:%d",flow="%d"' % (ip, port, flow)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    source: "MetricsDaemon"
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.source.metrics()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class MetricsDaemon:
+    # Listens forever and exposes per-client rolling metrics on /metrics.
+    # The receive loop publishes a new snapshot tuple on every slot rotation
+    # (a single reference assignment); the HTTP thread only reads published
+    # snapshots, so a scrape never takes a lock the receive loop waits on.
+    def __init__(
+        self,
+        local_ip: str = "0.0.0.0",
+        local_port: int = 20001,
+        metrics_port: int = METRICS_PORT,
+        window: float = WINDOW,
+        significant_digits: int = 3,
+    ) -> None:
+        self.local_ip = local_ip
+        self.local_port = local_port
+        self.metrics_port = metrics_port
+        self.window = int(window * 1e9)
+        self.slot = self.window // SLOTS
+        self.significant_digits = significant_digits
+        # Flows idle for a whole window have nothing left to export
+        self.table: PeerTable[PeerMetrics] = PeerTable(self._new_peer, window)
+        self.clocks = PeerClocks(window)
+        self._snapshot: Tuple[int, tuple] = (0, ())
+        self._rendered: Tuple[int, bytes] = (-1, b"")
+        self._stop = threading.Event()
+        self._http: Optional[http.server.ThreadingHTTPServer] = None
+
+        self._udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._udp_socket.bind((self.local_ip, self.local_port))
+
+    def _new_peer(self, key: Key, now: int) -> PeerMetrics:
+        peer = PeerMetrics(self.window, self.significant_digits, now)
+        peer.clock = self.clocks.get(key[0])
+        return peer
+
+    def metrics(self) -> bytes:
+        generation, peers = self._snapshot
+        rendered = self._rendered
+        if rendered[0] != generation:
+            rendered = self._rendered = (generation, render(peers).encode())
+        return rendered[1]
+
+    def _publish(self, now: int) -> None:
+        table = self.table
+        for key in table.stale(now):
+            table.pop(key)
+        self.clocks.expire({key[0] for key in table.peers}, now)
+        for peer in table.peers.values():
+            peer.rotate(now)
+        self._snapshot = (
+            self._snapshot[0] + 1,
+            tuple(
+                (_labels(key), peer.closed, peer.totals, peer.jitter_rfc3550)
+                for key, peer in table.peers.items()
+            ),
+        )
+
+    def start_http(self) -> http.server.ThreadingHTTPServer:
+        handler = type("Handler", (_MetricsHandler,), {"source": self})
+        server = self._http = http.server.ThreadingHTTPServer(
+            (self.local_ip, self.metrics_port), handler
+        )
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def serve(
+        self,
+        buffer_size: int = 1500,
+        verbose: bool = True,
+        batch: int = 1,
+        kernel_ts: bool = True,
+        sync: bool = True,
+        fast_sync: bool = True,
+        sync_interval: float = 0.5,
+    ) -> None:
+        server = self._http or self.start_http()
+        if verbose:
+            print(
+                "|  ---------- Serving metrics on port %d/metrics ------------  |"
+                % server.server_address[1]
+            )
+        # recv() returns at least once per slot so idle peers still rotate
+        receiver = BatchReceiver(
+            self._udp_socket, buffer_size, batch, kernel_ts, timeout=self.slot / 1e9
+        )
+        unpack_from = HEADER.unpack_from
+        buffers = receiver.buffers
+        sizes = receiver.sizes
+        stamps = receiver.stamps
+        table = self.table
+        peers = table.peers
+        last_seen = table.last_seen
+        next_rotation = time.time_ns() + self.slot
+        try:
+            while not self._stop.is_set():
+                n = receiver.recv()
+                for i in range(n):
+                    recv_time = stamps[i]
+                    magic, _, kind, flow, packet_index, send_time = unpack_from(buffers[i])
+                    if magic != MAGIC:
+                        continue
+                    address = receiver.address(i)
+                    key = (address, flow)
+                    peer = peers.get(key)
+                    if kind == DATA:
+                        if peer is None:
+                            peer = table.add(key, recv_time)
+                        last_seen[key] = recv_time
+                        peer.update(packet_index, recv_time - send_time, recv_time, sizes[i])
+                    elif kind == START:
+                        if peer is None:
+                            peer = table.add(key, recv_time)
+                        peer.begin(recv_time)
+                        self._udp_socket.sendto(pack(START_ACK, flow), address)
+                    elif kind == END:
+                        # Repeated ENDs are acknowledged again
+                        self._udp_socket.sendto(pack(END_ACK, flow), address)
+                        if peer is not None:
+                            peer.end(unpack_end(buffers[i]))
+                        # The next run from this address synchronizes again
+                        self.clocks.release(address)
+                    elif kind == SYNC_HELLO and sync:
+                        clock = self.clocks.synchronize(address, fast_sync, sync_interval)
+                        if clock is not None:
+                            for other in peers:
+                                if other[0] == address:
+                                    peers[other].clock = clock
+                now = time.time_ns()
+                if now >= next_rotation:
+                    self._publish(now)
+                    next_rotation = now + self.slot
+        finally:
+            receiver.close()
+            self.clocks.close()
+            if self._http is not None:
+                self._http.shutdown()
+                self._http.server_close()
+                self._http = None
+
+    def __del__(self):
+        self._udp_socket.close()
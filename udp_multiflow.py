@@ -0,0 +1,321 @@
+import math
+import multiprocessing as mp
+import os
+import queue
+import select
+import socket
+import time
+
+from typing import Dict, List, Tuple
+
+from udp_hist import LatencyHistogram
+from udp_io import BatchReceiver
+from udp_latency import SEQUENCE_WINDOW, Client
+from udp_proto import (
+    DATA,
+    END,
+    END_ACK,
+    HEADER,
+    MAGIC,
+    START,
+    START_ACK,
+    pack,
+    unpack_end,
+    unpack_start,
+)
+from udp_stats import StreamingStats, histogram_percentiles, report, summarize_schedule
+from udp_sync import ClockSync
+
+POLL_TIMEOUT = 200
+
+
+def _send_flow(
+    flow: int,
+    local_port: int,
+    remote_ip: str,
+    to_port: int,
+    frequency: float,
+    packet_size: int,
+    running_time: int,
+    batch: int,
+    pacing: str,
+    results,
+) -> None:
+    client = Client(
+        local_port=local_port + flow, remote_ip=remote_ip, to_port=to_port, flow=flow
+    )
+    summary = client.send(
+        frequency,
+        packet_size,
+        running_time,
+        False,
+        sync=False,
+        dyna=False,
+        batch=batch,
+        pacing=pacing,
+        report=False,
+    )
+    results.put((flow, summary, summarize_schedule(client.log)))
+
+
+def run_clients(
+    flows: int,
+    frequency: float,
+    packet_size: int,
+    running_time: int,
+    remote_ip: str = "127.0.0.1",
+    to_port: int = 20001,
+    local_port: int = 20002,
+    verbose: bool = False,
+    sync: bool = True,
+    batch: int = 1,
+    pacing: str = "deadline",
+) -> List[dict]:
+    # One sender process per flow, flow k sends from local_port + k at an equal
+    # share of the target rate; the clock sync stays on local_port itself
+    control = Client(local_port=local_port, remote_ip=remote_ip, to_port=to_port)
+    if sync:
+        control.synchronize(verbose)
+
+    results: "mp.Queue[Tuple[int, dict, dict]]" = mp.Queue()
+    workers = [
+        mp.Process(
+            target=_send_flow,
+            args=(
+                flow,
+                local_port,
+                remote_ip,
+                to_port,
+                frequency / flows,
+                packet_size,
+                running_time,
+                batch,
+                pacing,
+                results,
+            ),
+        )
+        for flow in range(1, flows + 1)
+    ]
+    for worker in workers:
+        worker.start()
+    collected = sorted(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+
+    print("| ---- Sender flows ---- |")
+    print("%6s %12s %12s %12s %14s" % ("flow", "packets", "pps", "Mbits", "sched p99"))
+    total_packets = 0
+    total_pps = 0.0
+    total_mbits = 0.0
+    for flow, summary, schedule in collected:
+        total_packets += summary["packets"]
+        total_pps += summary["pps"]
+        total_mbits += summary["mbits"]
+        print(
+            "%6d %12d %12.1f %12.3f %14f"
+            % (
+                flow,
+                summary["packets"],
+                summary["pps"],
+                summary["mbits"],
+                schedule.get("error_p99", 0.0),
+            )
+        )
+    print(
+        "%6s %12d %12.1f %12.3f" % ("all", total_packets, total_pps, total_mbits),
+        flush=True,
+    )
+    return [summary for _, summary, _ in collected]
+
+
+def _receive_flows(
+    port: int,
+    buffer_size: int,
+    batch: int,
+    kernel_ts: bool,
+    significant_digits: int,
+    flows: int,
+    timeout: float,
+    finished,
+    model,
+    ready,
+    results,
+) -> None:
+    # Every worker binds its own SO_REUSEPORT socket to the same port, the
+    # kernel hashes each flow's 4-tuple onto one of them
+    sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("0.0.0.0", port))
+    receiver = BatchReceiver(sock, buffer_size, batch, kernel_ts)
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    ready.release()
+
+    unpack_from = HEADER.unpack_from
+    buffers = receiver.buffers
+    sizes = receiver.sizes
+    stamps = receiver.stamps
+    per_flow: Dict[int, Tuple[StreamingStats, LatencyHistogram]] = {}
+    ended = set()
+    last = time.monotonic()
+    while finished.value < flows:
+        if not poller.poll(POLL_TIMEOUT):
+            # A lost END would keep this worker forever, give up after being
+            # idle for `timeout` once the test has started
+            if (per_flow or finished.value) and time.monotonic() - last > timeout:
+                break
+            continue
+        last = time.monotonic()
+        n = receiver.recv()
+        a, b, t0 = model[:]
+        for i in range(n):
+            recv_time = stamps[i]
+            magic, _, kind, flow, packet_index, send_time = unpack_from(buffers[i])
+            if magic != MAGIC or kind not in (DATA, START, END):
+                continue
+            entry = per_flow.get(flow)
+            if entry is None:
+                entry = per_flow[flow] = (
+                    StreamingStats(window=SEQUENCE_WINDOW),
+                    LatencyHistogram(significant_digits=significant_digits),
+                )
+            if kind == START:
+                rate, _, duration = unpack_start(buffers[i])
+                if math.isfinite(rate):
+                    entry[0].expected = math.ceil(rate * duration)
+                sock.sendto(pack(START_ACK, flow), receiver.address(i))
+                continue
+            if kind == END:
+                entry[0].expected = unpack_end(buffers[i])
+                sock.sendto(pack(END_ACK, flow), receiver.address(i))
+                if flow not in ended:
+                    ended.add(flow)
+                    with finished.get_lock():
+                        finished.value += 1
+                continue
+            latency = recv_time - send_time - int(a + b * (recv_time - t0))
+            entry[0].update(packet_index, latency, recv_time, sizes[i])
+            entry[1].record(latency)
+    receiver.close()
+    sock.close()
+    results.put(
+        [
+            (flow, stats, histogram.to_bytes())
+            for flow, (stats, histogram) in per_flow.items()
+        ]
+    )
+
+
+def run_server(
+    flows: int,
+    buffer_size: int,
+    local_port: int = 20001,
+    remote_ip: str = "127.0.0.1",
+    to_port: int = 20002,
+    verbose: bool = False,
+    sync: bool = True,
+    batch: int = 1,
+    kernel_ts: bool = True,
+    significant_digits: int = 3,
+    fast_sync: bool = True,
+    sync_interval: float = 0.5,
+    workers: int = 0,
+    timeout: float = 5.0,
+) -> Tuple[dict, Dict[int, dict], LatencyHistogram]:
+    workers = workers or min(flows, os.cpu_count() or 1)
+    finished = mp.Value("i", 0)
+    model = mp.Array("d", 3)
+    ready = mp.Semaphore(0)
+    # Per worker: (flow, stats, serialized histogram) of each of its flows
+    results: "mp.Queue[List[Tuple[int, StreamingStats, bytes]]]" = mp.Queue()
+    procs = [
+        mp.Process(
+            target=_receive_flows,
+            args=(
+                local_port,
+                buffer_size,
+                batch,
+                kernel_ts,
+                significant_digits,
+                flows,
+                timeout,
+                finished,
+                model,
+                ready,
+                results,
+            ),
+        )
+        for _ in range(workers)
+    ]
+    for proc in procs:
+        proc.start()
+    for _ in procs:
+        ready.acquire()
+
+    clock = None
+    if sync:
+        if verbose:
+            print("|  ---------- Sychonizing Server & Client by PTP ------------  |")
+        clock = ClockSync((remote_ip, to_port))
+        if fast_sync:
+            clock.initial(count=32)
+        else:
+            clock.initial(count=10, gap=0.1)
+        model[:] = clock.model
+        print(
+            "----- Offset after %d exchanges:  %f -----"
+            % (len(clock.samples), clock.model[0] * 1e-9)
+        )
+        if sync_interval > 0:
+            clock.start(sync_interval)
+    if verbose:
+        print(
+            "|  ---------- Listen from %d flows on %d workers ------------  |"
+            % (flows, workers)
+        )
+
+    collected: List[List[Tuple[int, StreamingStats, bytes]]] = []
+    while len(collected) < len(procs):
+        try:
+            collected.append(results.get(timeout=sync_interval or 0.5))
+        except queue.Empty:
+            pass
+        if clock:
+            model[:] = clock.model
+    for proc in procs:
+        proc.join()
+    if clock:
+        clock.stop()
+
+    total = StreamingStats()
+    histogram = LatencyHistogram(significant_digits=significant_digits)
+    per_flow = {}
+    for entries in collected:
+        for flow, stats, data in entries:
+            flow_histogram = LatencyHistogram.from_bytes(data)
+            per_flow[flow] = stats.summary(histogram_percentiles(flow_histogram))
+            total.merge(stats)
+            histogram.merge(flow_histogram)
+
+    print("| -------------  Flows  --------------- |")
+    print(
+        "%6s %10s %10s %12s %12s %12s %12s"
+        % ("flow", "packets", "loss", "avg", "p50", "p99", "max")
+    )
+    for flow in sorted(per_flow):
+        result = per_flow[flow]
+        print(
+            "%6d %10d %10f %12f %12f %12f %12f"
+            % (
+                flow,
+                result["count"],
+                result["packet_loss"],
+                result["latency_avg"],
+                result["p50"],
+                result["p99"],
+                result["latency_max"],
+            )
+        )
+    result = total.summary(histogram_percentiles(histogram))
+    report(result)
+    return result, per_flow, histogram
@@ -0,0 +1,20 @@
+import importlib
+from types import ModuleType
+from typing import Optional
+
+# NumPy is optional and takes longer to import than the rest of the tool,
+# modules ask for it on the code paths that use it instead of at import time
+_numpy: Optional[ModuleType] = None
+_loaded = False
+
+
+def numpy() -> Optional[ModuleType]:
+    # The numpy module, None when it is not installed
+    global _numpy, _loaded
+    if not _loaded:
+        try:
+            _numpy = importlib.import_module("numpy")
+        except ImportError:  # pragma: no cover - numpy is optional
+            _numpy = None
+        _loaded = True
+    return _numpy
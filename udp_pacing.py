@@ -0,0 +1,94 @@
+import ctypes
+import sys
+import time
+
+from typing import Optional
+
+from udp_io import open_libc
+
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+MAX_SPIN = 2_000_000
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _load_clock_nanosleep():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        func = open_libc().clock_nanosleep
+    except AttributeError:
+        return None
+    func.argtypes = [
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.POINTER(_Timespec),
+        ctypes.POINTER(_Timespec),
+    ]
+    func.restype = ctypes.c_int
+    return func
+
+
+_clock_nanosleep = _load_clock_nanosleep()
+
+
+def sleep_until(deadline: int) -> None:
+    # `deadline` is an absolute time.monotonic_ns() value
+    if _clock_nanosleep is not None:
+        ts = _Timespec(deadline // 1_000_000_000, deadline % 1_000_000_000)
+        # Restarted on EINTR, the deadline is absolute so nothing drifts
+        while _clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, ctypes.byref(ts), None):
+            if time.monotonic_ns() >= deadline:
+                break
+        return
+    remaining = deadline - time.monotonic_ns()
+    if remaining > 0:
+        time.sleep(remaining * 1e-9)
+
+
+def calibrate(samples: int = 50, probe: int = 200_000) -> int:
+    # Measure how late sleep_until() wakes up, busy-spin covers the p90 miss
+    overshoots = []
+    for _ in range(samples):
+        deadline = time.monotonic_ns() + probe
+        sleep_until(deadline)
+        overshoots.append(time.monotonic_ns() - deadline)
+    overshoots.sort()
+    return min(overshoots[int(len(overshoots) * 0.9)] * 2, MAX_SPIN)
+
+
+class Pacer:
+    # Schedules packet k against the absolute deadline start + k * period
+    # (time.monotonic_ns() clock): sleeps until shortly before the deadline,
+    # then busy-spins the last `spin` nanoseconds. The period is kept in
+    # fractional nanoseconds and only the product is rounded, so rates that
+    # do not divide 1e9 do not drift by the truncated remainder per packet.
+    def __init__(self, period: float, spin: Optional[int] = None) -> None:
+        self.period = period
+        self.spin = calibrate() if spin is None else spin
+        self.start = time.monotonic_ns()
+
+    def begin(self) -> None:
+        self.start = time.monotonic_ns()
+
+    def deadline(self, k: int) -> int:
+        return self.start + round(k * self.period)
+
+    def wait(self, k: int) -> int:
+        return self.wait_at(round(k * self.period))
+
+    def wait_at(self, offset: int) -> int:
+        # Wait for the deadline `offset` ns after the start and return the lateness
+        deadline = self.start + offset
+        now = time.monotonic_ns()
+        if deadline - now > self.spin:
+            sleep_until(deadline - self.spin)
+        while now < deadline:
+            now = time.monotonic_ns()
+        return now - deadline
+
+    def error(self, k: int) -> int:
+        return time.monotonic_ns() - self.deadline(k)
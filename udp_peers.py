@@ -0,0 +1,325 @@
+import math
+import socket
+import threading
+import time
+
+from typing import Callable, Dict, Generic, List, Optional, Set, Tuple, TypeVar
+
+from udp_hist import LatencyHistogram
+from udp_io import BatchReceiver
+from udp_latency import SEQUENCE_WINDOW
+from udp_proto import (
+    DATA,
+    END,
+    END_ACK,
+    HEADER,
+    MAGIC,
+    START,
+    START_ACK,
+    SYNC_HELLO,
+    pack,
+    unpack_end,
+    unpack_start,
+)
+from udp_stats import StreamingStats, histogram_percentiles
+from udp_sync import ClockSync
+
+# Peers idle for this long are closed and dropped from the table
+EVICT = 30.0
+# Longest wait in recv(), eviction is checked at least this often
+TICK = 1.0
+
+Address = Tuple[str, int]
+Key = Tuple[Address, int]
+P = TypeVar("P")
+
+
+class PeerTable(Generic[P]):
+    # Per-peer state keyed by (source address, flow id). Only the receive
+    # loop touches it; `peers` and `last_seen` are plain dicts so the hot path
+    # can use them without a method call.
+    def __init__(self, factory: Callable[[Key, int], P], idle: float = EVICT) -> None:
+        self.factory = factory
+        self.idle = int(idle * 1e9)
+        self.peers: Dict[Key, P] = {}
+        self.last_seen: Dict[Key, int] = {}
+
+    def add(self, key: Key, now: int) -> P:
+        peer = self.peers[key] = self.factory(key, now)
+        self.last_seen[key] = now
+        return peer
+
+    def pop(self, key: Key) -> P:
+        del self.last_seen[key]
+        return self.peers.pop(key)
+
+    def stale(self, now: int) -> List[Key]:
+        # Peers idle for longer than `idle`
+        oldest = now - self.idle
+        return [key for key, seen in self.last_seen.items() if seen < oldest]
+
+    def __len__(self) -> int:
+        return len(self.peers)
+
+
+class PeerClocks:
+    # ClockSync of every client address that asked for synchronization
+    # (SYNC_HELLO), shared by the flows from that address. The initial
+    # exchanges take up to a second and run on a thread, never in the
+    # receive loop.
+    def __init__(self, idle: float = EVICT) -> None:
+        self.idle = int(idle * 1e9)
+        self.clocks: Dict[Address, ClockSync] = {}
+        self._started: Dict[Address, int] = {}
+
+    def get(self, address: Address) -> Optional[ClockSync]:
+        return self.clocks.get(address)
+
+    def __contains__(self, address: Address) -> bool:
+        return address in self.clocks
+
+    def synchronize(
+        self, address: Address, fast: bool, interval: float
+    ) -> Optional[ClockSync]:
+        # The new clock, None when the address is already synchronized
+        if address in self.clocks:
+            return None
+        clock = self.clocks[address] = ClockSync(address)
+        self._started[address] = time.time_ns()
+
+        def run() -> None:
+            if fast:
+                clock.initial(count=32)
+            else:
+                clock.initial(count=10, gap=0.1)
+            if interval > 0:
+                clock.start(interval)
+
+        threading.Thread(target=run, daemon=True).start()
+        return clock
+
+    def release(self, address: Address) -> None:
+        # A new run from this address synchronizes again
+        if address in self.clocks:
+            del self._started[address]
+            threading.Thread(target=self.clocks.pop(address).stop, daemon=True).start()
+
+    def expire(self, active: Set[Address], now: int) -> None:
+        # Clients that synchronized but never sent anything
+        for address, started in list(self._started.items()):
+            if address not in active and now - started > self.idle:
+                self.release(address)
+
+    def close(self) -> None:
+        for clock in self.clocks.values():
+            clock.stop()
+        self.clocks.clear()
+        self._started.clear()
+
+
+def label(key: Key) -> str:
+    (ip, port), flow = key
+    return "%s:%d/%d" % (ip, port, flow)
+
+
+class Peer:
+    # Measurement state of one client flow: sequence tracking, moments and
+    # latency histogram, plus the clock model of its address when synchronized
+    def __init__(self, key: Key, now: int, significant_digits: int = 3) -> None:
+        self.key = key
+        self.stats = StreamingStats(window=SEQUENCE_WINDOW)
+        self.histogram = LatencyHistogram(significant_digits=significant_digits)
+        self.clock: Optional[ClockSync] = None
+        self.planned: Optional[Tuple[float, int, float]] = None
+        self.first_seen = now
+
+    def summary(self) -> dict:
+        return self.stats.summary(histogram_percentiles(self.histogram))
+
+
+class MultiServer:
+    # One socket for any number of clients. Packets are demultiplexed by
+    # source address and flow id; every client that asks for synchronization
+    # (SYNC_HELLO) gets its own ClockSync. A peer's result is final on END
+    # or after EVICT idle seconds.
+    def __init__(
+        self,
+        local_ip: str = "0.0.0.0",
+        local_port: int = 20001,
+        evict: float = EVICT,
+        significant_digits: int = 3,
+    ) -> None:
+        self.local_ip = local_ip
+        self.local_port = local_port
+        self.significant_digits = significant_digits
+        self.table: PeerTable[Peer] = PeerTable(self._new_peer, evict)
+        self.clocks = PeerClocks(evict)
+        # Peers closed by END, and when: late or reordered DATA behind the
+        # END must not open them again
+        self.ended: Dict[Key, int] = {}
+        self.results: Dict[str, dict] = {}
+        self._stop = threading.Event()
+
+        self._udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._udp_socket.bind((self.local_ip, self.local_port))
+
+    def _new_peer(self, key: Key, now: int) -> Peer:
+        peer = Peer(key, now, self.significant_digits)
+        peer.clock = self.clocks.get(key[0])
+        return peer
+
+    def _synchronize(self, address: Address, fast: bool, interval: float) -> None:
+        clock = self.clocks.synchronize(address, fast, interval)
+        if clock is None:
+            return
+        for peer in self.table.peers.values():
+            if peer.key[0] == address:
+                peer.clock = clock
+
+    def _close(self, key: Key, reason: str, verbose: bool) -> None:
+        peer = self.table.pop(key)
+        result = self.results[label(key)] = peer.summary()
+        if verbose:
+            print(
+                "[  Peer: %-24s |  %-7s |  Packets: %8d  |  Avg: %f  |  p99: %f  |  Loss: %f  ]"
+                % (
+                    label(key),
+                    reason,
+                    result["count"],
+                    result["latency_avg"],
+                    result["p99"],
+                    result["packet_loss"],
+                ),
+                flush=True,
+            )
+        address = key[0]
+        if address in self.clocks and not any(
+            other[0] == address for other in self.table.peers
+        ):
+            # No flow of this client left, a new run synchronizes again
+            self.clocks.release(address)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def listen(
+        self,
+        buffer_size: int = 1500,
+        verbose: bool = True,
+        sync: bool = True,
+        batch: int = 1,
+        kernel_ts: bool = True,
+        fast_sync: bool = True,
+        sync_interval: float = 0.5,
+        clients: int = 0,
+    ) -> Dict[str, dict]:
+        # Returns {peer label: summary} once `clients` peers have finished,
+        # runs until stop() when clients is 0
+        if verbose:
+            print(
+                "|  ---------- Listen from any client on port %d ------------  |"
+                % self.local_port
+            )
+        receiver = BatchReceiver(
+            self._udp_socket, buffer_size, batch, kernel_ts, timeout=TICK
+        )
+        unpack_from = HEADER.unpack_from
+        buffers = receiver.buffers
+        sizes = receiver.sizes
+        stamps = receiver.stamps
+        table = self.table
+        peers = table.peers
+        last_seen = table.last_seen
+        ended = self.ended
+        sock = self._udp_socket
+        tick = int(TICK * 1e9)
+        next_tick = time.time_ns() + tick
+        finished = 0
+        try:
+            while not self._stop.is_set() and not (clients and finished >= clients):
+                n = receiver.recv()
+                for i in range(n):
+                    recv_time = stamps[i]
+                    magic, _, kind, flow, packet_index, send_time = unpack_from(buffers[i])
+                    if magic != MAGIC:
+                        continue
+                    key = (receiver.address(i), flow)
+                    peer = peers.get(key)
+                    if kind == DATA:
+                        if peer is None:
+                            if key in ended:
+                                continue
+                            peer = table.add(key, recv_time)
+                        last_seen[key] = recv_time
+                        latency = recv_time - send_time
+                        if peer.clock is not None:
+                            a, b, t0 = peer.clock.model
+                            latency -= int(a + b * (recv_time - t0))
+                        peer.stats.update(packet_index, latency, recv_time, sizes[i])
+                        peer.histogram.record(latency)
+                        continue
+                    if kind == START:
+                        if peer is not None and peer.stats.count:
+                            self._close(key, "restart", verbose)
+                            finished += 1
+                            peer = None
+                        if peer is None:
+                            ended.pop(key, None)
+                            peer = table.add(key, recv_time)
+                        peer.planned = rate, _, duration = unpack_start(buffers[i])
+                        if math.isfinite(rate):
+                            peer.stats.expected = math.ceil(rate * duration)
+                        sock.sendto(pack(START_ACK, flow), key[0])
+                    elif kind == END:
+                        # Repeated ENDs of a closed peer are acknowledged again
+                        sock.sendto(pack(END_ACK, flow), key[0])
+                        if peer is not None:
+                            peer.stats.expected = unpack_end(buffers[i])
+                            self._close(key, "end", verbose)
+                            ended[key] = recv_time
+                            finished += 1
+                    elif kind == SYNC_HELLO and sync:
+                        self._synchronize(key[0], fast_sync, sync_interval)
+                now = time.time_ns()
+                if now >= next_tick:
+                    next_tick = now + tick
+                    for key in table.stale(now):
+                        self._close(key, "evicted", verbose)
+                        finished += 1
+                    for key in [k for k, t in ended.items() if now - t > table.idle]:
+                        del ended[key]
+                    self.clocks.expire({key[0] for key in peers}, now)
+        finally:
+            receiver.close()
+        return self.results
+
+    def close(self) -> None:
+        for key in list(self.table.peers):
+            self._close(key, "closed", False)
+        self.clocks.close()
+        self._udp_socket.close()
+
+
+def report_peers(results: Dict[str, dict]) -> None:
+    print("| -------------  Peers  --------------- |")
+    print(
+        "%-24s %10s %10s %12s %12s %12s %12s"
+        % ("peer", "packets", "loss", "avg", "p50", "p99", "max")
+    )
+    total = 0
+    for name in sorted(results):
+        result = results[name]
+        total += result["count"]
+        print(
+            "%-24s %10d %10f %12f %12f %12f %12f"
+            % (
+                name,
+                result["count"],
+                result["packet_loss"],
+                result["latency_avg"],
+                result["p50"],
+                result["p99"],
+                result["latency_max"],
+            )
+        )
+    print("%-24s %10d" % ("all", total))
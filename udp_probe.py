@@ -0,0 +1,395 @@
+import asyncio
+import math
+import socket
+import time
+
+from array import array
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from udp_hist import LatencyHistogram
+from udp_io import WIRE_OVERHEAD
+from udp_log import RECEIVE_SCHEMA, REFLECT_SCHEMA, MeasurementLog, write_csv
+from udp_numpy import numpy
+from udp_proto import DATA, END, HEADER, MAGIC, REFLECT, REFLECT_STAMPS, VERSION
+from udp_proto import pack_end, unpack, unpack_end
+from udp_record import is_csv, write_record
+from udp_rtt import (
+    BUFFER_SIZE,
+    END_RETRIES,
+    END_WAIT,
+    HEADER_SIZE,
+    REFLECT_MSG,
+    SEQUENCE_WINDOW,
+)
+from udp_stats import StreamingStats, histogram_percentiles, summarize, summarize_reflect
+
+
+class ProbeResult:
+    # What a finished probe measured. `status` is "complete" (the END echo
+    # came back), "stopped" (stop() or cancellation), "timeout" (echoes
+    # stopped for `idle_timeout` seconds) or "incomplete" (no END echo).
+    def __init__(
+        self,
+        summary: dict,
+        sent: int,
+        elapsed: float,
+        status: str,
+        histogram: LatencyHistogram,
+        log: Optional[MeasurementLog],
+    ) -> None:
+        self.summary = summary
+        self.sent = sent
+        self.elapsed = elapsed
+        self.status = status
+        self.histogram = histogram
+        self.log = log
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def save(self, path: str) -> None:
+        if self.log is None:
+            raise Exception("Warning: the probe kept no raw log, %s is not written" % path)
+        if is_csv(path):
+            write_csv(self.log, path)
+        else:
+            write_record(self.log, path, run={"expected": self.sent})
+
+    def __repr__(self) -> str:
+        return "ProbeResult(status=%r, sent=%d, received=%d, p50=%r, p99=%r)" % (
+            self.status,
+            self.sent,
+            self.summary.get("count", 0),
+            self.summary.get("p50"),
+            self.summary.get("p99"),
+        )
+
+
+class _ProbeProtocol(asyncio.DatagramProtocol):
+    # asyncio datagram protocol of a probe: every echo goes into the
+    # histogram, the streaming stats, the raw log and, while someone iterates
+    # samples(), into the pending batch. Created on the running loop.
+    def __init__(
+        self, schema, raw_log: bool, significant_digits: int, twamp: bool, reserve: int = 0
+    ) -> None:
+        self.schema = schema
+        self.log = MeasurementLog(schema) if raw_log else None
+        if self.log is not None:
+            self.log.reserve(reserve)
+        self.histogram = LatencyHistogram(significant_digits=significant_digits)
+        self.stats = StreamingStats(window=SEQUENCE_WINDOW)
+        self.twamp = twamp
+        self.kind = REFLECT if twamp else DATA
+        self.received = 0
+        self.expected = -1
+        self.ended: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.batch: Optional[List[array]] = None
+        self.ready: Optional[asyncio.Event] = None
+
+    def datagram_received(self, data, addr) -> None:
+        recv_time = time.time_ns()
+        kind, _, packet_index, send_time = unpack(data)
+        if kind != self.kind:
+            if kind == END and not self.ended.done():
+                self.expected = unpack_end(data)
+                self.ended.set_result(None)
+            return
+        self.received += 1
+        # Payload bytes like the other receivers; the IP and UDP headers are
+        # added once, where the bandwidth is computed
+        recv_size = len(data)
+        latency = recv_time - send_time
+        row: tuple
+        if self.twamp:
+            # Net RTT, the reflector's residence T3 - T2 taken out
+            if len(data) >= REFLECT_MSG:
+                t2, t3 = REFLECT_STAMPS.unpack_from(data, HEADER.size)
+                latency -= t3 - t2
+            else:
+                t2 = t3 = 0
+            row = (packet_index, send_time, recv_time, latency, recv_size, t2, t3)
+        else:
+            row = (packet_index, send_time, recv_time, latency, recv_size)
+        self.histogram.record(latency)
+        self.stats.update(packet_index, latency, recv_time, recv_size)
+        if self.log is not None:
+            self.log.append(*row)
+        batch = self.batch
+        if batch is not None:
+            for column, value in zip(batch, row):
+                column.append(value)
+        if self.ready is not None:
+            self.ready.set()
+
+    def error_received(self, exc) -> None:
+        # ICMP errors, e.g. no server yet on a local port; the probe goes on
+        pass
+
+    def take(self) -> Dict[str, Any]:
+        # The pending batch by column name, a fresh one starts collecting
+        batch = self.batch
+        if batch is None:
+            raise Exception("Warning: no batch is being collected")
+        self.batch = [array(code) for _, code in self.schema]
+        np = numpy()
+        return {
+            name: np.frombuffer(column, dtype=column.typecode) if np is not None else column
+            for (name, _), column in zip(self.schema, batch)
+        }
+
+
+class Probe:
+    # RTT probe against any udp_rtt.py server, run as a task on the caller's
+    # event loop: one socket, no processes. Packets are sent on absolute
+    # deadlines; after an event-loop wake-up every packet already due goes
+    # out at once, so rates above the loop's timer resolution (about 1 ms)
+    # are reached in small bursts. Receive times are taken in user space when
+    # asyncio delivers the echo.
+    #
+    #     async with Probe("10.0.0.2", frequency=1000, running_time=30) as probe:
+    #         async for batch in probe.samples(interval=1.0):
+    #             print(len(batch["latency"]), max(batch["latency"]))
+    #     print(probe.result.summary["p99"])
+    #
+    # running_time 0 probes until stop(). Several probes can share one loop,
+    # each binds its own local port (an ephemeral one by default). `reserve`
+    # rows of the raw log are allocated before the first packet.
+    def __init__(
+        self,
+        remote_ip: str = "127.0.0.1",
+        to_port: int = 20001,
+        frequency: float = 100.0,
+        packet_size: int = 64,
+        running_time: float = 10.0,
+        local_ip: str = "0.0.0.0",
+        local_port: int = 0,
+        idle_timeout: float = 5.0,
+        twamp: bool = False,
+        raw_log: bool = True,
+        significant_digits: int = 3,
+        reserve: int = 0,
+    ) -> None:
+        if packet_size < HEADER_SIZE or packet_size > 1500:
+            raise Exception(
+                "Warning: packet size is not allowed larger than 1500 bytes (MTU size)"
+            )
+        if twamp and packet_size < REFLECT_MSG + WIRE_OVERHEAD:
+            raise Exception(
+                "Warning: twamp needs packets of at least %d bytes"
+                % (REFLECT_MSG + WIRE_OVERHEAD)
+            )
+        if not math.isfinite(frequency) or frequency <= 0:
+            raise Exception("Warning: a probe needs a finite frequency")
+        self.remote_ip = remote_ip
+        self.to_port = to_port
+        self.frequency = frequency
+        self.packet_size = packet_size
+        self.running_time = running_time
+        self.local_ip = local_ip
+        self.local_port = local_port
+        self.idle_timeout = idle_timeout
+        self.twamp = twamp
+        self.raw_log = raw_log
+        self.significant_digits = significant_digits
+        self.reserve = reserve
+        self.sent = 0
+        self.result: Optional[ProbeResult] = None
+        self._protocol: Optional[_ProbeProtocol] = None
+        self._task: Optional["asyncio.Task[ProbeResult]"] = None
+        self._sending: Optional[asyncio.Task] = None
+        self._status = "complete"
+
+    async def start(self) -> "Probe":
+        await self._started()
+        return self
+
+    async def _started(self) -> Tuple[_ProbeProtocol, "asyncio.Task[ProbeResult]"]:
+        # Protocol and task of the probe, started on first use
+        if self._protocol is not None and self._task is not None:
+            return self._protocol, self._task
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFFER_SIZE)
+        sock.bind((self.local_ip, self.local_port))
+        self.local_port = sock.getsockname()[1]
+        schema = REFLECT_SCHEMA if self.twamp else RECEIVE_SCHEMA
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _ProbeProtocol(
+                schema, self.raw_log, self.significant_digits, self.twamp, self.reserve
+            ),
+            sock=sock,
+        )
+        task = loop.create_task(self._run(protocol, transport))
+        self._protocol, self._task = protocol, task
+        return protocol, task
+
+    async def _run(
+        self, protocol: _ProbeProtocol, transport: asyncio.DatagramTransport
+    ) -> ProbeResult:
+        start_time = time.monotonic()
+        sending = self._sending = asyncio.get_running_loop().create_task(
+            self._send(protocol, transport)
+        )
+        try:
+            # Idle watchdog, armed once echoes have started to arrive
+            seen = 0
+            while not sending.done():
+                await asyncio.wait([sending], timeout=self.idle_timeout or None)
+                if seen and protocol.received == seen and not sending.done():
+                    self._status = "timeout"
+                    sending.cancel()
+                seen = protocol.received
+            if not sending.cancelled():
+                sending.result()
+            elapsed = time.monotonic() - start_time
+            await self._end(protocol, transport)
+        finally:
+            sending.cancel()
+            self._close(protocol, transport)
+        self.result = self._evaluate(protocol, elapsed)
+        return self.result
+
+    async def _send(
+        self, protocol: _ProbeProtocol, transport: asyncio.DatagramTransport
+    ) -> None:
+        address = (self.remote_ip, self.to_port)
+        buffer = bytearray(self.packet_size - WIRE_OVERHEAD)
+        pack_into = HEADER.pack_into
+        kind = protocol.kind
+        period = 1e9 / self.frequency
+        total = self.frequency * self.running_time if self.running_time else math.inf
+        start = time.monotonic_ns()
+        index = 1
+        while index <= total:
+            # Everything due by now, then sleep until the next deadline
+            due = (time.monotonic_ns() - start) / period + 1
+            while index <= due and index <= total:
+                pack_into(buffer, 0, MAGIC, VERSION, kind, 0, index, time.time_ns())
+                transport.sendto(buffer, address)
+                self.sent = index
+                index += 1
+            delay = start + (index - 1) * period - time.monotonic_ns()
+            await asyncio.sleep(max(delay, 0) / 1e9)
+
+    async def _end(
+        self, protocol: _ProbeProtocol, transport: asyncio.DatagramTransport
+    ) -> None:
+        # END is repeated until its echo returns; the echoes sent before it
+        # have arrived by then unless they were reordered or lost
+        for _ in range(END_RETRIES):
+            transport.sendto(
+                pack_end(0, self.sent, time.time_ns()), (self.remote_ip, self.to_port)
+            )
+            await asyncio.wait([protocol.ended], timeout=END_WAIT)
+            if protocol.ended.done():
+                return
+        if self._status == "complete":
+            self._status = "incomplete"
+
+    def _close(
+        self, protocol: _ProbeProtocol, transport: asyncio.DatagramTransport
+    ) -> None:
+        if not protocol.ended.done() and not transport.is_closing():
+            # Cancelled before the END exchange: one END so the server does
+            # not wait for its idle timeout
+            transport.sendto(
+                pack_end(0, self.sent, time.time_ns()), (self.remote_ip, self.to_port)
+            )
+        transport.close()
+        if protocol.ready is not None:
+            protocol.ready.set()
+
+    def _evaluate(self, protocol: _ProbeProtocol, elapsed: float) -> ProbeResult:
+        expected = protocol.expected if protocol.expected >= 0 else self.sent
+        protocol.stats.expected = expected
+        if protocol.log is not None and len(protocol.log):
+            summary = summarize(protocol.log, expected)
+            if self.twamp:
+                summary.update(summarize_reflect(protocol.log))
+        else:
+            summary = protocol.stats.summary(histogram_percentiles(protocol.histogram))
+        return ProbeResult(
+            summary, self.sent, elapsed, self._status, protocol.histogram, protocol.log
+        )
+
+    async def samples(self, interval: float = 0.0) -> AsyncIterator[Dict[str, Any]]:
+        # Echoes in batches, one array per column of the receive log (numpy
+        # arrays when numpy is installed): everything that arrived since the
+        # previous batch, at most one batch per `interval` seconds. Ends with
+        # the probe; only one iterator at a time.
+        protocol, task = await self._started()
+        if protocol.batch is not None:
+            raise Exception("Warning: samples() is already being iterated")
+        ready = protocol.ready = asyncio.Event()
+        protocol.batch = [array(code) for _, code in protocol.schema]
+        try:
+            while True:
+                done = task.done()
+                if not done:
+                    await ready.wait()
+                    ready.clear()
+                    if interval > 0:
+                        await asyncio.sleep(interval)
+                batch = protocol.take()
+                if len(batch["index"]):
+                    yield batch
+                if done:
+                    return
+        finally:
+            protocol.batch = None
+            protocol.ready = None
+
+    def stop(self) -> None:
+        # Stop sending now; the END exchange and the result still follow
+        if self._sending is not None and not self._sending.done():
+            self._status = "stopped"
+            self._sending.cancel()
+
+    async def wait(self, timeout: Optional[float] = None) -> ProbeResult:
+        # The result once the probe has finished; on timeout the probe is
+        # stopped early and the result covers what was sent until then
+        _, task = await self._started()
+        try:
+            done, _ = await asyncio.wait([task], timeout=timeout)
+            if not done:
+                self.stop()
+            return await task
+        except asyncio.CancelledError:
+            # The caller was cancelled: so is the probe
+            task.cancel()
+            raise
+
+    async def close(self) -> None:
+        # Cancels a probe that is still running
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.wait([self._task])
+
+    async def __aenter__(self) -> "Probe":
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            await self.wait()
+        else:
+            await self.close()
+
+
+async def run_probe(
+    remote_ip: str = "127.0.0.1",
+    to_port: int = 20001,
+    frequency: float = 100.0,
+    packet_size: int = 64,
+    running_time: float = 10.0,
+    timeout: Optional[float] = None,
+    **options,
+) -> ProbeResult:
+    # One probe from start to result; `timeout` bounds the whole run (the
+    # result then covers what was sent until it expired), the other options
+    # are those of Probe
+    probe = Probe(remote_ip, to_port, frequency, packet_size, running_time, **options)
+    try:
+        return await probe.wait(timeout)
+    finally:
+        await probe.close()
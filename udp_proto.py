@@ -0,0 +1,109 @@
+import struct
+
+from typing import List, Sequence, Tuple
+
+# Every datagram starts with the same header:
+# magic, version, message type, flow id, sequence number, timestamp (ns)
+HEADER = struct.Struct("!HBBIIQ")
+MAGIC = 0x5544
+VERSION = 1
+
+DATA = 1
+START = 2
+START_ACK = 3
+END = 4
+END_ACK = 5
+SYNC_REQUEST = 6
+SYNC_REPLY = 7
+SYNC_READY = 8
+# Client waiting to be synchronized, a multi-client server starts on this
+SYNC_HELLO = 9
+# udp_rtt DATA with four timestamps (TWAMP-light style): the echo keeps the
+# client's send time in the header and adds the reflector's own times
+REFLECT = 10
+
+# START: planned rate (pps), packet size, running time (s), then optional
+# flags telling the receiver what else the client sends
+_START = struct.Struct("!dId")
+_START_FLAGS = struct.Struct("!I")
+# DATA and END payloads carry follow-ups
+TX_FOLLOW_UP = 1
+# END: number of data packets sent
+_END = struct.Struct("!Q")
+# Follow-up, like two-step PTP: the kernel TX timestamp of an earlier DATA
+# packet (sequence number, 0 for none), known only after it was sent
+FOLLOW_UP = struct.Struct("!IQ")
+# SYNC_REPLY: receive and transmit time of the request at the responder
+_SYNC_REPLY = struct.Struct("!QQ")
+# REFLECT payload: receive and transmit time at the reflector, zero until
+# reflected (a reflector that does not know REFLECT leaves them zero)
+REFLECT_STAMPS = struct.Struct("!QQ")
+
+
+def pack(kind: int, flow: int = 0, sequence: int = 0, timestamp: int = 0) -> bytes:
+    return HEADER.pack(MAGIC, VERSION, kind, flow, sequence, timestamp)
+
+
+def unpack(data) -> Tuple[int, int, int, int]:
+    # (type, flow, sequence, timestamp); type 0 for anything that is not ours
+    if len(data) < HEADER.size:
+        return 0, 0, 0, 0
+    magic, version, kind, flow, sequence, timestamp = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return 0, 0, 0, 0
+    return kind, flow, sequence, timestamp
+
+
+def pack_start(
+    flow: int, rate: float, size: int, duration: float, now: int, flags: int = 0
+) -> bytes:
+    return (
+        pack(START, flow, 0, now)
+        + _START.pack(rate, size, duration)
+        + _START_FLAGS.pack(flags)
+    )
+
+
+def unpack_start(data) -> Tuple[float, int, float]:
+    return _START.unpack_from(data, HEADER.size)
+
+
+def start_flags(data) -> int:
+    # 0 for clients that send no flags
+    offset = HEADER.size + _START.size
+    if len(data) < offset + _START_FLAGS.size:
+        return 0
+    return _START_FLAGS.unpack_from(data, offset)[0]
+
+
+def pack_end(
+    flow: int, sent: int, now: int, follow_ups: Sequence[Tuple[int, int]] = ()
+) -> bytes:
+    return (
+        pack(END, flow, 0, now)
+        + _END.pack(sent)
+        + b"".join(FOLLOW_UP.pack(index, stamp) for index, stamp in follow_ups)
+    )
+
+
+def unpack_end(data) -> int:
+    if len(data) < HEADER.size + _END.size:
+        return 0
+    return _END.unpack_from(data, HEADER.size)[0]
+
+
+def end_follow_ups(data, size: int) -> List[Tuple[int, int]]:
+    # Follow-ups the client had left when it ended, `size` bytes received
+    start = HEADER.size + _END.size
+    return [
+        FOLLOW_UP.unpack_from(data, offset)
+        for offset in range(start, size - FOLLOW_UP.size + 1, FOLLOW_UP.size)
+    ]
+
+
+def pack_sync_reply(t1: int, t2: int, t3: int) -> bytes:
+    return pack(SYNC_REPLY, 0, 0, t1) + _SYNC_REPLY.pack(t2, t3)
+
+
+def unpack_sync_reply(data) -> Tuple[int, int]:
+    return _SYNC_REPLY.unpack_from(data, HEADER.size)
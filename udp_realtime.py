@@ -0,0 +1,140 @@
+import ctypes
+import gc
+import os
+
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from udp_io import open_libc
+
+# mlockall() flags: everything mapped now and everything mapped later
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+FIFO_PRIORITY = 50
+
+
+def parse_cpus(value: str) -> List[int]:
+    # "2", "2,3" or "2-5,8"
+    cpus: List[int] = []
+    for item in value.split(","):
+        if not item:
+            continue
+        first, _, last = item.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class Realtime:
+    # Run-time settings for a measurement's hot loop, used as a context
+    # manager: pin to `cpus`, SCHED_FIFO at `fifo` (0 keeps the normal
+    # scheduler), lock all memory with `mlock`, and no garbage collection
+    # inside. Whatever the kernel refuses is left as it was; `applied` says
+    # what actually took effect. Everything is undone on exit, so the
+    # evaluation after a run does not keep a core or RT priority.
+    def __init__(self, cpus: Sequence[int] = (), fifo: int = 0, mlock: bool = False) -> None:
+        self.cpus = list(cpus)
+        self.fifo = fifo
+        self.mlock = mlock
+        self.applied: Dict[str, Any] = {}
+        self._affinity: Optional[set] = None
+        self._policy: Optional[int] = None
+        self._priority = 0
+        self._libc: Optional[ctypes.CDLL] = None
+        self._gc = False
+
+    @classmethod
+    def parse(cls, spec: str) -> "Realtime":
+        # <cores>[:fifo[=<priority>]][:mlock], cores may be empty
+        cpus, *flags = spec.split(":")
+        fifo = 0
+        mlock = False
+        for flag in flags:
+            name, _, value = flag.partition("=")
+            if name == "fifo":
+                fifo = int(value or FIFO_PRIORITY)
+            elif name == "mlock":
+                mlock = True
+            elif name:
+                raise Exception("Warning: unknown --realtime setting %s" % flag)
+        return cls(parse_cpus(cpus), fifo, mlock)
+
+    def role(self, i: int) -> "Realtime":
+        # The same settings pinned to the i-th core only (cycling), for the
+        # processes of one tool that should not share a core
+        cpus = [self.cpus[i % len(self.cpus)]] if self.cpus else []
+        return Realtime(cpus, self.fifo, self.mlock)
+
+    def __enter__(self) -> "Realtime":
+        applied = self.applied = {}
+        if self.cpus:
+            try:
+                self._affinity = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, self.cpus)
+                applied["cpus"] = sorted(os.sched_getaffinity(0))
+            except (OSError, ValueError) as e:
+                self._affinity = None
+                applied["cpus"] = "not pinned (%s)" % e
+        if self.fifo:
+            try:
+                self._policy = os.sched_getscheduler(0)
+                self._priority = os.sched_getparam(0).sched_priority
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.fifo))
+                applied["sched"] = "fifo:%d" % os.sched_getparam(0).sched_priority
+            except (OSError, AttributeError) as e:
+                self._policy = None
+                applied["sched"] = "other (%s)" % e
+        if self.mlock:
+            applied["mlock"] = self._mlockall()
+        # Collect once now, then keep every surviving object out of later
+        # collections and switch the collector off for the run
+        gc.collect()
+        gc.freeze()
+        self._gc = gc.isenabled()
+        gc.disable()
+        applied["gc"] = "off (%d objects frozen)" % gc.get_freeze_count()
+        return self
+
+    def _mlockall(self) -> str:
+        libc = open_libc()
+        if libc is None:
+            return "no (libc not found)"
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            return "no (%s)" % os.strerror(ctypes.get_errno())
+        self._libc = libc
+        return "yes"
+
+    def __exit__(self, *exc) -> None:
+        if self._gc:
+            gc.enable()
+        gc.unfreeze()
+        if self._libc is not None:
+            self._libc.munlockall()
+            self._libc = None
+        if self._policy is not None:
+            try:
+                os.sched_setscheduler(0, self._policy, os.sched_param(self._priority))
+            except OSError:
+                pass
+            self._policy = None
+        if self._affinity is not None:
+            os.sched_setaffinity(0, self._affinity)
+            self._affinity = None
+
+    def call(self, func: Callable, *args) -> Any:
+        # Process target: run func under these settings and report them
+        with self:
+            result = func(*args)
+        report_realtime(self.applied)
+        return result
+
+
+def describe(applied: Dict[str, Any]) -> str:
+    # "cpus 2  sched fifo:50  mlock yes  gc off (... objects frozen)"
+    return "  ".join(
+        "%s %s" % (name, ",".join(map(str, value)) if isinstance(value, list) else value)
+        for name, value in applied.items()
+    )
+
+
+def report_realtime(applied: Dict[str, Any]) -> None:
+    if applied:
+        print("Realtime: %s" % describe(applied))
@@ -0,0 +1,264 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from array import array
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from udp_log import MeasurementLog, write_csv
+from udp_numpy import numpy
+
+
+# File layout: a HEADER_BYTES block (prefix + JSON, zero padded) followed by
+# fixed-width rows of little-endian int64 columns, in the log's schema order.
+MAGIC = b"UDPL"
+VERSION = 1
+HEADER_BYTES = 4096
+_PREFIX = struct.Struct("<4sHHI")
+_ITEM = 8
+
+
+def is_csv(path: str) -> bool:
+    return path.lower().endswith(".csv")
+
+
+def _column_bytes(column: array, n: int) -> memoryview:
+    if sys.byteorder == "big":
+        column = array(column.typecode, column[:n])
+        column.byteswap()
+    return memoryview(column).cast("B")[: n * _ITEM]
+
+
+def _scatter(dest, base: int, data: memoryview, c: int, ncols: int, n: int) -> None:
+    # Copy one column into every row of dest with one strided slice per byte
+    stride = ncols * _ITEM
+    end = base + n * stride
+    for b in range(_ITEM):
+        dest[base + c * _ITEM + b : end : stride] = data[b::_ITEM].tobytes()
+
+
+def _gather(src, base: int, c: int, ncols: int, n: int) -> array:
+    stride = ncols * _ITEM
+    end = base + n * stride
+    out = bytearray(n * _ITEM)
+    for b in range(_ITEM):
+        out[b::_ITEM] = src[base + c * _ITEM + b : end : stride]
+    column = array("q")
+    column.frombytes(out)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def _header(names: Sequence[str], fields: dict) -> bytes:
+    # json (and re behind it) is only needed once a record is written or read
+    import json
+
+    body = json.dumps(dict(fields, schema=list(names))).encode()
+    if _PREFIX.size + len(body) > HEADER_BYTES:
+        raise Exception("Warning: record header is larger than %d bytes" % HEADER_BYTES)
+    prefix = _PREFIX.pack(MAGIC, VERSION, 0, len(body))
+    return (prefix + body).ljust(HEADER_BYTES, b"\0")
+
+
+class RecordWriter:
+    # Streams a MeasurementLog to disk while it is being filled: a background
+    # thread appends every sealed chunk as rows, the header is rewritten with
+    # the final row count, clock model and run on close(). `params` are the
+    # command-line options of the side that records; `run` is what the
+    # sender announced (rate, size, duration and the expected packet count).
+    def __init__(
+        self,
+        path: str,
+        log: MeasurementLog,
+        params: Optional[dict] = None,
+        interval: float = 0.5,
+    ) -> None:
+        self.path = path
+        self.log = log
+        self.params = params or {}
+        self.interval = interval
+        self.rows = 0
+        self._written = 0
+        self._fields = {"params": self.params, "created": time.time_ns()}
+        self._file = open(path, "w+b")
+        self._file.write(self._header(complete=False))
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _header(self, complete: bool, clock=None, run=None) -> bytes:
+        fields = dict(
+            self._fields, rows=self.rows, complete=complete, clock=clock, run=run or {}
+        )
+        return _header(self.log.names, fields)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._write_sealed()
+
+    def _write_sealed(self) -> None:
+        for j in range(self._written, self.log.sealed()):
+            self._write_chunk(j, self.log.chunk_size)
+            self._written = j + 1
+        self._file.flush()
+
+    def _write_chunk(self, j: int, n: int) -> None:
+        if not n:
+            return
+        ncols = len(self.log.names)
+        rows = bytearray(n * ncols * _ITEM)
+        for c in range(ncols):
+            _scatter(rows, 0, _column_bytes(self.log.chunk(c, j), n), c, ncols, n)
+        self._file.write(rows)
+        self.rows += n
+
+    def close(
+        self,
+        clock: Optional[Tuple[float, float, int]] = None,
+        rewrite: Iterable[str] = (),
+        run: Optional[dict] = None,
+    ) -> None:
+        # `rewrite` names columns changed in memory after they were streamed
+        # (e.g. the final clock correction of "latency")
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write_sealed()
+        remaining = len(self.log) - self._written * self.log.chunk_size
+        self._write_chunk(self._written, remaining)
+        self._file.flush()
+        rewrite = list(rewrite)
+        if rewrite and self.rows:
+            self._rewrite(rewrite)
+        self._file.seek(0)
+        self._file.write(self._header(True, list(clock) if clock else None, run))
+        self._file.close()
+
+    def _rewrite(self, names: Sequence[str]) -> None:
+        ncols = len(self.log.names)
+        stride = ncols * _ITEM
+        with mmap.mmap(self._file.fileno(), HEADER_BYTES + self.rows * stride) as mm:
+            for name in names:
+                c = self.log.names.index(name)
+                base = HEADER_BYTES
+                for column, n in self.log.chunks(name):
+                    _scatter(mm, base, _column_bytes(column, n), c, ncols, n)
+                    base += n * stride
+
+
+def write_record(
+    log: MeasurementLog,
+    path: str,
+    params: Optional[dict] = None,
+    clock: Optional[Tuple[float, float, int]] = None,
+    run: Optional[dict] = None,
+) -> None:
+    RecordWriter(path, log, params).close(clock, run=run)
+
+
+class RecordFile:
+    # Read side, memory-mapped: columns are numpy.memmap views when numpy is
+    # available. Rows past the header's count (a run that did not finish)
+    # are still read, up to the last complete row in the file.
+    def __init__(self, path: str) -> None:
+        import json
+
+        self.path = path
+        with open(path, "rb") as f:
+            head = f.read(HEADER_BYTES)
+            size = os.fstat(f.fileno()).st_size
+        if len(head) < _PREFIX.size:
+            raise Exception("Warning: %s is not a udp-latency record" % path)
+        magic, version, _, length = _PREFIX.unpack_from(head)
+        if magic != MAGIC or version > VERSION:
+            raise Exception("Warning: %s is not a udp-latency record" % path)
+        self.header = json.loads(head[_PREFIX.size : _PREFIX.size + length])
+        self.names = self.header["schema"]
+        self.params = self.header.get("params", {})
+        self.run = self.header.get("run") or {}
+        self.clock = self.header.get("clock")
+        self.complete = self.header.get("complete", False)
+        self._stride = len(self.names) * _ITEM
+        self._rows = max(size - HEADER_BYTES, 0) // self._stride
+        self._file = open(path, "rb")
+        self._map = None
+        self._memmap = None
+        if self._rows:
+            np = numpy()
+            if np is not None:
+                dtype = np.dtype([(name, "<i8") for name in self.names])
+                self._memmap = np.memmap(
+                    self._file,
+                    dtype=dtype,
+                    mode="r",
+                    offset=HEADER_BYTES,
+                    shape=(self._rows,),
+                )
+            else:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def column(self, name: str):
+        c = self.names.index(name)
+        if not self._rows:
+            np = numpy()
+            return np.empty(0, dtype=np.int64) if np is not None else array("q")
+        if self._memmap is not None:
+            return self._memmap[name]
+        return _gather(self._map, HEADER_BYTES, c, len(self.names), self._rows)
+
+    def rows(self):
+        return zip(*(self.column(name) for name in self.names))
+
+    def close(self) -> None:
+        self._memmap = None
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self) -> "RecordFile":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def export_csv(path: str, csv_path: str) -> None:
+    with RecordFile(path) as record:
+        write_csv(record, csv_path)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import json
+
+    from udp_stats import report, summarize
+
+    paths = sys.argv[1:] if argv is None else argv
+    if len(paths) not in (1, 2):
+        print("Usage --> udp_record.py <record path> [<csv saving path>]")
+        sys.exit(2)
+    if len(paths) == 2:
+        export_csv(paths[0], paths[1])
+        sys.exit(0)
+    with RecordFile(paths[0]) as _record:
+        print("Parameters: %s" % json.dumps(_record.params, sort_keys=True))
+        if _record.run:
+            print("Run: %s" % json.dumps(_record.run, sort_keys=True))
+        if _record.clock:
+            print("Clock offset: %f second" % (_record.clock[0] * 1e-9))
+        if not _record.complete:
+            print("Record is incomplete, %d rows were recovered" % len(_record))
+        report(summarize(_record, int(_record.run.get("expected") or 0)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+from typing import Optional
+
+from udp_hist import LatencyHistogram
+
+
+class _Interval:
+    def __init__(self, significant_digits: int) -> None:
+        self.histogram = LatencyHistogram(significant_digits=significant_digits)
+        self.packets = 0
+        self.bytes = 0
+        self.highest = 0
+
+    def reset(self) -> None:
+        self.histogram.reset()
+        self.packets = 0
+        self.bytes = 0
+        self.highest = 0
+
+
+class IntervalReporter:
+    # Per-interval counters and a fixed-size latency histogram are updated by
+    # the receive loop; a daemon thread swaps the double buffer and prints, so
+    # the hot path never touches stdout.
+    def __init__(
+        self,
+        interval: float,
+        packet_overhead: int = 20 + 8,
+        significant_digits: int = 2,
+    ) -> None:
+        self.interval = interval
+        self.packet_overhead = packet_overhead
+        self._current = _Interval(significant_digits)
+        self._spare = _Interval(significant_digits)
+        self._highest = 0
+        self._busy = False
+        self._start = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, index: int, latency: int, size: int) -> None:
+        # _busy brackets the read of _current and the updates, so _swap() can
+        # tell when no update to the old buffer is still in flight
+        self._busy = True
+        current = self._current
+        current.histogram.record(latency)
+        current.packets += 1
+        current.bytes += size
+        if index > current.highest:
+            current.highest = index
+        self._busy = False
+
+    def start(self) -> None:
+        self._start = time.monotonic_ns()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        begin = self._start
+        deadline = begin
+        while True:
+            deadline += int(self.interval * 1e9)
+            stopped = self._stop.wait(max(deadline - time.monotonic_ns(), 0) * 1e-9)
+            end = time.monotonic_ns()
+            self._print(self._swap(), begin, end)
+            begin = end
+            if stopped:
+                break
+
+    def _swap(self) -> _Interval:
+        done = self._current
+        self._spare.reset()
+        self._current = self._spare
+        self._spare = done
+        # A record() that started before the swap may still write to the old
+        # buffer; any record() that starts now sees the new one
+        while self._busy:
+            time.sleep(0)
+        return done
+
+    def _print(self, done: _Interval, begin: int, end: int) -> None:
+        elapsed = max(end - begin, 1) * 1e-9
+        highest = max(done.highest, self._highest)
+        expected = highest - self._highest
+        self._highest = highest
+        loss = (expected - done.packets) / expected if expected > 0 else 0.0
+        p50, p99 = done.histogram.percentiles((50, 99))
+        print(
+            "[  %6.2f-%6.2f sec  |  %9.1f pps  |  %9.3f Mbits  |  Loss: %f  |  p50: %f  p99: %f  max: %f  ]"
+            % (
+                (begin - self._start) * 1e-9,
+                (end - self._start) * 1e-9,
+                done.packets / elapsed,
+                (done.bytes + self.packet_overhead * done.packets) * 8 / elapsed / 1e6,
+                max(loss, 0.0),
+                p50 * 1e-9,
+                p99 * 1e-9,
+                done.histogram.max * 1e-9,
+            ),
+            flush=True,
+        )
@@ -0,0 +1,187 @@
+import os
+import platform
+import struct
+import time
+
+from multiprocessing import Semaphore, shared_memory
+from typing import List, Optional, Tuple
+
+# Every slot is 16 bytes, by default two signed 64-bit words
+SLOT_SIZE = 16
+SLOT = struct.Struct("=qq")
+RING_SLOTS = 1 << 16
+# Empty polls before the consumer sleeps on the semaphore; spinning only
+# steals the producer's time slice on a single CPU
+SPIN = 2000 if (os.cpu_count() or 1) > 1 else 0
+# Longest sleep of a blocked consumer, bounds the cost of a missed wake-up
+BLOCK = 0.001
+# The producer's and the consumer's counters live on separate cache lines:
+# words 0-1 are written by the producer, words 8-9 by the consumer (the
+# producer only clears the waiting flag when it wakes the consumer)
+_HEAD, _CLOSED, _TAIL, _WAITING = 0, 1, 8, 9
+_CONTROL = 128
+# The counters are published with plain stores and read without barriers.
+# That is only correct where stores become visible in program order (x86
+# TSO); ARM and POWER may show the new head before the slot it covers, so
+# the ring refuses to run there and the callers hand off by queue
+ORDERED = platform.machine().lower() in ("x86_64", "amd64", "i386", "i686", "x86")
+
+
+class Ring:
+    # Lock-free single-producer / single-consumer ring of fixed 16-byte slots
+    # on multiprocessing.shared_memory. The producer writes a slot and then
+    # publishes the new head; the consumer reads the slots up to head and
+    # publishes the new tail. Each counter has a single writer, so no lock is
+    # taken on the data path, this relies on stores becoming visible in
+    # program order (x86 TSO, see ORDERED). An idle consumer spins SPIN polls and then
+    # sleeps on a semaphore that the producer only touches while the consumer
+    # has flagged itself waiting.
+    #
+    # Create it in the parent and pass it to the child Process; one process
+    # only put()s and finish()es, the other only get_batch()es.
+    def __init__(self, capacity: int = RING_SLOTS, slot: struct.Struct = SLOT) -> None:
+        if not ORDERED:
+            raise Exception(
+                "Warning: the ring needs x86 store ordering, not %s" % platform.machine()
+            )
+        if slot.size != SLOT_SIZE:
+            raise Exception("Warning: ring slots are %d bytes" % SLOT_SIZE)
+        if capacity & (capacity - 1):
+            raise Exception("Warning: ring capacity must be a power of two")
+        self.capacity = capacity
+        self.slot = slot
+        self._owner = os.getpid()
+        self._wake = Semaphore(0)
+        self._attach(
+            shared_memory.SharedMemory(create=True, size=_CONTROL + capacity * SLOT_SIZE),
+            clear=True,
+        )
+
+    def _attach(self, shm: shared_memory.SharedMemory, clear: bool = False) -> None:
+        buf = shm.buf
+        if buf is None:
+            raise Exception("Warning: ring %s is already closed" % shm.name)
+        if clear:
+            buf[:_CONTROL] = bytes(_CONTROL)
+        self._shm: Optional[shared_memory.SharedMemory] = shm
+        self._counters = buf[:_CONTROL].cast("q")
+        self._slots = buf[_CONTROL:]
+        self._mask = self.capacity - 1
+        # Local copies of this side's own counter and of the other side's
+        # counter as last read
+        self._head = self._counters[_HEAD]
+        self._tail = self._counters[_TAIL]
+
+    def __getstate__(self) -> dict:
+        # Only used by spawn / forkserver start methods; fork inherits the map
+        if self._shm is None:
+            raise Exception("Warning: a closed ring cannot be passed to a process")
+        return {
+            "name": self._shm.name,
+            "capacity": self.capacity,
+            "format": self.slot.format,
+            "owner": self._owner,
+            "wake": self._wake,
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        self.capacity = state["capacity"]
+        self.slot = struct.Struct(state["format"])
+        self._owner = state["owner"]
+        self._wake = state["wake"]
+        self._attach(shared_memory.SharedMemory(name=state["name"]))
+
+    # ---------- Producer ----------
+
+    def put(self, *values) -> None:
+        head = self._head
+        if head - self._tail >= self.capacity:
+            self._wait_space(head)
+        self.slot.pack_into(self._slots, (head & self._mask) * SLOT_SIZE, *values)
+        head += 1
+        self._head = head
+        counters = self._counters
+        counters[_HEAD] = head
+        if counters[_WAITING]:
+            counters[_WAITING] = 0
+            self._wake.release()
+
+    def _wait_space(self, head: int) -> None:
+        # Full: the consumer is behind, back off until it frees a slot
+        counters = self._counters
+        delay = 0.0
+        while head - counters[_TAIL] >= self.capacity:
+            time.sleep(delay)
+            delay = min(delay * 2 or 1e-6, BLOCK)
+        self._tail = counters[_TAIL]
+
+    def finish(self) -> None:
+        # End of stream: get_batch() returns [] once the rest is consumed
+        self._counters[_CLOSED] = 1
+        self._wake.release()
+
+    # ---------- Consumer ----------
+
+    def get_batch(self, limit: int = 0) -> List[Tuple]:
+        # Every queued slot (at most `limit` when set), waits while the ring
+        # is empty; [] after finish() and the last slot
+        counters = self._counters
+        tail = self._tail
+        spins = 0
+        while True:
+            head = counters[_HEAD]
+            if head != tail:
+                break
+            if counters[_CLOSED]:
+                # Slots published before finish() are still returned
+                if counters[_HEAD] == tail:
+                    return []
+                continue
+            spins += 1
+            if spins < SPIN:
+                continue
+            counters[_WAITING] = 1
+            if counters[_HEAD] == tail and not counters[_CLOSED]:
+                self._wake.acquire(timeout=BLOCK)
+            counters[_WAITING] = 0
+        if limit and head - tail > limit:
+            head = tail + limit
+        # One contiguous run per call, the rest is returned by the next one
+        start = tail & self._mask
+        end = min(start + head - tail, self.capacity)
+        run = self._slots[start * SLOT_SIZE : end * SLOT_SIZE]
+        items = list(self.slot.iter_unpack(run))
+        run.release()
+        tail += end - start
+        self._tail = tail
+        counters[_TAIL] = tail
+        return items
+
+    def empty(self) -> bool:
+        return self._counters[_HEAD] == self._tail
+
+    def finished(self) -> bool:
+        return bool(self._counters[_CLOSED])
+
+    def close(self) -> None:
+        # Unmaps this process's view; the creating process also removes the block
+        shm = self._shm
+        if shm is None:
+            return
+        self._counters.release()
+        self._slots.release()
+        shm.close()
+        if os.getpid() == self._owner:
+            shm.unlink()
+        self._shm = None
+
+
+def open_ring(capacity: int = RING_SLOTS, slot: struct.Struct = SLOT) -> Optional[Ring]:
+    # None where POSIX shared memory is unavailable or the host is not x86,
+    # callers fall back to a Queue
+    if not ORDERED:
+        return None
+    try:
+        return Ring(capacity, slot)
+    except OSError:
+        return None
@@ -1,14 +1,67 @@
 import socket
+import select
 import time
 import math
-import csv
 import sys
-import getopt
-from multiprocessing import Process, Queue
-from typing import Any, Optional, List, Union
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, List, Optional
 
-HEADER_SIZE = 32 + 4 + 8
+from udp_hist import LatencyHistogram
+from udp_io import WIRE_OVERHEAD, BatchReceiver, BatchSender, RateMeter
+from udp_log import (
+    RECEIVE_SCHEMA,
+    REFLECT_SCHEMA,
+    SEND_SCHEMA,
+    MeasurementLog,
+    write_csv,
+)
+from udp_pacing import Pacer
+from udp_proto import (
+    DATA,
+    END,
+    HEADER,
+    MAGIC,
+    REFLECT,
+    REFLECT_STAMPS,
+    VERSION,
+    pack_end,
+    unpack,
+    unpack_end,
+)
+from udp_record import RecordWriter, is_csv, write_record
+from udp_report import IntervalReporter
+from udp_stats import (
+    StreamingStats,
+    histogram_percentiles,
+    report,
+    report_reflect,
+    report_schedule,
+    summarize,
+    summarize_reflect,
+    summarize_schedule,
+)
+
+if TYPE_CHECKING:
+    from asyncio import DatagramTransport
+    from multiprocessing import Process, Queue
+
+    from udp_probe import Probe, ProbeResult
+    from udp_realtime import Realtime
+    from udp_ring import Ring
+
+HEADER_SIZE = WIRE_OVERHEAD + HEADER.size
+# Smallest datagram that has room for the reflector's two timestamps
+REFLECT_MSG = HEADER.size + REFLECT_STAMPS.size
 BUFFER_SIZE = 3_000_000
+SEQUENCE_WINDOW = 1 << 16
+# Ring slots of the process engine that are not a DATA echo: the echo waits
+# in the queue, or the next slot holds the times of a REFLECT
+ESCAPE = -(1 << 63)
+STAMPED = ESCAPE + 1
+MASK32 = (1 << 32) - 1
+# END is repeated every END_WAIT seconds until its echo returns
+END_RETRIES = 20
+END_WAIT = 0.05
 
 
 class Client:
@@ -23,9 +76,16 @@ class Client:
         self.local_port = local_port
         self.remote_ip = remote_ip
         self.to_port = to_port
-        self.send_log: List[List[Union[int, float]]] = []
-        self.receive_log: List[List[Union[int, float]]] = []
+        self.send_log = MeasurementLog(SEND_SCHEMA)
+        self.receive_log = MeasurementLog(RECEIVE_SCHEMA)
+        self.histogram = LatencyHistogram()
+        self.stats = StreamingStats(window=SEQUENCE_WINDOW)
         self.packet_index = 1
+        self.expected = 0
+        self.record_path: Optional[str] = None
+        # Rows allocated in the logs before the first packet (--realtime)
+        self.prefault = 0
+        self._twamp = False
 
         self._udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         self._udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFFER_SIZE)
@@ -37,27 +97,50 @@ class Client:
         packet_size: int,
         running_time: int,
         dyna: bool,
-        q: Queue,
+        q: "Queue",
+        batch: int = 1,
+        pacing: str = "deadline",
+        ring: Optional["Ring"] = None,
+        twamp: bool = False,
     ) -> None:
         if packet_size < HEADER_SIZE or packet_size > 1500:
             raise Exception(
                 "Warning: packet size is not allowed larger than 1500 bytes (MTU size)"
             )
+        _check_twamp(packet_size, twamp)
+        self.send_log.reserve(self.prefault)
 
-        _payload_size = packet_size - HEADER_SIZE
+        sender = BatchSender(
+            self._udp_socket,
+            (self.remote_ip, self.to_port),
+            packet_size - WIRE_OVERHEAD,
+            batch,
+            kind=REFLECT if twamp else DATA,
+        )
+        pacer = Pacer(sender.batch / frequency * 1e9) if math.isfinite(frequency) else None
+        meter = RateMeter(frequency, packet_size)
 
+        append = self.send_log.append
         start_time = time.time_ns()
         total_packets = frequency * running_time
         running_time = running_time * int(1e9)
-        period = 1 / frequency
-        _fill = b"".join([b"\x00"] * (_payload_size))
+        period = sender.batch / frequency
+        burst = 0
+        error = 0
 
+        if pacer:
+            pacer.begin()
         while True:
-            index_bytes = self.packet_index.to_bytes(4, "big")
+            count = int(min(sender.batch, total_packets - self.packet_index + 1))
+            if pacer:
+                error = pacer.wait(burst) if pacing == "deadline" else pacer.error(burst)
+                burst += 1
             current_time = time.time_ns()
-            msg = index_bytes + current_time.to_bytes(8, "big") + _fill
-            send_nums = self._udp_socket.sendto(msg, (self.remote_ip, self.to_port))
-            self.send_log.append([self.packet_index, current_time, send_nums])
+            send_nums = sender.send(self.packet_index, count, current_time) // count
+            for i in range(self.packet_index, self.packet_index + count):
+                append(i, current_time, send_nums, error)
+            meter.add(count)
+            self.packet_index += count - 1
 
             if (
                 current_time - start_time
@@ -65,6 +148,9 @@ class Client:
                 break
             self.packet_index += 1
 
+            if pacing == "deadline":
+                continue
+
             if dyna:
                 prac_period = (
                     (running_time - (current_time - start_time))
@@ -73,6 +159,7 @@ class Client:
                         len(self.send_log)
                         / (frequency * (current_time - start_time) * 1e-9)
                     )
+                    * sender.batch
                     * 1e-9
                 )
                 prac_period = period if prac_period > period else prac_period
@@ -82,86 +169,480 @@ class Client:
             time.sleep(prac_period)
             # time.sleep(period)
 
-        while q.empty():
-            self._udp_socket.sendto(
-                (0).to_bytes(4, "big"), (self.remote_ip, self.to_port)
-            )
-            time.sleep(0.05)
+        meter.stop()
+        sender.close()
+        # The listener stops on the echoed END, or after its idle timeout
+        finished = ring.finished if ring is not None else lambda: not q.empty()
+        packet = pack_end(0, len(self.send_log), time.time_ns())
+        for _ in range(END_RETRIES):
+            if finished():
+                break
+            self._udp_socket.sendto(packet, (self.remote_ip, self.to_port))
+            time.sleep(END_WAIT)
+        if not finished():
+            print("No END echo from the server, %d packets were sent" % len(self.send_log))
+            # Our own END on the listener's socket stops it, also when its
+            # idle timeout is off
+            local_ip = "127.0.0.1" if self.local_ip == "0.0.0.0" else self.local_ip
+            self._udp_socket.sendto(packet, (local_ip, self.local_port))
         self._udp_socket.close()
+        meter.report()
+        if pacer:
+            report_schedule(summarize_schedule(self.send_log))
+        return meter.summary()
 
     def listen(
-        self, buffer_size: int, verbose: bool, save: Optional[str], q: Queue
+        self,
+        buffer_size: int,
+        verbose: bool,
+        save: Optional[str],
+        q: "Queue",
+        batch: int = 1,
+        kernel_ts: bool = True,
+        interval: float = 0,
+        raw_log: bool = True,
+        significant_digits: int = 3,
+        hist: Optional[str] = None,
+        params: Optional[dict] = None,
+        timeout: float = 5.0,
+        ring: Optional["Ring"] = None,
+        twamp: bool = False,
     ) -> None:
-        latency = 0.0
-        while True:
-            msg, _ = self._udp_socket.recvfrom(buffer_size)
-            recv_time = time.time_ns()
-            packet_index = int.from_bytes(msg[:4], "big")
-            send_time = int.from_bytes(msg[4:12], "big")
+        self._open_receiver(
+            buffer_size,
+            verbose,
+            batch,
+            kernel_ts,
+            interval,
+            raw_log,
+            significant_digits,
+            save,
+            params,
+            timeout,
+            twamp,
+        )
+        while self._drain():
+            pass
+        self._close_receiver()
 
-            old_latency = latency
-            latency = round((recv_time - send_time) * 1e-9, 6)
-            jitter = abs(latency - old_latency)
-            recv_size = len(msg)
-            if packet_index == 0:
-                break
-            self.receive_log.append(
-                [packet_index, latency, jitter, recv_time, recv_size]
+        self.evaluate()
+
+        if save:
+            self.save(save)
+        if hist:
+            self.histogram.save(hist)
+        if ring is not None:
+            ring.finish()
+        else:
+            q.put(0)
+
+    def run(
+        self,
+        frequency: float,
+        packet_size: int,
+        running_time: int,
+        buffer_size: int,
+        verbose: bool,
+        save: Optional[str],
+        batch: int = 1,
+        pacing: str = "deadline",
+        kernel_ts: bool = True,
+        interval: float = 0,
+        raw_log: bool = True,
+        significant_digits: int = 3,
+        hist: Optional[str] = None,
+        params: Optional[dict] = None,
+        timeout: float = 5.0,
+        twamp: bool = False,
+    ):
+        # Single-process engine: echoes are drained with poll() while the
+        # sender waits for its next deadline, no Process / Queue hand-off.
+        if packet_size < HEADER_SIZE or packet_size > 1500:
+            raise Exception(
+                "Warning: packet size is not allowed larger than 1500 bytes (MTU size)"
             )
+        _check_twamp(packet_size, twamp)
+        self.send_log.reserve(self.prefault)
 
-            if verbose:
-                print(
-                    "[  Server: %d  |  Packet: %6d  |  Latency: %f ｜ Jitter: %f |  Data size: %4d  ]"
-                    % (self.local_port, packet_index, latency, jitter, recv_size)
-                )
+        self._open_receiver(
+            buffer_size,
+            verbose,
+            batch,
+            kernel_ts,
+            interval,
+            raw_log,
+            significant_digits,
+            save,
+            params,
+            timeout,
+            twamp,
+        )
+        poller = select.poll()
+        poller.register(self._udp_socket, select.POLLIN)
+        sender = BatchSender(
+            self._udp_socket,
+            (self.remote_ip, self.to_port),
+            packet_size - WIRE_OVERHEAD,
+            batch,
+            kind=REFLECT if twamp else DATA,
+        )
+        pacer = Pacer(sender.batch / frequency * 1e9) if math.isfinite(frequency) else None
+        meter = RateMeter(frequency, packet_size)
 
-        self.evaluate()
+        append = self.send_log.append
+        total_packets = frequency * running_time
+        running_time = running_time * int(1e9)
+        start_time = time.time_ns()
+        burst = 0
+        error = 0
+        running = True
 
+        if pacer:
+            pacer.begin()
+        while running:
+            count = int(min(sender.batch, total_packets - self.packet_index + 1))
+            if pacer:
+                deadline = pacer.deadline(burst)
+                while running:
+                    # Checked at least once per burst, the spin may cover the
+                    # whole period at high rates. poll() sleeps whole
+                    # milliseconds and rounds up, so it only waits while a
+                    # full one is left; the pacer sleeps and spins the rest.
+                    remaining = deadline - pacer.spin - time.monotonic_ns()
+                    if poller.poll(max(remaining // 1_000_000, 0)):
+                        running = self._drain()
+                    if remaining < 1_000_000:
+                        break
+                error = pacer.wait(burst) if pacing == "deadline" else pacer.error(burst)
+                burst += 1
+            elif poller.poll(0):
+                running = self._drain()
+            current_time = time.time_ns()
+            send_nums = sender.send(self.packet_index, count, current_time) // count
+            for i in range(self.packet_index, self.packet_index + count):
+                append(i, current_time, send_nums, error)
+            meter.add(count)
+            self.packet_index += count - 1
+
+            if (
+                current_time - start_time
+            ) > running_time or self.packet_index >= total_packets:
+                break
+            self.packet_index += 1
+
+        meter.stop()
+        sender.close()
+        packet = pack_end(0, len(self.send_log), time.time_ns())
+        for _ in range(END_RETRIES):
+            if not running:
+                break
+            self._udp_socket.sendto(packet, (self.remote_ip, self.to_port))
+            deadline = time.monotonic_ns() + int(END_WAIT * 1e9)
+            while running and poller.poll(max(deadline - time.monotonic_ns(), 0) / 1e6):
+                running = self._drain()
+        if running:
+            print("No END echo from the server, %d packets were sent" % len(self.send_log))
+            self.expected = self.stats.expected = len(self.send_log)
+        self._close_receiver()
+
+        self.evaluate()
+        meter.report()
+        if pacer:
+            report_schedule(summarize_schedule(self.send_log))
         if save:
             self.save(save)
-        q.put(0)
+        if hist:
+            self.histogram.save(hist)
+        return meter.summary()
 
-    def evaluate(self):
-        latency_list = [row[1] for row in self.receive_log]
-        latency_max = max(latency_list)
-        latency_avg = sum(latency_list) / len(latency_list)
-        var = sum(pow(x - latency_avg, 2) for x in latency_list) / len(latency_list)
-        latency_std = math.sqrt(var)
-        jitter = max(latency_list) - min(latency_list)
-        cycle = (self.receive_log[-1][3] - self.receive_log[0][3]) * 1e-9
-        bandwidth = sum([x[4] + 32 for x in self.receive_log]) / cycle
-        packet_loss = (max([x[0] for x in self.receive_log]) - len(latency_list)) / max(
-            [x[0] for x in self.receive_log]
+    def run_async(
+        self,
+        frequency: float,
+        packet_size: int,
+        running_time: int,
+        verbose: bool,
+        save: Optional[str],
+        interval: float = 0,
+        raw_log: bool = True,
+        significant_digits: int = 3,
+        hist: Optional[str] = None,
+        timeout: float = 5.0,
+        twamp: bool = False,
+    ):
+        # asyncio engine: the udp_probe.py probe from this client's address.
+        # One sendto() per packet, receive times are taken in user space when
+        # the event loop delivers the echo.
+        import asyncio
+
+        from udp_probe import Probe
+
+        # The probe binds its own socket on the same address
+        self._udp_socket.close()
+        probe = Probe(
+            self.remote_ip,
+            self.to_port,
+            frequency,
+            packet_size,
+            running_time,
+            local_ip=self.local_ip,
+            local_port=self.local_port,
+            idle_timeout=timeout,
+            twamp=twamp,
+            raw_log=raw_log,
+            significant_digits=significant_digits,
+            reserve=self.prefault,
         )
+        reporter = IntervalReporter(interval) if interval > 0 else None
+        meter = RateMeter(frequency, packet_size)
+        if reporter:
+            reporter.start()
+        result = asyncio.run(self._watch(probe, reporter, verbose and reporter is None))
+        if reporter:
+            reporter.stop()
+        # The probe's own sending time, the END exchange is not part of it
+        meter.add(result.sent)
+        meter.stop_time = meter.start_time + round(result.elapsed * 1e9)
+        if result.status == "incomplete":
+            print("No END echo from the server, %d packets were sent" % result.sent)
+        report(result.summary)
+        if twamp:
+            if raw_log:
+                report_reflect(result.summary)
+            else:
+                print("Raw log is disabled, the RTT is not split by direction")
+        meter.report()
+        if save:
+            if raw_log:
+                result.save(save)
+            else:
+                print("Raw log is disabled, %s is not written" % save)
+        if hist:
+            result.histogram.save(hist)
+        return meter.summary()
 
-        print("| -------------  Summary  --------------- |")
-        print(
-            "Total %d packets are received in %f seconds"
-            % (len(self.receive_log), cycle)
+    async def _watch(
+        self, probe: "Probe", reporter: Optional[IntervalReporter], verbose: bool
+    ) -> "ProbeResult":
+        # Interval reports and per-echo lines from the probe's sample batches
+        if reporter is None and not verbose:
+            return await probe.wait()
+        record = reporter.record if reporter else None
+        latency = 0
+        async for batch in probe.samples():
+            for packet_index, new_latency, recv_size in zip(
+                batch["index"], batch["latency"], batch["recv-size"]
+            ):
+                old_latency, latency = latency, int(new_latency)
+                if record:
+                    record(int(packet_index), latency, int(recv_size))
+                if verbose:
+                    print(
+                        "[  Server: %d  |  Packet: %6d  |  Latency: %f ｜ Jitter: %f |  Data size: %4d  ]"
+                        % (
+                            self.local_port,
+                            packet_index,
+                            latency * 1e-9,
+                            abs(latency - old_latency) * 1e-9,
+                            recv_size,
+                        )
+                    )
+        return await probe.wait()
+
+    def _open_receiver(
+        self,
+        buffer_size: int,
+        verbose: bool,
+        batch: int,
+        kernel_ts: bool,
+        interval: float,
+        raw_log: bool,
+        significant_digits: int,
+        save: Optional[str] = None,
+        params: Optional[dict] = None,
+        timeout: float = 0,
+        twamp: bool = False,
+    ) -> None:
+        if twamp and raw_log:
+            self.receive_log = MeasurementLog(REFLECT_SCHEMA)
+        if raw_log:
+            self.receive_log.reserve(self.prefault)
+        self._twamp = twamp
+        self._receiver = BatchReceiver(
+            self._udp_socket, buffer_size, batch, kernel_ts, timeout=timeout
         )
-        print("Average latency: %f second" % latency_avg)
-        print("Maximum latency: %f second" % latency_max)
-        print("Std latency: %f second" % latency_std)
-        print("bandwidth: %f Mbits" % (bandwidth * 8 / 1024 / 1024))
-        print("Jitter (Latency Max - Min): %f second" % jitter)
-        print("Packet loss: %f" % packet_loss)
-        return {
-            "latency_max": latency_max,
-            "latency_avg": latency_avg,
-            "jitter": jitter,
-            "bandwidth": bandwidth,
-        }
+        self._reporter = IntervalReporter(interval) if interval > 0 else None
+        self._verbose = verbose and self._reporter is None
+        self.histogram = LatencyHistogram(significant_digits=significant_digits)
+        self._raw_log = raw_log
+        self._latency = 0
+        self._recorder = None
+        if save and raw_log and not is_csv(save):
+            # Rows are streamed to disk during the run, not written at the end
+            self._recorder = RecordWriter(save, self.receive_log, params)
+            self._recorder.start()
+            self.record_path = save
+        if self._reporter:
+            self._reporter.start()
+
+    def _drain(self) -> bool:
+        receiver = self._receiver
+        unpack_from = HEADER.unpack_from
+        buffers = receiver.buffers
+        sizes = receiver.sizes
+        stamps = receiver.stamps
+        hist_record = self.histogram.record
+        append = self.receive_log.append if self._raw_log else None
+        update = self.stats.update
+        record = self._reporter.record if self._reporter else None
+        verbose = self._verbose
+        latency = self._latency
+        twamp = self._twamp
+        data_kind = REFLECT if twamp else DATA
+        reflect_from = REFLECT_STAMPS.unpack_from
+
+        n = receiver.recv()
+        if not n:
+            # Idle timeout, also before the first echo: a run without a
+            # server has to end too
+            print("No echo for %g seconds, stop listening" % receiver.timeout)
+            return False
+        for i in range(n):
+            recv_time = stamps[i]
+            recv_size = sizes[i]
+            magic, _, kind, _, packet_index, send_time = unpack_from(buffers[i])
+            if kind != data_kind or magic != MAGIC:
+                if kind == END and magic == MAGIC:
+                    self.expected = self.stats.expected = unpack_end(buffers[i])
+                    self._latency = latency
+                    return False
+                continue
+
+            old_latency = latency
+            latency = recv_time - send_time
+            if twamp:
+                # Net RTT, the reflector's residence T3 - T2 taken out
+                if recv_size >= REFLECT_MSG:
+                    t2, t3 = reflect_from(buffers[i], HEADER.size)
+                    latency -= t3 - t2
+                else:
+                    t2 = t3 = 0
+                if append:
+                    append(packet_index, send_time, recv_time, latency, recv_size, t2, t3)
+                else:
+                    update(packet_index, latency, recv_time, recv_size)
+            elif append:
+                append(packet_index, send_time, recv_time, latency, recv_size)
+            else:
+                update(packet_index, latency, recv_time, recv_size)
+            hist_record(latency)
+            if record:
+                record(packet_index, latency, recv_size)
+
+            if verbose:
+                print(
+                    "[  Server: %d  |  Packet: %6d  |  Latency: %f ｜ Jitter: %f |  Data size: %4d  ]"
+                    % (
+                        self.local_port,
+                        packet_index,
+                        latency * 1e-9,
+                        abs(latency - old_latency) * 1e-9,
+                        recv_size,
+                    )
+                )
+        self._latency = latency
+        return True
+
+    def _close_receiver(self) -> None:
+        if self._reporter:
+            self._reporter.stop()
+        self._receiver.close()
+        if self._recorder:
+            self._recorder.close(run=self._announced())
+
+    def _announced(self) -> dict:
+        # Packet count from the echoed END, for the record header
+        return {"expected": self.expected} if self.expected else {}
+
+    def evaluate(self):
+        if len(self.receive_log):
+            result = summarize(self.receive_log, self.expected)
+        else:
+            result = self.stats.summary(histogram_percentiles(self.histogram))
+        report(result)
+        if self._twamp:
+            if self._raw_log:
+                result.update(summarize_reflect(self.receive_log))
+                report_reflect(result)
+            else:
+                print("Raw log is disabled, the RTT is not split by direction")
+        return result
 
     def save(self, path):
-        with open(path, "w") as f:
-            writer = csv.writer(f, delimiter=",")
-            content = [["index", "latency", "jitter", "recv-time", "recv-size"]]
-            writer.writerows(content + self.receive_log)
+        if not len(self.receive_log):
+            print("Raw log is disabled, %s is not written" % path)
+            return
+        if path == self.record_path:
+            return
+        if is_csv(path):
+            write_csv(self.receive_log, path)
+        else:
+            write_record(self.receive_log, path, run=self._announced())
 
     def __del__(self):
         self._udp_socket.close()
 
 
+class _ReflectProtocol:
+    # asyncio datagram protocol, duck-typed so asyncio is only imported by
+    # reflect_async()
+    def __init__(self, msg_size, done, verbose, clients=1) -> None:
+        self.buffer = bytearray(msg_size)
+        self.done = done
+        self.verbose = verbose
+        self.clients = clients
+        self.transport: Optional["DatagramTransport"] = None
+        self.received = 0
+        self.ended = 0
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data, addr) -> None:
+        recv_time = time.time_ns()
+        kind, flow, packet_index, send_time = unpack(data)
+        transport = self.transport
+        if not kind or transport is None:
+            return
+        self.received += 1
+        current_time = time.time_ns()
+        if kind == REFLECT and len(self.buffer) >= REFLECT_MSG:
+            # The client's send time stays, T2 and T3 go in the payload
+            REFLECT_STAMPS.pack_into(self.buffer, HEADER.size, recv_time, current_time)
+        else:
+            send_time += current_time - recv_time
+        HEADER.pack_into(
+            self.buffer, 0, MAGIC, VERSION, kind, flow, packet_index, send_time
+        )
+        if kind != DATA and kind != REFLECT:
+            # Control messages are echoed with their payload
+            end = min(len(data), len(self.buffer))
+            self.buffer[HEADER.size : end] = data[HEADER.size : end]
+        transport.sendto(bytes(self.buffer), addr)
+
+        if kind == END:
+            self.ended += 1
+            if self.clients and self.ended >= self.clients and not self.done.done():
+                self.done.set_result(None)
+        elif self.verbose:
+            print("Send message at time %d" % current_time)
+
+    def error_received(self, exc) -> None:
+        pass
+
+    def connection_lost(self, exc) -> None:
+        pass
+
+
 class Server:
     def __init__(
         self,
@@ -179,51 +660,352 @@ class Server:
         self._udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFFER_SIZE)
         self._udp_socket.bind((self.local_ip, self.local_port))
 
-    def listen(self, buffer_size, verbose, q):
-        while True:
-            msg, _ = self._udp_socket.recvfrom(buffer_size)
-            recv_time = time.time_ns()
-            packet_index = int.from_bytes(msg[:4], "big")
-            send_time = int.from_bytes(msg[4:12], "big")
-            q.put((packet_index, send_time - recv_time))
-
-            if packet_index == 0:
+    def listen(
+        self,
+        buffer_size,
+        verbose,
+        q,
+        batch=1,
+        kernel_ts=True,
+        timeout=5.0,
+        clients=1,
+        ring=None,
+    ):
+        # With a ring, DATA from the current peer goes through its 16-byte
+        # slots as (send - receive time, flow << 32 | sequence number), and a
+        # REFLECT as a STAMPED slot followed by (T1, T2). Control messages and
+        # a new peer address take the queue and leave an ESCAPE slot in their
+        # place, so the sender keeps the order.
+        receiver = BatchReceiver(
+            self._udp_socket, buffer_size, batch, kernel_ts, timeout=timeout
+        )
+        unpack_from = HEADER.unpack_from
+        buffers = receiver.buffers
+        sizes = receiver.sizes
+        stamps = receiver.stamps
+        put = ring.put if ring is not None else None
+        peer = None
+        running = True
+        started = False
+        ended = 0
+        while running:
+            n = receiver.recv()
+            if not n and started:
+                print("No packet for %g seconds, stop listening" % timeout)
                 break
+            started = started or n > 0
+            for i in range(n):
+                recv_time = stamps[i]
+                magic, _, kind, flow, packet_index, send_time = unpack_from(buffers[i])
+                if magic != MAGIC:
+                    continue
+                address = receiver.address(i)
+                if put is not None and kind == DATA and address == peer:
+                    put(send_time - recv_time, flow << 32 | packet_index)
+                elif put is not None and kind == REFLECT and address == peer:
+                    put(STAMPED, flow << 32 | packet_index)
+                    put(send_time, recv_time)
+                else:
+                    # Control messages are echoed with their payload, REFLECT
+                    # carries its receive time instead
+                    if kind == DATA:
+                        extra = None
+                    elif kind == REFLECT:
+                        extra = recv_time
+                    else:
+                        extra = bytes(buffers[i][HEADER.size : sizes[i]])
+                    q.put((kind, flow, packet_index, send_time - recv_time, extra, address))
+                    if put is not None:
+                        put(ESCAPE, 0)
+                        peer = address
 
-            if verbose:
-                print("Receive message at time %d" % recv_time)
+                if kind == END:
+                    # Every client ends with one END, 0 clients runs until idle
+                    ended += 1
+                    if clients and ended >= clients:
+                        running = False
+                        break
+
+                if verbose:
+                    print("Receive message at time %d" % recv_time)
+        if ring is not None:
+            ring.finish()
+        else:
+            q.put(None)
+        receiver.close()
 
-    def send(self, packet_size, verbose, q):
+    def send(self, packet_size, verbose, q, ring=None):
         if packet_size < HEADER_SIZE or packet_size > 1500:
             raise "Warning: packet size is not allowed larger than 1500 bytes (MTU size)"
 
         _payload_size = packet_size - HEADER_SIZE
         _fill = b"".join([b"\x00"] * (_payload_size))
-        while True:
-            packet_index, time_diff = q.get()
-            index_bytes = packet_index.to_bytes(4, "big")
-            current_time = time.time_ns()
-            time_bytes = (current_time + time_diff).to_bytes(8, "big")
+        _stamp_fill = _fill[REFLECT_STAMPS.size :]
+        stamped = _payload_size >= REFLECT_STAMPS.size
+        pack = HEADER.pack
+        pack_stamps = REFLECT_STAMPS.pack
+        sendto = self._udp_socket.sendto
 
-            msg = index_bytes + time_bytes + _fill
-            self._udp_socket.sendto(msg, (self.remote_ip, self.to_port))
+        def message(kind, flow, packet_index, time_diff, extra, current_time):
+            # Echo of a queued item
+            if kind == REFLECT:
+                if stamped:
+                    t2 = extra
+                    return (
+                        pack(MAGIC, VERSION, kind, flow, packet_index, t2 + time_diff)
+                        + pack_stamps(t2, current_time)
+                        + _stamp_fill
+                    )
+                extra = None
+            msg = pack(MAGIC, VERSION, kind, flow, packet_index, current_time + time_diff)
+            return msg + (_fill if extra is None else extra.ljust(_payload_size, b"\x00"))
 
-            if packet_index == 0:
-                break
+        if ring is None:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                current_time = time.time_ns()
+                sendto(message(*item[:5], current_time), item[5])
+
+                if verbose:
+                    print("Send message at time %d" % current_time)
+            return
+
+        slots = _ring_slots(ring)
+        address = None
+        for time_diff, key in slots:
+            current_time = time.time_ns()
+            if time_diff == ESCAPE:
+                item = q.get()
+                msg = message(*item[:5], current_time)
+                address = item[5]
+            elif time_diff == STAMPED:
+                t1, t2 = next(slots)
+                if stamped:
+                    msg = (
+                        pack(MAGIC, VERSION, REFLECT, key >> 32, key & MASK32, t1)
+                        + pack_stamps(t2, current_time)
+                        + _stamp_fill
+                    )
+                else:
+                    msg = pack(
+                        MAGIC,
+                        VERSION,
+                        REFLECT,
+                        key >> 32,
+                        key & MASK32,
+                        current_time + t1 - t2,
+                    )
+                    msg += _fill
+            else:
+                msg = pack(
+                    MAGIC, VERSION, DATA, key >> 32, key & MASK32, current_time + time_diff
+                )
+                msg += _fill
+            sendto(msg, address)
 
             if verbose:
                 print("Send message at time %d" % current_time)
 
+    def reflect(
+        self,
+        packet_size,
+        buffer_size,
+        verbose,
+        batch=1,
+        kernel_ts=True,
+        timeout=5.0,
+        clients=1,
+    ):
+        # Single-process engine: echoes straight from the receive path
+        if packet_size < HEADER_SIZE or packet_size > 1500:
+            raise Exception(
+                "Warning: packet size is not allowed larger than 1500 bytes (MTU size)"
+            )
+
+        receiver = BatchReceiver(
+            self._udp_socket, buffer_size, batch, kernel_ts, timeout=timeout
+        )
+        sender = BatchSender(
+            self._udp_socket,
+            (self.remote_ip, self.to_port),
+            packet_size - WIRE_OVERHEAD,
+            receiver.batch,
+        )
+        unpack_from = HEADER.unpack_from
+        buffers = receiver.buffers
+        sizes = receiver.sizes
+        recv_stamps = receiver.stamps
+        out = sender.buffers
+        reply_to = sender.reply_to
+        kinds = [0] * receiver.batch
+        flows = [0] * receiver.batch
+        indices = [0] * receiver.batch
+        stamps = [0] * receiver.batch
+        # Four-timestamp echoes of the batch: (slot, receive time)
+        reflected = []
+        pack_stamps = REFLECT_STAMPS.pack_into
+        stamped = sender.msg_size >= REFLECT_MSG
+        running = True
+        started = False
+        ended = 0
+        while running:
+            n = receiver.recv()
+            if not n:
+                if started:
+                    print("No packet for %g seconds, stop reflecting" % timeout)
+                    break
+                continue
+            started = True
+            current_time = time.time_ns()
+            count = 0
+            for i in range(n):
+                magic, _, kind, flow, packet_index, send_time = unpack_from(buffers[i])
+                if magic != MAGIC:
+                    continue
+                kinds[count] = kind
+                flows[count] = flow
+                indices[count] = packet_index
+                reply_to(count, receiver, i)
+                if kind == REFLECT and stamped:
+                    stamps[count] = send_time
+                    reflected.append((count, recv_stamps[i]))
+                else:
+                    stamps[count] = current_time + send_time - recv_stamps[i]
+                    if kind != DATA:
+                        # Control messages are echoed with their payload
+                        end = min(sizes[i], sender.msg_size)
+                        out[count][HEADER.size : end] = buffers[i][HEADER.size : end]
+                count += 1
+                if kind == END:
+                    ended += 1
+                    if clients and ended >= clients:
+                        running = False
+                        break
+            if reflected:
+                # T3 as late as possible, right before the batch goes out
+                send_time = time.time_ns()
+                for slot, recv_time in reflected:
+                    pack_stamps(out[slot], HEADER.size, recv_time, send_time)
+                reflected.clear()
+            if count:
+                sender.send_stamped(kinds, flows, indices, stamps, count)
+
+            if verbose:
+                print("Reflect %d messages at time %d" % (count, current_time))
+        sender.close()
+        receiver.close()
+
+    def reflect_async(self, packet_size, verbose, timeout=5.0, clients=1):
+        if packet_size < HEADER_SIZE or packet_size > 1500:
+            raise Exception(
+                "Warning: packet size is not allowed larger than 1500 bytes (MTU size)"
+            )
+        import asyncio
+
+        msg_size = packet_size - WIRE_OVERHEAD
+        asyncio.run(self._reflect_async(msg_size, verbose, timeout, clients))
+
+    async def _reflect_async(self, msg_size, verbose, timeout, clients):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _ReflectProtocol(msg_size, done, verbose, clients),
+            sock=self._udp_socket,
+        )
+        try:
+            # Idle watchdog: stop when nothing arrived for a whole timeout
+            # once the test has started
+            seen = 0
+            while not done.done():
+                await asyncio.wait([done], timeout=timeout or None)
+                if seen and protocol.received == seen and not done.done():
+                    print("No packet for %g seconds, stop reflecting" % timeout)
+                    break
+                seen = protocol.received
+        finally:
+            transport.abort()
+
     def __del__(self):
         self._udp_socket.close()
 
 
-if __name__ == "__main__":
+def _ring_slots(ring: "Ring"):
+    # Every slot up to finish(), whatever batches they were dequeued in
+    get_batch = ring.get_batch
+    while True:
+        slots = get_batch()
+        if not slots:
+            return
+        yield from slots
+
+
+def _check_twamp(packet_size: int, twamp: bool) -> None:
+    if twamp and packet_size < REFLECT_MSG + WIRE_OVERHEAD:
+        raise Exception(
+            "Warning: four-timestamp packets are at least %d bytes"
+            % (REFLECT_MSG + WIRE_OVERHEAD)
+        )
+
+
+def _start_listener(realtime: Optional["Realtime"], target, args: tuple) -> "Process":
+    # Listener process of the process engine, on the second --realtime core
+    from multiprocessing import Process
+
+    if realtime is not None:
+        process = Process(target=realtime.role(1).call, args=(target,) + args)
+    else:
+        process = Process(target=target, args=args)
+    process.start()
+    return process
+
+
+def _open_handoff(handoff: str) -> Optional["Ring"]:
+    # Shared-memory ring between the process engine's listener and sender,
+    # None for the multiprocessing.Queue hand-off
+    if handoff != "ring":
+        return None
+    from udp_ring import ORDERED, open_ring
+
+    ring = open_ring()
+    if ring is None:
+        reason = "Shared memory is" if ORDERED else "x86 store ordering is"
+        print("%s not available, the processes hand off by queue" % reason)
+    return ring
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import getopt
+
     try:
         _opts, _ = getopt.getopt(
-            sys.argv[1:],
+            sys.argv[1:] if argv is None else argv,
             "csf:n:t:b:m:",
-            ["verbose=", "save=", "ip=", "rp=", "lp=", "sync=", "dyna="],
+            [
+                "verbose=",
+                "save=",
+                "ip=",
+                "rp=",
+                "lp=",
+                "sync=",
+                "dyna=",
+                "batch=",
+                "timestamp=",
+                "interval=",
+                "no-raw-log",
+                "hist=",
+                "digits=",
+                "pacing=",
+                "engine=",
+                "handoff=",
+                "twamp",
+                "realtime=",
+                "timeout=",
+                "clients=",
+            ],
         )
         opts = dict(_opts)
         opts.setdefault("-f", "1")
@@ -233,28 +1015,60 @@ if __name__ == "__main__":
         opts.setdefault("--ip", "127.0.0.1")
         opts.setdefault("--verbose", "True")
         opts.setdefault("--dyna", "True")
-        opts.setdefault("--save", "result.csv")
+        opts.setdefault("--save", "result.udpl")
+        opts.setdefault("--batch", "1")
+        opts.setdefault("--timestamp", "kernel")
+        opts.setdefault("--interval", "0")
+        opts.setdefault("--digits", "3")
+        opts.setdefault("--pacing", "deadline")
+        opts.setdefault("--engine", "selector")
+        opts.setdefault("--handoff", "ring")
+        opts.setdefault("--timeout", "5")
+        opts.setdefault("--clients", "1")
 
     except getopt.GetoptError:
         print(
-            "For Client --> udp_latency.py -c -f/m <frequency / bandwidth> -m <bandwidth> -n <packet size> -t <running time> -b <buffer size> --ip <remote ip> --lp <local port> --rp <remote port> --verbose <bool> --save <records saving path>"
+            "For Client --> udp_latency.py -c -f/m <frequency / bandwidth> -m <bandwidth> -n <packet size> -t <running time> -b <buffer size> --ip <remote ip> --lp <local port> --rp <remote port> --verbose <bool> --save <records saving path> --batch <packets per syscall> --pacing <deadline / sleep> --timestamp <kernel / user> --interval <report seconds> --no-raw-log --hist <histogram saving path> --digits <significant digits> --engine <selector / asyncio / process> --handoff <ring / queue> --timeout <idle seconds> --twamp --realtime <cores>[:fifo[=<priority>]][:mlock]"
         )
         print(
-            "For Server --> udp_latency.py -s -b <buffer size> --ip <remote ip> --lp <local port> --rp <remote port> --verbose <bool>"
+            "For Server --> udp_latency.py -s -b <buffer size> --ip <remote ip> --lp <local port> --rp <remote port> --verbose <bool> --batch <packets per syscall> --timestamp <kernel / user> --engine <selector / asyncio / process> --handoff <ring / queue> --timeout <idle seconds> --clients <clients to serve> --realtime <cores>[:fifo[=<priority>]][:mlock]"
         )
         sys.exit(2)
 
+    # With --engine process the sender takes the first core, the listener
+    # process the second
+    _realtime = None
+    if "--realtime" in opts:
+        from udp_realtime import Realtime, describe, report_realtime
+
+        _realtime = Realtime.parse(opts["--realtime"])
+
     if "-c" in opts.keys():
         opts.setdefault("--lp", "20002")
         opts.setdefault("--rp", "20001")
+        if opts["--engine"] == "asyncio":
+            # The probe sends one packet per sendto() on a finite schedule of
+            # deadlines and takes receive times in user space
+            _unsupported: List[str] = []
+            if opts["--batch"] != "1":
+                _unsupported.append("--batch")
+            if opts["--pacing"] != "deadline":
+                _unsupported.append("--pacing " + opts["--pacing"])
+            if dict(_opts).get("--timestamp") == "kernel":
+                _unsupported.append("--timestamp kernel")
+            if opts["-f"] == "m" and "-m" not in opts:
+                _unsupported.append("-f m")
+            if _unsupported:
+                print(
+                    "--engine asyncio cannot be combined with %s" % ", ".join(_unsupported)
+                )
+                sys.exit(2)
 
         client = Client(
             remote_ip=opts["--ip"],
             to_port=int(opts["--rp"]),
             local_port=int(opts["--lp"]),
         )
-        q: Queue = Queue()
-
         _f: float
         if "-m" in opts:
             _f = float(opts["-m"]) * 125000 / int(opts["-n"])
@@ -262,22 +1076,95 @@ if __name__ == "__main__":
             _f = math.inf
         else:
             _f = float(opts["-f"])
+        if _realtime is not None and math.isfinite(_f):
+            client.prefault = math.ceil(_f * int(opts["-t"]))
 
-        listen_process = Process(
-            target=client.listen,
-            args=(
-                int(opts["-b"]),
-                eval(opts["--verbose"]),
-                opts["--save"],
-                q,
-            ),
-        )
+        _rt = _realtime
+        if _realtime is not None and opts["--engine"] == "process":
+            _rt = _realtime.role(0)
 
-        listen_process.start()
-        client.send(_f, int(opts["-n"]), int(opts["-t"]), eval(opts["--dyna"]), q)
+        with _rt or nullcontext():
+            if _rt is not None:
+                # Lands in the record header next to the other parameters
+                opts["realtime"] = describe(_rt.applied)
+            if opts["--engine"] == "process":
+                from multiprocessing import Queue
 
-        listen_process.join()
-        listen_process.close()
+                q: Queue = Queue()
+                ring = _open_handoff(opts["--handoff"])
+                try:
+                    listen_process = _start_listener(
+                        _realtime,
+                        client.listen,
+                        (
+                            int(opts["-b"]),
+                            opts["--verbose"] == "True",
+                            opts["--save"],
+                            q,
+                            int(opts["--batch"]),
+                            opts["--timestamp"] == "kernel",
+                            float(opts["--interval"]),
+                            "--no-raw-log" not in opts,
+                            int(opts["--digits"]),
+                            opts.get("--hist"),
+                            opts,
+                            float(opts["--timeout"]),
+                            ring,
+                            "--twamp" in opts,
+                        ),
+                    )
+                    client.send(
+                        _f,
+                        int(opts["-n"]),
+                        int(opts["-t"]),
+                        opts["--dyna"] == "True",
+                        q,
+                        batch=int(opts["--batch"]),
+                        pacing=opts["--pacing"],
+                        ring=ring,
+                        twamp="--twamp" in opts,
+                    )
+
+                    listen_process.join()
+                    listen_process.close()
+                finally:
+                    if ring is not None:
+                        ring.close()
+            elif opts["--engine"] == "asyncio":
+                client.run_async(
+                    _f,
+                    int(opts["-n"]),
+                    int(opts["-t"]),
+                    opts["--verbose"] == "True",
+                    opts["--save"],
+                    interval=float(opts["--interval"]),
+                    raw_log="--no-raw-log" not in opts,
+                    significant_digits=int(opts["--digits"]),
+                    hist=opts.get("--hist"),
+                    timeout=float(opts["--timeout"]),
+                    twamp="--twamp" in opts,
+                )
+            else:
+                client.run(
+                    _f,
+                    int(opts["-n"]),
+                    int(opts["-t"]),
+                    int(opts["-b"]),
+                    opts["--verbose"] == "True",
+                    opts["--save"],
+                    batch=int(opts["--batch"]),
+                    pacing=opts["--pacing"],
+                    kernel_ts=opts["--timestamp"] == "kernel",
+                    interval=float(opts["--interval"]),
+                    raw_log="--no-raw-log" not in opts,
+                    significant_digits=int(opts["--digits"]),
+                    hist=opts.get("--hist"),
+                    params=opts,
+                    timeout=float(opts["--timeout"]),
+                    twamp="--twamp" in opts,
+                )
+        if _rt is not None:
+            report_realtime(_rt.applied)
 
     if "-s" in opts.keys():
         opts.setdefault("--lp", "20001")
@@ -288,12 +1175,57 @@ if __name__ == "__main__":
             local_port=int(opts["--lp"]),
             to_port=int(opts["--rp"]),
         )
-        q = Queue()
+        _rt = _realtime
+        if _realtime is not None and opts["--engine"] == "process":
+            _rt = _realtime.role(0)
 
-        listen_process = Process(
-            target=server.listen, args=(int(opts["-b"]), eval(opts["--verbose"]), q)
-        )
-        listen_process.start()
-        server.send(int(opts["-n"]), eval(opts["--verbose"]), q)
-        listen_process.join()
-        listen_process.close()
+        with _rt or nullcontext():
+            if opts["--engine"] == "process":
+                from multiprocessing import Queue
+
+                q = Queue()
+                ring = _open_handoff(opts["--handoff"])
+                try:
+                    listen_process = _start_listener(
+                        _realtime,
+                        server.listen,
+                        (
+                            int(opts["-b"]),
+                            opts["--verbose"] == "True",
+                            q,
+                            int(opts["--batch"]),
+                            opts["--timestamp"] == "kernel",
+                            float(opts["--timeout"]),
+                            int(opts["--clients"]),
+                            ring,
+                        ),
+                    )
+                    server.send(int(opts["-n"]), opts["--verbose"] == "True", q, ring)
+                    listen_process.join()
+                    listen_process.close()
+                finally:
+                    if ring is not None:
+                        ring.close()
+            elif opts["--engine"] == "asyncio":
+                server.reflect_async(
+                    int(opts["-n"]),
+                    opts["--verbose"] == "True",
+                    float(opts["--timeout"]),
+                    int(opts["--clients"]),
+                )
+            else:
+                server.reflect(
+                    int(opts["-n"]),
+                    int(opts["-b"]),
+                    opts["--verbose"] == "True",
+                    int(opts["--batch"]),
+                    opts["--timestamp"] == "kernel",
+                    float(opts["--timeout"]),
+                    int(opts["--clients"]),
+                )
+        if _rt is not None:
+            report_realtime(_rt.applied)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+import math
+
+from types import ModuleType
+from typing import Dict, Optional, Sequence
+
+from udp_numpy import numpy
+
+
+PERCENTILES = (50.0, 90.0, 99.0, 99.9, 99.99)
+OVERHEAD_SIZE = 20 + 8
+
+
+def _percentile_key(q: float) -> str:
+    return "p" + ("%g" % q).replace(".", "")
+
+
+class StreamingStats:
+    # Single-pass, constant-memory statistics that can be updated packet by
+    # packet while the test is running (Welford mean/variance, RFC 3550
+    # interarrival jitter, sequence tracking for loss/duplicates/reordering).
+    def __init__(self, expected: int = 0, window: int = 0) -> None:
+        self.expected = expected
+        self.window = window
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = 0
+        self.max = 0
+        self.jitter = 0.0
+        self._last_latency: Optional[int] = None
+        self.highest = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.bytes = 0
+        self.first_time = 0
+        self.last_time = 0
+        # Bitmap of seen sequence numbers. With a window it is a fixed ring
+        # covering the last `window` sequence numbers, so memory stays
+        # constant; packets older than the window count as reordered.
+        self._seen = bytearray((window + 7) >> 3)
+
+    def _track(self, index: int) -> None:
+        seen = self._seen
+        window = self.window
+        if window:
+            if index > self.highest:
+                for old in range(max(self.highest + 1, index - window + 1), index):
+                    slot = old % window
+                    seen[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+                slot = index % window
+                seen[slot >> 3] |= 1 << (slot & 7)
+                self.highest = index
+                return
+            if index <= self.highest - window:
+                self.reordered += 1
+                return
+            slot = index % window
+        else:
+            slot = index
+            if slot >> 3 >= len(seen):
+                seen.extend(bytes(max((slot >> 3) + 1 - len(seen), 4096)))
+        mask = 1 << (slot & 7)
+        if seen[slot >> 3] & mask:
+            self.duplicates += 1
+        else:
+            seen[slot >> 3] |= mask
+            if index < self.highest:
+                self.reordered += 1
+            else:
+                self.highest = index
+
+    def update(self, index: int, latency: int, recv_time: int, size: int) -> None:
+        self._track(index)
+
+        self.count += 1
+        delta = latency - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (latency - self.mean)
+        if self.count == 1:
+            self.min = self.max = latency
+            self.first_time = recv_time
+        elif latency < self.min:
+            self.min = latency
+        elif latency > self.max:
+            self.max = latency
+        if self._last_latency is not None:
+            self.jitter += (abs(latency - self._last_latency) - self.jitter) / 16
+        self._last_latency = latency
+        self.bytes += size
+        self.last_time = recv_time
+
+    def merge(self, other: "StreamingStats") -> None:
+        # Combine stats of an independent sequence space (another flow): the
+        # moments are pooled, loss/duplicates/reordering add up per flow
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.jitter = (self.jitter * self.count + other.jitter * other.count) / count
+        if self.count:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self.first_time = min(self.first_time, other.first_time)
+            self.last_time = max(self.last_time, other.last_time)
+        else:
+            self.min, self.max = other.min, other.max
+            self.first_time, self.last_time = other.first_time, other.last_time
+        self.count = count
+        self.expected = max(self.expected, self.highest) + max(
+            other.expected, other.highest
+        )
+        self.highest = 0
+        self.duplicates += other.duplicates
+        self.reordered += other.reordered
+        self.bytes += other.bytes
+
+    def summary(self, percentiles: Optional[Dict[str, float]] = None) -> dict:
+        unique = self.count - self.duplicates
+        expected = max(self.expected, self.highest)
+        cycle = (self.last_time - self.first_time) * 1e-9
+        result = {
+            "count": self.count,
+            "duration": cycle,
+            "latency_avg": self.mean * 1e-9,
+            "latency_max": self.max * 1e-9,
+            "latency_min": self.min * 1e-9,
+            "latency_std": math.sqrt(self._m2 / self.count) * 1e-9 if self.count else 0.0,
+            "jitter": (self.max - self.min) * 1e-9,
+            "jitter_rfc3550": self.jitter * 1e-9,
+            "bandwidth": (self.bytes + OVERHEAD_SIZE * self.count) / cycle if cycle else 0.0,
+            "lost": expected - unique,
+            "packet_loss": (expected - unique) / expected if expected else 0.0,
+            "duplicates": self.duplicates,
+            "reordered": self.reordered,
+        }
+        for q in PERCENTILES:
+            key = _percentile_key(q)
+            result[key] = percentiles[key] if percentiles else float("nan")
+        return result
+
+
+def histogram_percentiles(histogram) -> Dict[str, float]:
+    values = histogram.percentiles(PERCENTILES)
+    return {_percentile_key(q): v * 1e-9 for q, v in zip(PERCENTILES, values)}
+
+
+def _sorted_percentiles(values: Sequence[int]) -> Dict[str, float]:
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    result = {}
+    for q in PERCENTILES:
+        rank = q / 100 * last
+        low = int(rank)
+        high = min(low + 1, last)
+        value = ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+        result[_percentile_key(q)] = value * 1e-9
+    return result
+
+
+def _summarize_numpy(np: ModuleType, log, expected: int) -> dict:
+    index = log.column("index")
+    latency = log.column("latency")
+    recv_time = log.column("recv-time")
+    size = log.column("recv-size")
+    count = len(latency)
+
+    _, first = np.unique(index, return_index=True)
+    unique = len(first)
+    is_first = np.zeros(count, dtype=bool)
+    is_first[first] = True
+    prior_max = np.maximum.accumulate(index)[:-1]
+    reordered = int(np.count_nonzero((index[1:] < prior_max) & is_first[1:]))
+
+    as_float = latency.astype(np.float64)
+    diffs = np.abs(np.diff(as_float))
+    weights = (15 / 16) ** np.arange(len(diffs) - 1, -1, -1)
+    jitter = float(np.dot(weights, diffs)) / 16
+
+    highest = int(index.max())
+    expected = max(expected, highest)
+    cycle = int(recv_time[-1] - recv_time[0]) * 1e-9
+    total_bytes = int(size.sum()) + OVERHEAD_SIZE * count
+    result = {
+        "count": count,
+        "duration": cycle,
+        "latency_avg": float(as_float.mean()) * 1e-9,
+        "latency_max": int(latency.max()) * 1e-9,
+        "latency_min": int(latency.min()) * 1e-9,
+        "latency_std": float(as_float.std()) * 1e-9,
+        "jitter": int(latency.max() - latency.min()) * 1e-9,
+        "jitter_rfc3550": jitter * 1e-9,
+        "bandwidth": total_bytes / cycle if cycle else 0.0,
+        "lost": expected - unique,
+        "packet_loss": (expected - unique) / expected if expected else 0.0,
+        "duplicates": count - unique,
+        "reordered": reordered,
+    }
+    values = np.percentile(latency, PERCENTILES)
+    for q, value in zip(PERCENTILES, values):
+        result[_percentile_key(q)] = float(value) * 1e-9
+    return result
+
+
+def summarize(log, expected: int = 0) -> dict:
+    if not len(log):
+        return StreamingStats(expected).summary()
+    np = numpy()
+    if np is not None:
+        return _summarize_numpy(np, log, expected)
+
+    stats = StreamingStats(expected)
+    update = stats.update
+    latency = log.column("latency")
+    for row in zip(
+        log.column("index"), latency, log.column("recv-time"), log.column("recv-size")
+    ):
+        update(*row)
+    return stats.summary(_sorted_percentiles(latency))
+
+
+def summarize_schedule(log) -> dict:
+    # Sender-side pacing error (actual send time - scheduled deadline)
+    error = log.column("sched-error")
+    if not len(error):
+        return {"count": 0}
+    np = numpy()
+    if np is not None:
+        as_float = error.astype(np.float64)
+        avg, std = float(as_float.mean()), float(as_float.std())
+        p99 = float(np.percentile(error, 99))
+    else:
+        avg = sum(error) / len(error)
+        std = math.sqrt(sum((x - avg) ** 2 for x in error) / len(error))
+        p99 = _sorted_percentiles(error)["p99"] * 1e9
+    return {
+        "count": len(error),
+        "error_avg": avg * 1e-9,
+        "error_std": std * 1e-9,
+        "error_p99": p99 * 1e-9,
+        "error_max": int(max(error)) * 1e-9,
+    }
+
+
+def summarize_tx(log, tx_log) -> dict:
+    # Splits the one-way latency at the sender's kernel TX timestamp: "stack"
+    # is user send time -> kernel TX (sender host, one clock), "wire" the
+    # rest up to the receive timestamp
+    tx_time = dict(zip(tx_log.column("index"), tx_log.column("tx-time")))
+    stack = []
+    wire = []
+    for index, send_time, latency in zip(
+        log.column("index"), log.column("send-time"), log.column("latency")
+    ):
+        stamp = tx_time.get(index)
+        if stamp is None:
+            continue
+        delay = int(stamp - send_time)
+        stack.append(delay)
+        wire.append(int(latency) - delay)
+    result: Dict[str, float] = {"tx_count": len(stack)}
+    for name, values in (("stack", stack), ("wire", wire)):
+        if not values:
+            continue
+        percentiles = _sorted_percentiles(values)
+        result[name + "_avg"] = sum(values) / len(values) * 1e-9
+        result[name + "_p50"] = percentiles["p50"]
+        result[name + "_p99"] = percentiles["p99"]
+        result[name + "_max"] = max(values) * 1e-9
+    return result
+
+
+def summarize_reflect(log) -> dict:
+    # Four-timestamp echoes (T1 client send, T2 / T3 reflector receive / send,
+    # T4 client receive): the reflector's residence T3 - T2 on its own clock,
+    # and the one-way delays once its clock offset is fitted from the echoes
+    # themselves, like the sync exchanges (symmetric minimum delay assumed)
+    from udp_sync import fit_offset
+
+    rows = [
+        row
+        for row in zip(
+            log.column("send-time"),
+            log.column("reflect-recv-time"),
+            log.column("reflect-send-time"),
+            log.column("recv-time"),
+        )
+        if row[1]
+    ]
+    result: Dict[str, float] = {"reflect_count": len(rows)}
+    if not rows:
+        return result
+    # offset = client clock - reflector clock
+    a, b, t0 = fit_offset(
+        [
+            ((t1 + t4) // 2, ((t1 - t2) + (t4 - t3)) / 2, (t4 - t1) - (t3 - t2))
+            for t1, t2, t3, t4 in rows
+        ]
+    )
+    residence = []
+    forward = []
+    reverse = []
+    for t1, t2, t3, t4 in rows:
+        offset = round(a + b * ((t1 + t4) // 2 - t0))
+        residence.append(t3 - t2)
+        forward.append(t2 + offset - t1)
+        reverse.append(t4 - t3 - offset)
+    result["clock_offset"] = a * 1e-9
+    for name, values in (
+        ("residence", residence),
+        ("forward", forward),
+        ("reverse", reverse),
+    ):
+        percentiles = _sorted_percentiles(values)
+        result[name + "_avg"] = sum(values) / len(values) * 1e-9
+        result[name + "_p50"] = percentiles["p50"]
+        result[name + "_p99"] = percentiles["p99"]
+        result[name + "_max"] = max(values) * 1e-9
+    return result
+
+
+def report_reflect(result: dict) -> None:
+    if not result["reflect_count"]:
+        print("The reflector sent no timestamps, RTT cannot be split by direction")
+        return
+    print(
+        "Echoes with reflector timestamps: %d (clock offset %f second)"
+        % (result["reflect_count"], result["clock_offset"])
+    )
+    for name, title in (
+        ("residence", "Reflector residence"),
+        ("forward", "Forward delay"),
+        ("reverse", "Reverse delay"),
+    ):
+        print(
+            "%s: avg %f  p50 %f  p99 %f  max %f second"
+            % (
+                title,
+                result[name + "_avg"],
+                result[name + "_p50"],
+                result[name + "_p99"],
+                result[name + "_max"],
+            )
+        )
+
+
+def report_tx(result: dict) -> None:
+    if not result["tx_count"]:
+        print("No kernel TX timestamps were received")
+        return
+    print("Packets with a kernel TX timestamp: %d" % result["tx_count"])
+    for name, title in (("stack", "Sender stack delay"), ("wire", "Wire latency")):
+        print(
+            "%s: avg %f  p50 %f  p99 %f  max %f second"
+            % (
+                title,
+                result[name + "_avg"],
+                result[name + "_p50"],
+                result[name + "_p99"],
+                result[name + "_max"],
+            )
+        )
+
+
+def report_schedule(result: dict) -> None:
+    if not result["count"]:
+        return
+    print(
+        "Send schedule error: avg %f  std %f  p99 %f  max %f second"
+        % (
+            result["error_avg"],
+            result["error_std"],
+            result["error_p99"],
+            result["error_max"],
+        )
+    )
+
+
+def report(result: dict) -> None:
+    print("| -------------  Summary  --------------- |")
+    print(
+        "Total %d packets are received in %f seconds"
+        % (result["count"], result["duration"])
+    )
+    print("Average latency: %f second" % result["latency_avg"])
+    print("Maximum latency: %f second" % result["latency_max"])
+    print("Std latency: %f second" % result["latency_std"])
+    print(
+        "Percentiles: "
+        + "  ".join(
+            "%s %f" % (_percentile_key(q), result[_percentile_key(q)]) for q in PERCENTILES
+        )
+        + " second"
+    )
+    print("bandwidth: %f Mbits" % (result["bandwidth"] * 8 / 1024 / 1024))
+    print("Jitter (Latency Max - Min): %f second" % result["jitter"])
+    print("Jitter (RFC 3550): %f second" % result["jitter_rfc3550"])
+    print("Packet loss: %f (%d lost)" % (result["packet_loss"], result["lost"]))
+    print("Duplicated: %d  Reordered: %d" % (result["duplicates"], result["reordered"]))
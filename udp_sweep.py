@@ -0,0 +1,365 @@
+import itertools
+import json
+import multiprocessing as mp
+import os
+import select
+import socket
+import socketserver
+import sqlite3
+import sys
+import time
+
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from udp_latency import Client, Server
+
+CONTROL_PORT = 20000
+# Port pair k: server data port DATA_PORT + 2k, client port DATA_PORT + 2k + 1
+DATA_PORT = 20001
+TERMINATE_RETRY = 1.0
+
+METRICS = (
+    "count",
+    "latency_avg",
+    "latency_std",
+    "latency_max",
+    "p50",
+    "p99",
+    "p999",
+    "jitter_rfc3550",
+    "packet_loss",
+)
+
+
+def _send_message(stream, message: dict) -> None:
+    stream.write((json.dumps(message) + "\n").encode())
+    stream.flush()
+
+
+def _read_message(stream) -> dict:
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("control channel closed")
+    return json.loads(line)
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    # One control connection drives one port pair; the forking server runs
+    # every connection in its own process so parallel pairs use their own core
+    def handle(self) -> None:
+        server: Optional[Server] = None
+        while True:
+            try:
+                message = _read_message(self.rfile)
+            except (ConnectionError, ValueError):
+                break
+            if message["cmd"] == "open":
+                server = Server(
+                    local_port=message["port"],
+                    remote_ip=self.client_address[0],
+                    to_port=message["peer_port"],
+                )
+                if message["sync"]:
+                    clock = server.synchronize(False, message["fast_sync"])
+                    if message["sync_interval"] > 0:
+                        clock.start(message["sync_interval"])
+                _send_message(self.wfile, {"ok": True})
+            elif message["cmd"] == "run":
+                if server is None:
+                    raise Exception("Warning: run before open on the control channel")
+                server.reset()
+                # The socket stays bound, packets sent from now on are queued
+                _send_message(self.wfile, {"ok": True})
+                server.listen(
+                    buffer_size=message["buffer_size"],
+                    verbose=False,
+                    sync=False,
+                    batch=message["batch"],
+                    kernel_ts=message["kernel_ts"],
+                    raw_log=bool(message["record"]),
+                    significant_digits=message["digits"],
+                    record_path=message["record"],
+                    params=message,
+                )
+                _send_message(self.wfile, {"result": server.evaluate()})
+            elif message["cmd"] == "close":
+                break
+        if server is not None and server.clock is not None:
+            server.clock.stop()
+
+
+class Agent(socketserver.ForkingTCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, control_port: int = CONTROL_PORT) -> None:
+        super().__init__(("0.0.0.0", control_port), _AgentHandler)
+
+
+def _run_pair(
+    pair: int,
+    remote_ip: str,
+    control_port: int,
+    data_port: int,
+    points: Sequence[Tuple[int, float, float]],
+    options: dict,
+    results,
+) -> None:
+    port = data_port + 2 * pair
+    client = Client(local_port=port + 1, remote_ip=remote_ip, to_port=port)
+    conn = socket.create_connection((remote_ip, control_port))
+    stream = conn.makefile("rwb")
+    _send_message(
+        stream,
+        {
+            "cmd": "open",
+            "port": port,
+            "peer_port": port + 1,
+            "sync": options["sync"],
+            "fast_sync": options["fast_sync"],
+            "sync_interval": options["sync_interval"],
+        },
+    )
+    if options["sync"]:
+        client.synchronize(False)
+    _read_message(stream)
+
+    for size, rate, duration in points:
+        record = None
+        if options["records"]:
+            record = os.path.join(
+                options["records"], "sweep_%04d_%g_%g.udpl" % (size, rate, duration)
+            )
+        _send_message(
+            stream,
+            {
+                "cmd": "run",
+                "buffer_size": max(options["buffer_size"], size),
+                "batch": options["batch"],
+                "kernel_ts": options["kernel_ts"],
+                "digits": options["digits"],
+                "record": record,
+                "size": size,
+                "rate": rate,
+                "duration": duration,
+            },
+        )
+        _read_message(stream)
+        client.reset()
+        sent = client.send(
+            rate,
+            size,
+            duration,
+            False,
+            sync=False,
+            dyna=False,
+            batch=options["batch"],
+            pacing=options["pacing"],
+            report=False,
+            keep_open=True,
+        )
+        # A lost termination packet would stall the server, repeat it until
+        # the result arrives (reset() drops the spare ones)
+        while not select.select([conn], [], [], TERMINATE_RETRY)[0]:
+            client.terminate()
+        reply = _read_message(stream)
+        results.put((pair, size, rate, duration, sent, reply["result"], record))
+
+    _send_message(stream, {"cmd": "close"})
+    conn.close()
+    results.put(None)
+
+
+def open_store(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS runs ("
+        "id INTEGER PRIMARY KEY, sweep TEXT, pair INTEGER, size INTEGER, rate REAL, "
+        "duration REAL, sent INTEGER, pps REAL, "
+        + ", ".join("%s REAL" % name for name in METRICS)
+        + ", record TEXT, summary TEXT)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS runs_point ON runs (size, rate, duration)")
+    db.execute("CREATE INDEX IF NOT EXISTS runs_sweep ON runs (sweep)")
+    return db
+
+
+def sweep(
+    remote_ip: str,
+    sizes: Iterable[int],
+    rates: Iterable[float],
+    durations: Iterable[float],
+    store: str = "sweep.db",
+    pairs: int = 1,
+    control_port: int = CONTROL_PORT,
+    data_port: int = DATA_PORT,
+    records: Optional[str] = None,
+    buffer_size: int = 1500,
+    batch: int = 1,
+    kernel_ts: bool = True,
+    digits: int = 3,
+    pacing: str = "deadline",
+    sync: bool = True,
+    fast_sync: bool = True,
+    sync_interval: float = 0.5,
+) -> List[dict]:
+    # Steps through sizes x rates x durations against a running agent
+    # (udp_sweep.py -s); points are dealt round-robin to `pairs` sender
+    # processes and every result lands in one SQLite store.
+    points = list(itertools.product(sizes, rates, durations))
+    pairs = max(1, min(pairs, len(points)))
+    options = {
+        "records": records,
+        "buffer_size": buffer_size,
+        "batch": batch,
+        "kernel_ts": kernel_ts,
+        "digits": digits,
+        "pacing": pacing,
+        "sync": sync,
+        "fast_sync": fast_sync,
+        "sync_interval": sync_interval,
+    }
+    results: "mp.Queue[Optional[tuple]]" = mp.Queue()
+    workers = [
+        mp.Process(
+            target=_run_pair,
+            args=(
+                pair,
+                remote_ip,
+                control_port,
+                data_port,
+                points[pair::pairs],
+                options,
+                results,
+            ),
+        )
+        for pair in range(pairs)
+    ]
+    for worker in workers:
+        worker.start()
+
+    sweep_id = time.strftime("%Y%m%d-%H%M%S")
+    db = open_store(store)
+    rows = []
+    finished = 0
+    while finished < len(workers):
+        item = results.get()
+        if item is None:
+            finished += 1
+            continue
+        pair, size, rate, duration, sent, result, record = item
+        db.execute(
+            "INSERT INTO runs (sweep, pair, size, rate, duration, sent, pps, "
+            + ", ".join(METRICS)
+            + ", record, summary) VALUES ("
+            + ", ".join("?" * (len(METRICS) + 9))
+            + ")",
+            [sweep_id, pair, size, rate, duration, sent["packets"], sent["pps"]]
+            + [result[name] for name in METRICS]
+            + [record, json.dumps(result)],
+        )
+        db.commit()
+        rows.append(dict(result, pair=pair, size=size, rate=rate, duration=duration))
+        print(
+            "[  Size: %4d  |  Rate: %9.1f  |  Time: %5g  |  Avg: %f  |  p99: %f  |  Loss: %f  ]"
+            % (
+                size,
+                rate,
+                duration,
+                result["latency_avg"],
+                result["p99"],
+                result["packet_loss"],
+            ),
+            flush=True,
+        )
+    for worker in workers:
+        worker.join()
+    db.close()
+    return rows
+
+
+def _numbers(value: str, cast) -> List:
+    return [cast(x) for x in value.split(",") if x]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import getopt
+
+    try:
+        _opts, _ = getopt.getopt(
+            sys.argv[1:] if argv is None else argv,
+            "csb:",
+            [
+                "ip=",
+                "control-port=",
+                "port=",
+                "sizes=",
+                "rates=",
+                "times=",
+                "pairs=",
+                "store=",
+                "records=",
+                "batch=",
+                "timestamp=",
+                "digits=",
+                "pacing=",
+                "sync=",
+                "fast-sync=",
+                "sync-interval=",
+            ],
+        )
+        opts = dict(_opts)
+        opts.setdefault("-b", "1500")
+        opts.setdefault("--ip", "127.0.0.1")
+        opts.setdefault("--control-port", str(CONTROL_PORT))
+        opts.setdefault("--port", str(DATA_PORT))
+        opts.setdefault("--sizes", "1500")
+        opts.setdefault("--rates", "1")
+        opts.setdefault("--times", "10")
+        opts.setdefault("--pairs", "1")
+        opts.setdefault("--store", "sweep.db")
+        opts.setdefault("--batch", "1")
+        opts.setdefault("--timestamp", "kernel")
+        opts.setdefault("--digits", "3")
+        opts.setdefault("--pacing", "deadline")
+        opts.setdefault("--sync", "True")
+        opts.setdefault("--fast-sync", "True")
+        opts.setdefault("--sync-interval", "0.5")
+    except getopt.GetoptError:
+        print("For Server --> udp_sweep.py -s --control-port <control port>")
+        print(
+            "For Client --> udp_sweep.py -c --ip <remote ip> --sizes <sizes, comma separated> --rates <frequencies> --times <running times> --pairs <parallel port pairs> --store <results database path> --records <record directory on server> --control-port <control port> --port <first data port> -b <buffer size> --batch <packets per syscall> --timestamp <kernel / user> --digits <significant digits> --pacing <deadline / sleep> --sync <bool> --fast-sync <bool> --sync-interval <seconds>"
+        )
+        sys.exit(2)
+
+    if "-s" in opts:
+        with Agent(int(opts["--control-port"])) as _agent:
+            print(
+                "|  ---------- Sweep agent on port %s ------------  |"
+                % opts["--control-port"]
+            )
+            _agent.serve_forever()
+
+    if "-c" in opts:
+        sweep(
+            opts["--ip"],
+            _numbers(opts["--sizes"], int),
+            _numbers(opts["--rates"], float),
+            _numbers(opts["--times"], float),
+            store=opts["--store"],
+            pairs=int(opts["--pairs"]),
+            control_port=int(opts["--control-port"]),
+            data_port=int(opts["--port"]),
+            records=opts.get("--records"),
+            buffer_size=int(opts["-b"]),
+            batch=int(opts["--batch"]),
+            kernel_ts=opts["--timestamp"] == "kernel",
+            digits=int(opts["--digits"]),
+            pacing=opts["--pacing"],
+            sync=opts["--sync"] == "True",
+            fast_sync=opts["--fast-sync"] == "True",
+            sync_interval=float(opts["--sync-interval"]),
+        )
+
+
+if __name__ == "__main__":
+    main()
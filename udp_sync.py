@@ -0,0 +1,197 @@
+import queue
+import socket
+import threading
+import time
+
+from typing import Callable, List, Optional, Tuple
+
+from udp_numpy import numpy
+from udp_proto import (
+    SYNC_READY,
+    SYNC_REPLY,
+    SYNC_REQUEST,
+    pack,
+    pack_sync_reply,
+    unpack,
+    unpack_sync_reply,
+)
+
+
+BIN_SIZE = 8
+MIN_SPAN = 10_000_000_000
+# Longest wait of a client for the first request of the initial exchanges
+SYNC_TIMEOUT = 10.0
+
+
+def fit_offset(samples: List[Tuple[int, float, int]]) -> Tuple[float, float, int]:
+    # (time, offset, delay) samples of two-way exchanges in time order to
+    # offset = a + b * (t - t0), fitted by least squares over the
+    # minimum-delay sample of every bin; a constant below MIN_SPAN
+    kept = [
+        min(samples[i : i + BIN_SIZE], key=lambda s: s[2])
+        for i in range(0, len(samples), BIN_SIZE)
+    ]
+    t0 = kept[0][0]
+    span = kept[-1][0] - t0
+    if len(kept) < 3 or span < MIN_SPAN:
+        best = min(samples, key=lambda s: s[2])
+        return (best[1], 0.0, best[0])
+    xs = [s[0] - t0 for s in kept]
+    ys = [s[1] for s in kept]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sxx
+    return (mean_y - slope * mean_x, slope, t0)
+
+
+class SyncResponder:
+    # Client side of the side-channel exchange: stamps and echoes every
+    # request that arrives on the client's socket from a background thread.
+    # Other control messages for the client are passed on through `messages`.
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.ready = threading.Event()
+        self.last_request = 0
+        self.messages: "queue.Queue[Tuple[int, int, bytes]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                msg, addr = self.sock.recvfrom(64)
+            except OSError:
+                return
+            t2 = time.time_ns()
+            kind, flow, _, t1 = unpack(msg)
+            if kind == SYNC_REQUEST:
+                self.last_request = t2
+                try:
+                    self.sock.sendto(pack_sync_reply(t1, t2, time.time_ns()), addr)
+                except OSError:
+                    return
+            elif kind == SYNC_READY:
+                self.ready.set()
+            elif kind:
+                self.messages.put((kind, flow, msg))
+
+    def wait_ready(
+        self,
+        quiet: float = 1.0,
+        announce: Optional[Callable[[], None]] = None,
+        timeout: float = SYNC_TIMEOUT,
+    ) -> None:
+        # READY may be lost, so a pause in requests after the first one also
+        # ends the initial phase. `announce` is called every 0.1 s until the
+        # first request arrives, which has to be within `timeout` seconds.
+        deadline = time.monotonic() + timeout
+        while True:
+            if announce is not None and not self.last_request:
+                announce()
+            if self.ready.wait(0.1):
+                break
+            if self.last_request and time.time_ns() - self.last_request > quiet * 1e9:
+                break
+            if not self.last_request and time.monotonic() > deadline:
+                raise Exception(
+                    "Warning: no clock synchronization from the server within %g seconds"
+                    % timeout
+                )
+
+
+class ClockSync:
+    # Server side: fires PTP-like exchanges at the client over its own socket
+    # and models offset = server clock - client clock as a + b * (t - t0),
+    # fitted by least squares over the minimum-delay sample of every bin.
+    def __init__(self, remote: Tuple[str, int], timeout: float = 0.2) -> None:
+        self.remote = remote
+        self.samples: List[Tuple[int, float, int]] = []
+        self.model: Tuple[float, float, int] = (0.0, 0.0, 0)
+        self._sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._sock.bind(("0.0.0.0", 0))
+        self._sock.settimeout(timeout)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def exchange(self) -> bool:
+        t1 = time.time_ns()
+        self._sock.sendto(pack(SYNC_REQUEST, 0, 0, t1), self.remote)
+        while True:
+            try:
+                msg, _ = self._sock.recvfrom(64)
+            except socket.timeout:
+                return False
+            t4 = time.time_ns()
+            kind, _, _, echo = unpack(msg)
+            if kind == SYNC_REPLY and echo == t1:
+                t2, t3 = unpack_sync_reply(msg)
+                break
+        offset = ((t1 - t2) + (t4 - t3)) / 2
+        delay = (t4 - t1) - (t3 - t2)
+        with self._lock:
+            self.samples.append(((t1 + t4) // 2, offset, delay))
+        return True
+
+    def initial(self, count: int = 32, gap: float = 0.0) -> None:
+        done = 0
+        while done < count:
+            if self.exchange():
+                done += 1
+                if gap:
+                    time.sleep(gap)
+        self.fit()
+        for _ in range(3):
+            self._sock.sendto(pack(SYNC_READY), self.remote)
+
+    def fit(self) -> Tuple[float, float, int]:
+        with self._lock:
+            samples = list(self.samples)
+        if samples:
+            self.model = fit_offset(samples)
+        return self.model
+
+    def offset_at(self, t: int) -> float:
+        a, b, t0 = self.model
+        return a + b * (t - t0)
+
+    def start(self, interval: float) -> None:
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def _run(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                if self.exchange():
+                    self.fit()
+            except OSError:
+                return
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.fit()
+        self._sock.close()
+
+    def correct(self, log) -> None:
+        # Re-apply the final fit to every logged sample: latency = recv - send - offset
+        a, b, t0 = self.model
+        np = numpy()
+        for latency, send, recv in zip(
+            log.chunks("latency"), log.chunks("send-time"), log.chunks("recv-time")
+        ):
+            n = latency[1]
+            latency, send, recv = latency[0], send[0], recv[0]
+            if np is not None:
+                view = np.frombuffer(latency, dtype=np.int64, count=n)
+                recv_view = np.frombuffer(recv, dtype=np.int64, count=n)
+                offset = np.rint(a + b * (recv_view - t0).astype(np.float64))
+                view[:] = recv_view - np.frombuffer(send, dtype=np.int64, count=n)
+                view -= offset.astype(np.int64)
+                continue
+            for i in range(n):
+                latency[i] = recv[i] - send[i] - round(a + b * (recv[i] - t0))
@@ -0,0 +1,182 @@
+import math
+import random
+
+from array import array
+from typing import List, Optional, Sequence, Tuple
+
+from udp_io import WIRE_OVERHEAD
+from udp_proto import HEADER
+
+MIN_FRAME = WIRE_OVERHEAD + HEADER.size
+MAX_FRAME = 1500
+# Simple IMIX on the IP layer, frame size: weight
+IMIX = ((40, 7), (576, 4), (1500, 1))
+
+
+class Schedule:
+    # A whole test worked out before the first packet: packet k departs
+    # `offsets[k]` ns after the start with a frame of `sizes[k]` bytes. The
+    # send loop only indexes the two arrays.
+    def __init__(self, offsets: array, sizes: array, duration: float) -> None:
+        if len(offsets) != len(sizes):
+            raise Exception("Warning: schedule offsets and sizes differ in length")
+        self.offsets = offsets
+        self.sizes = sizes
+        self.duration = duration
+        self.fixed_size = len(set(sizes)) <= 1
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def rate(self) -> float:
+        return len(self) / self.duration if self.duration > 0 else math.inf
+
+    @property
+    def max_size(self) -> int:
+        return max(self.sizes) if len(self.sizes) else MIN_FRAME
+
+    @property
+    def mean_size(self) -> float:
+        return sum(self.sizes) / len(self.sizes) if len(self.sizes) else 0.0
+
+
+# ---------- Inter-departure times, ns offsets from the start ----------
+
+
+def constant(rate: float, duration: float) -> array:
+    period = 1e9 / rate
+    return array("q", (int(k * period) for k in range(math.ceil(rate * duration))))
+
+
+def poisson(rate: float, duration: float, rng: random.Random) -> array:
+    # Exponential gaps, on average `rate` packets per second
+    end = duration * 1e9
+    scale = 1e9 / rate
+    expovariate = rng.expovariate
+    offsets = array("q")
+    t = expovariate(1.0) * scale
+    while t < end:
+        offsets.append(int(t))
+        t += expovariate(1.0) * scale
+    return offsets
+
+
+def on_off(
+    rate: float,
+    duration: float,
+    on: float,
+    off: float,
+    rng: Optional[random.Random] = None,
+) -> array:
+    # Bursts at `rate` for `on` seconds, then `off` seconds of silence. With
+    # rng the period lengths are exponential with those means instead.
+    end = int(duration * 1e9)
+    period = 1e9 / rate
+    offsets = array("q")
+    start = 0
+    while start < end:
+        on_ns = (rng.expovariate(1.0 / on) if rng else on) * 1e9
+        off_ns = (rng.expovariate(1.0 / off) if rng else off) * 1e9
+        stop = min(start + on_ns, end)
+        k = 0
+        t: float = start
+        while t < stop:
+            offsets.append(int(t))
+            k += 1
+            t = start + k * period
+        start = int(stop + off_ns)
+    return offsets
+
+
+# ---------- Packet sizes ----------
+
+
+def fixed_sizes(count: int, size: int) -> array:
+    return array("H", [size]) * count
+
+
+def mixed_sizes(
+    count: int, mix: Sequence[Tuple[int, float]], rng: random.Random
+) -> array:
+    # Frame sizes drawn by weight, clamped to what the header allows
+    sizes = [min(max(size, MIN_FRAME), MAX_FRAME) for size, _ in mix]
+    weights = [weight for _, weight in mix]
+    return array("H", rng.choices(sizes, weights, k=count))
+
+
+def parse_mix(value: str) -> List[Tuple[int, float]]:
+    # "imix" or "size:weight,size:weight,..."
+    if value == "imix":
+        return list(IMIX)
+    mix = []
+    for item in value.split(","):
+        size, _, weight = item.partition(":")
+        mix.append((int(size), float(weight or 1)))
+    return mix
+
+
+# ---------- Recorded traces ----------
+
+
+def load_trace(path: str, scale: float = 1.0) -> Schedule:
+    # One packet per line: departure time in seconds and frame size,
+    # separated by a comma or whitespace; '#' starts a comment. Times are
+    # taken relative to the first packet, `scale` stretches them.
+    times = []
+    sizes = array("H")
+    with open(path) as f:
+        for line in f:
+            fields = line.split("#", 1)[0].replace(",", " ").split()
+            if not fields:
+                continue
+            times.append(float(fields[0]))
+            size = int(fields[1]) if len(fields) > 1 else MAX_FRAME
+            sizes.append(min(max(size, MIN_FRAME), MAX_FRAME))
+    if not times:
+        raise Exception("Warning: trace %s has no packets" % path)
+    first = times[0]
+    offsets = array("q", (int((t - first) * scale * 1e9) for t in times))
+    if any(b < a for a, b in zip(offsets, offsets[1:])):
+        raise Exception("Warning: trace %s is not sorted by time" % path)
+    # The last packet still gets its share of the running time
+    duration = (offsets[-1] * 1e-9) * len(offsets) / max(len(offsets) - 1, 1)
+    return Schedule(offsets, sizes, duration)
+
+
+def make_schedule(
+    pattern: str,
+    rate: float,
+    duration: float,
+    size: int,
+    mix: Optional[str] = None,
+    seed: Optional[int] = None,
+) -> Schedule:
+    # pattern: constant | poisson | onoff:<on s>:<off s>[:exp] | trace:<path>[:<scale>]
+    # mix overrides the fixed `size` (ignored for traces, they carry sizes)
+    rng = random.Random(seed)
+    kind, _, args = pattern.partition(":")
+    if kind == "trace":
+        # A trailing ":<number>" is the scale, anything else is part of the path
+        path, _, suffix = args.rpartition(":")
+        try:
+            scale = float(suffix)
+        except ValueError:
+            path, scale = args, 1.0
+        return load_trace(path, scale)
+    if not math.isfinite(rate) or rate <= 0:
+        raise Exception("Warning: traffic patterns need a finite rate")
+    if kind == "constant":
+        offsets = constant(rate, duration)
+    elif kind == "poisson":
+        offsets = poisson(rate, duration, rng)
+    elif kind == "onoff":
+        on, off, *exp = (args or "0.1:0.9").split(":")
+        offsets = on_off(rate, duration, float(on), float(off), rng if exp else None)
+    else:
+        raise Exception("Warning: unknown traffic pattern %s" % pattern)
+    if mix:
+        sizes = mixed_sizes(len(offsets), parse_mix(mix), rng)
+    else:
+        sizes = fixed_sizes(len(offsets), size)
+    return Schedule(offsets, sizes, duration)